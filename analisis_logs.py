@@ -1,10 +1,21 @@
-﻿import json
-from typing import Any, Dict
+﻿import argparse
+import json
+import os
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
+import numpy as np
 import pandas as pd
 
+from src.controllers.log_index import segmentos_log
+from src.models.domain import FlowStep
+
 LOG_PATH = "logs.jsonl"
 EXPORT_CSV = "logs_export_powerbi.csv"
+EXPORT_FUNNEL_CSV = "logs_funnel.csv"
+CHECKPOINT_PATH = "logs_checkpoint.json"
+# Sesiones recientes que recuerda el checkpoint para no contarlas dos veces (acota su tamano)
+MAX_SESIONES_RECIENTES = 10_000
 
 
 def cargar_logs(path: str = LOG_PATH) -> pd.DataFrame:
@@ -47,6 +58,12 @@ def calcular_metricas(df: pd.DataFrame) -> None:
         porcentaje_completadas = (len(completadas) / total_conversaciones * 100) if total_conversaciones else 0
         print(f"\nPorcentaje de conversaciones que llegaron a COMPLETADO: {porcentaje_completadas:.2f}%")
 
+    if "llamadas_llm" in df:
+        llamadas = pd.to_numeric(df["llamadas_llm"], errors="coerce")
+        if llamadas.notna().any():
+            print(f"\nLlamadas al LLM por turno (promedio): {llamadas.mean():.2f}")
+            print(f"Total de llamadas al LLM: {int(llamadas.sum())}")
+
     if "timestamp" in df:
         fechas = pd.to_datetime(df["timestamp"], errors="coerce")
         if fechas.notna().any():
@@ -54,10 +71,114 @@ def calcular_metricas(df: pd.DataFrame) -> None:
             print(f"Desde: {fechas.min()} | Hasta: {fechas.max()}")
 
 
-def exportar_powerbi(df: pd.DataFrame) -> pd.DataFrame:
-    if df.empty:
-        return pd.DataFrame()
+def calcular_latencias(df: pd.DataFrame) -> pd.DataFrame:
+    """p50/p95/p99 (ms) por etapa a partir de `duraciones_ms` (turnos registrados con METRICS_ENABLED)."""
+    columnas = ["turnos", "p50_ms", "p95_ms", "p99_ms"]
+    if df.empty or "duraciones_ms" not in df:
+        return pd.DataFrame(columns=columnas)
+    duraciones = df["duraciones_ms"].dropna()
+    duraciones = duraciones[duraciones.map(lambda d: isinstance(d, dict))]
+    if duraciones.empty:
+        return pd.DataFrame(columns=columnas)
+    por_etapa = pd.DataFrame(duraciones.tolist()).apply(pd.to_numeric, errors="coerce")
+    latencias = por_etapa.quantile([0.5, 0.95, 0.99]).T.round(2)
+    latencias.columns = columnas[1:]
+    latencias.insert(0, "turnos", por_etapa.notna().sum())
+    latencias.index.name = "etapa"
+    return latencias
+
+
+def calcular_funnel(df: pd.DataFrame) -> pd.DataFrame:
+    """Funnel por paso del flujo (FlowStep), calculado solo con groupby/sort vectorizados.
+
+    Por paso: sesiones que lo alcanzaron (y % del total), mediana de turnos en el paso,
+    sesiones cuyo ultimo turno registrado quedo en ese paso (abandono; COMPLETADO no
+    cuenta como abandono) y segundos hasta el siguiente turno (mediana y p90), que es
+    lo que tardo el usuario en responder a ese paso.
+
+    Una sesion alcanzo un paso si su paso mas avanzado (en el orden de FlowStep) es ese
+    o uno posterior, aunque no haya tenido turnos en el (dio varios datos de una vez):
+    asi `sesiones` nunca crece de un paso al siguiente.
+    """
+    pasos = [step.name for step in FlowStep]
+    columnas = [
+        "sesiones",
+        "pct_sesiones",
+        "mediana_turnos",
+        "abandonos",
+        "pct_abandono",
+        "mediana_seg_siguiente_turno",
+        "p90_seg_siguiente_turno",
+    ]
+    if df.empty or not {"session_id", "paso"}.issubset(df.columns):
+        return pd.DataFrame(columns=columnas, index=pd.Index(pasos, name="paso"))
+
+    d = df[["session_id", "paso"]].copy()
+    d["turno"] = pd.to_numeric(df["turno"], errors="coerce") if "turno" in df else np.nan
+    d["ts"] = (
+        pd.to_datetime(df["timestamp"], utc=True, format="ISO8601", errors="coerce")
+        if "timestamp" in df
+        else pd.NaT
+    )
+    d = d.dropna(subset=["session_id", "paso"])
+    d = d.sort_values(["session_id", "turno", "ts"], kind="stable")
+    total_sesiones = d["session_id"].nunique()
+
+    por_sesion = d.groupby("session_id", sort=False)
+    d["seg_siguiente"] = (por_sesion["ts"].shift(-1) - d["ts"]).dt.total_seconds()
 
+    turnos_paso = d.groupby(["paso", "session_id"], sort=False).size()
+    por_paso = turnos_paso.groupby(level="paso")
+    # Alcance: cuantas sesiones tienen su paso mas avanzado en cada indice, acumulado desde el final
+    indice_paso = d["paso"].map({paso: indice for indice, paso in enumerate(pasos)})
+    mas_avanzado = indice_paso.groupby(d["session_id"], sort=False).max().dropna().astype("int64")
+    alcanzadas = np.bincount(mas_avanzado, minlength=len(pasos))[::-1].cumsum()[::-1]
+    ultimos = por_sesion.tail(1)
+    abandonos = ultimos.loc[ultimos["paso"] != FlowStep.COMPLETADO.name, "paso"].value_counts()
+    tiempos = d.groupby("paso")["seg_siguiente"]
+
+    funnel = pd.DataFrame(
+        {
+            "sesiones": pd.Series(alcanzadas, index=pasos),
+            "mediana_turnos": por_paso.median(),
+            "abandonos": abandonos,
+            "mediana_seg_siguiente_turno": tiempos.median(),
+            "p90_seg_siguiente_turno": tiempos.quantile(0.9),
+        }
+    )
+    funnel = funnel.reindex(pasos)
+    funnel.index.name = "paso"
+    funnel[["sesiones", "abandonos"]] = funnel[["sesiones", "abandonos"]].fillna(0).astype("int64")
+    funnel["pct_sesiones"] = (funnel["sesiones"] / total_sesiones * 100).round(2) if total_sesiones else 0.0
+    funnel["pct_abandono"] = (
+        (funnel["abandonos"] / funnel["sesiones"].where(funnel["sesiones"] > 0) * 100).round(2)
+    )
+    return funnel[columnas]
+
+
+def exportar_funnel(funnel: pd.DataFrame, path: str = EXPORT_FUNNEL_CSV) -> None:
+    funnel.to_csv(path, encoding="utf-8")
+
+
+COLUMNAS_EXPORT = [
+    "session_id",
+    "turno",
+    "timestamp",
+    "usuario_texto",
+    "bot_texto",
+    "intencion",
+    "paso",
+    "nombre",
+    "identificacion",
+    "especialidad",
+    "fecha",
+    "hora",
+    "medio",
+]
+
+
+def aplanar_logs(df: pd.DataFrame, columnas_finales: List[str] = COLUMNAS_EXPORT) -> pd.DataFrame:
+    """Aplana `memoria` en columnas y deja solo `columnas_finales` (las que falten quedan en None)."""
     df_export = df.copy()
     memoria_cols = pd.json_normalize(df_export["memoria"]).rename(columns=lambda c: c.lower()) if "memoria" in df_export else pd.DataFrame()
     for col in ["nombre", "identificacion", "especialidad", "fecha", "hora", "medio"]:
@@ -65,31 +186,365 @@ def exportar_powerbi(df: pd.DataFrame) -> pd.DataFrame:
             memoria_cols[col] = None
     df_export = pd.concat([df_export.drop(columns=["memoria"], errors="ignore"), memoria_cols], axis=1)
 
-    columnas_finales = [
-        "session_id",
-        "turno",
-        "timestamp",
-        "usuario_texto",
-        "bot_texto",
-        "intencion",
-        "paso",
-        "nombre",
-        "identificacion",
-        "especialidad",
-        "fecha",
-        "hora",
-        "medio",
-    ]
     for col in columnas_finales:
         if col not in df_export:
             df_export[col] = None
-    df_export = df_export[columnas_finales]
+    return df_export[columnas_finales]
+
+
+def exportar_powerbi(df: pd.DataFrame) -> pd.DataFrame:
+    if df.empty:
+        return pd.DataFrame()
+
+    df_export = aplanar_logs(df)
     df_export.to_csv(EXPORT_CSV, index=False, encoding="utf-8")
     return df_export
 
 
-def main() -> None:
-    df = cargar_logs()
+# --- Export columnar (Parquet / Arrow IPC) ----------------------------------------------
+
+EXPORT_COLUMNAR_DIR = "logs_export_columnar"
+PARTICION_SIN_FECHA = "sin_fecha"
+
+
+def _esquema_columnar() -> "pa.Schema":
+    import pyarrow as pa
+
+    texto = pa.string()
+    categoria = pa.dictionary(pa.int8(), pa.string())
+    return pa.schema(
+        [
+            ("session_id", texto),
+            ("turno", pa.int32()),
+            ("timestamp", pa.timestamp("us", tz="UTC")),
+            ("usuario_texto", texto),
+            ("bot_texto", texto),
+            ("intencion", categoria),
+            ("paso", categoria),
+            ("llamadas_llm", pa.int16()),
+            ("nombre", texto),
+            ("identificacion", texto),
+            ("especialidad", texto),
+            ("fecha", texto),
+            ("hora", texto),
+            ("medio", texto),
+        ]
+    )
+
+
+def _particiones_existentes(directorio: str) -> List[str]:
+    if not os.path.isdir(directorio):
+        return []
+    return sorted(
+        nombre[len("dia="):]
+        for nombre in os.listdir(directorio)
+        if nombre.startswith("dia=") and nombre != f"dia={PARTICION_SIN_FECHA}"
+    )
+
+
+def exportar_columnar(
+    df: pd.DataFrame, directorio: str = EXPORT_COLUMNAR_DIR, formato: str = "parquet"
+) -> List[str]:
+    """Export columnar tipado, particionado por dia (`dia=YYYY-MM-DD/`), en Parquet o Arrow IPC.
+
+    Solo agrega particiones nuevas: los dias anteriores al ultimo ya exportado no se
+    reescriben; el ultimo dia exportado si (puede haber recibido turnos nuevos).
+    `intencion` y `paso` van dictionary-encoded. Requiere pyarrow.
+    Devuelve las rutas escritas.
+    """
+    if formato not in ("parquet", "ipc"):
+        raise ValueError("formato debe ser 'parquet' o 'ipc'")
+    if df.empty:
+        return []
+    try:
+        import pyarrow as pa
+        import pyarrow.ipc as ipc
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise RuntimeError("El export columnar requiere pyarrow (pip install pyarrow).") from e
+
+    esquema = _esquema_columnar()
+    df_export = aplanar_logs(df, esquema.names)
+    df_export["timestamp"] = pd.to_datetime(df_export["timestamp"], utc=True, format="ISO8601", errors="coerce")
+    df_export["turno"] = pd.to_numeric(df_export["turno"], errors="coerce").astype("Int32")
+    df_export["llamadas_llm"] = pd.to_numeric(df_export["llamadas_llm"], errors="coerce").astype("Int16")
+    dias = df_export["timestamp"].dt.strftime("%Y-%m-%d").fillna(PARTICION_SIN_FECHA)
+
+    existentes = _particiones_existentes(directorio)
+    ultima = existentes[-1] if existentes else None
+    extension = "parquet" if formato == "parquet" else "arrow"
+    escritos: List[str] = []
+    for dia, filas in df_export.groupby(dias, sort=True):
+        if ultima is not None and dia != PARTICION_SIN_FECHA and dia < ultima:
+            continue
+        tabla = pa.Table.from_pandas(filas, schema=esquema, preserve_index=False)
+        carpeta = os.path.join(directorio, f"dia={dia}")
+        os.makedirs(carpeta, exist_ok=True)
+        destino = os.path.join(carpeta, f"part-0.{extension}")
+        tmp = destino + ".tmp"
+        if formato == "parquet":
+            pq.write_table(tabla, tmp, compression="zstd")
+        else:
+            with pa.OSFile(tmp, "wb") as sink, ipc.new_file(sink, esquema) as writer:
+                writer.write_table(tabla)
+        os.replace(tmp, destino)
+        escritos.append(destino)
+    return escritos
+
+
+# --- Modo incremental ------------------------------------------------------------------
+
+
+@dataclass
+class AgregadosLogs:
+    """Agregados parciales del log que se guardan entre ejecuciones (checkpoint).
+
+    Los conteos por intencion/paso son listas [valor, conteo] en orden de primera
+    aparicion, igual que value_counts, para que los empates se impriman igual.
+    Las sesiones se cuentan, no se guardan: solo se recuerdan las ultimas
+    MAX_SESIONES_RECIENTES (session_id -> si ya llego a COMPLETADO) para no
+    contar dos veces una sesion que sigue entre ejecuciones. Una sesion que
+    vuelve despues de salir de esa ventana se cuenta de nuevo.
+    """
+
+    total_turnos: int = 0
+    columnas: List[str] = field(default_factory=list)
+    sesiones: int = 0
+    intenciones: List[List[Any]] = field(default_factory=list)
+    pasos: List[List[Any]] = field(default_factory=list)
+    sesiones_completadas: int = 0
+    sesiones_recientes: Dict[str, bool] = field(default_factory=dict)
+    llamadas_llm_suma: float = 0.0
+    llamadas_llm_n: int = 0
+    primer_timestamp: Optional[str] = None
+    timestamp_min: Optional[str] = None
+    timestamp_max: Optional[str] = None
+
+    @classmethod
+    def desde_checkpoint(cls, datos: Dict[str, Any]) -> "AgregadosLogs":
+        """Agregados guardados en el checkpoint (convierte los de versiones que guardaban cada sesion)."""
+        datos = dict(datos)
+        turnos_por_sesion = datos.pop("turnos_por_sesion", None)
+        if turnos_por_sesion is not None:
+            completadas = set(datos.get("sesiones_completadas") or [])
+            datos["sesiones"] = len(turnos_por_sesion)
+            datos["sesiones_completadas"] = len(completadas)
+            recientes = list(turnos_por_sesion)[-MAX_SESIONES_RECIENTES:]
+            datos["sesiones_recientes"] = {sid: sid in completadas for sid in recientes}
+        return cls(**datos)
+
+    def _ver_sesion(self, session_id: str, completada: bool) -> None:
+        recientes = self.sesiones_recientes
+        ya_completada = recientes.pop(session_id, None)
+        if ya_completada is None:
+            self.sesiones += 1
+            ya_completada = False
+        if completada and not ya_completada:
+            self.sesiones_completadas += 1
+        # Al final: la ventana queda ordenada por ultimo turno visto
+        recientes[session_id] = completada or ya_completada
+        while len(recientes) > MAX_SESIONES_RECIENTES:
+            del recientes[next(iter(recientes))]
+
+    def actualizar(self, registros: List[Dict[str, Any]]) -> None:
+        """Suma un lote de registros nuevos a los agregados."""
+        if not registros:
+            return
+        intenciones = {valor: n for valor, n in self.intenciones}
+        pasos = {valor: n for valor, n in self.pasos}
+        columnas = dict.fromkeys(self.columnas)
+        timestamps = []
+        for registro in registros:
+            columnas.update(dict.fromkeys(registro))
+            self.total_turnos += 1
+            session_id = registro.get("session_id")
+            intencion = registro.get("intencion")
+            intenciones[intencion] = intenciones.get(intencion, 0) + 1
+            paso = registro.get("paso")
+            pasos[paso] = pasos.get(paso, 0) + 1
+            if session_id is not None:
+                self._ver_sesion(session_id, paso == "COMPLETADO")
+            llamadas = registro.get("llamadas_llm")
+            if isinstance(llamadas, (int, float)) and not isinstance(llamadas, bool):
+                self.llamadas_llm_suma += llamadas
+                self.llamadas_llm_n += 1
+            timestamp = registro.get("timestamp")
+            if timestamp is not None:
+                if self.primer_timestamp is None:
+                    self.primer_timestamp = timestamp
+                timestamps.append(timestamp)
+        self.columnas = list(columnas)
+        self.intenciones = [[valor, n] for valor, n in intenciones.items()]
+        self.pasos = [[valor, n] for valor, n in pasos.items()]
+        self._actualizar_rango(timestamps)
+
+    def _actualizar_rango(self, timestamps: List[Any]) -> None:
+        if not timestamps:
+            return
+        # Se antepone el primer timestamp historico para que pandas infiera el mismo
+        # formato que en el escaneo completo (lo infiere del primer valor no nulo)
+        fechas = pd.to_datetime(pd.Series([self.primer_timestamp] + timestamps), errors="coerce").iloc[1:]
+        fechas = fechas.dropna()
+        if fechas.empty:
+            return
+        candidatos_min = [fechas.min()] + ([pd.Timestamp(self.timestamp_min)] if self.timestamp_min else [])
+        candidatos_max = [fechas.max()] + ([pd.Timestamp(self.timestamp_max)] if self.timestamp_max else [])
+        self.timestamp_min = str(min(candidatos_min))
+        self.timestamp_max = str(max(candidatos_max))
+
+
+def _conteos_como_value_counts(conteos: List[List[Any]], nombre: str) -> pd.Series:
+    indice = pd.Index([np.nan if valor is None else valor for valor, _ in conteos], name=nombre)
+    serie = pd.Series([n for _, n in conteos], index=indice, name="count", dtype="int64")
+    return serie.sort_values(ascending=False, kind="stable")
+
+
+def imprimir_metricas_agregadas(agregados: AgregadosLogs) -> None:
+    """Mismo reporte que calcular_metricas, pero desde los agregados del checkpoint."""
+    if agregados.total_turnos == 0:
+        print("No hay datos en logs.jsonl todavia.")
+        return
+
+    columnas = set(agregados.columnas)
+    print("== Metricas de conversacion ==")
+    total_turnos = agregados.total_turnos
+    total_conversaciones = agregados.sesiones if "session_id" in columnas else 0
+    promedio_turnos = total_turnos / total_conversaciones if total_conversaciones else 0
+    print(f"Total de turnos: {total_turnos}")
+    print(f"Total de conversaciones: {total_conversaciones}")
+    print(f"Promedio de turnos por conversacion: {promedio_turnos:.2f}")
+
+    if "intencion" in columnas:
+        print("\nTurnos por intencion:")
+        print(_conteos_como_value_counts(agregados.intenciones, "intencion"))
+
+    if "paso" in columnas:
+        print("\nTurnos por paso del flujo:")
+        print(_conteos_como_value_counts(agregados.pasos, "paso"))
+
+    if "paso" in columnas and "session_id" in columnas:
+        completadas = agregados.sesiones_completadas
+        porcentaje_completadas = (completadas / total_conversaciones * 100) if total_conversaciones else 0
+        print(f"\nPorcentaje de conversaciones que llegaron a COMPLETADO: {porcentaje_completadas:.2f}%")
+
+    if "llamadas_llm" in columnas and agregados.llamadas_llm_n:
+        promedio = agregados.llamadas_llm_suma / agregados.llamadas_llm_n
+        print(f"\nLlamadas al LLM por turno (promedio): {promedio:.2f}")
+        print(f"Total de llamadas al LLM: {int(agregados.llamadas_llm_suma)}")
+
+    if "timestamp" in columnas and agregados.timestamp_min is not None:
+        print("\nRango temporal de actividad:")
+        print(f"Desde: {pd.Timestamp(agregados.timestamp_min)} | Hasta: {pd.Timestamp(agregados.timestamp_max)}")
+
+
+def _leer_desde(path: str, offset: int) -> Tuple[List[Dict[str, Any]], int]:
+    """Lee las lineas completas agregadas despues de `offset`. Devuelve registros y nuevo offset.
+
+    Una linea final sin salto de linea (escritura a medias) se deja para la siguiente ejecucion.
+    """
+    registros: List[Dict[str, Any]] = []
+    with open(path, "rb") as f:
+        f.seek(offset)
+        for raw in f:
+            if not raw.endswith(b"\n"):
+                break
+            offset += len(raw)
+            line = raw.decode("utf-8").strip()
+            if not line:
+                continue
+            try:
+                registros.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return registros, offset
+
+
+def _rotados_desde(path: str, inode: int) -> List[Tuple[str, int]]:
+    """(segmento, inodo) de los segmentos rotados desde el que tenia `inode`, del mas viejo al mas nuevo.
+
+    Vacio si ese segmento ya no existe (no se sabe que rotados faltan leer).
+    """
+    rotados: List[Tuple[str, int]] = []
+    for segmento in segmentos_log(path):
+        if segmento == path:
+            continue
+        try:
+            rotados.append((segmento, os.stat(segmento).st_ino))
+        except OSError:
+            continue
+    inodos = [inodo for _, inodo in rotados]
+    return rotados[inodos.index(inode):] if inode in inodos else []
+
+
+def _cargar_checkpoint(checkpoint_path: str) -> Dict[str, Any]:
+    if not os.path.exists(checkpoint_path):
+        return {}
+    with open(checkpoint_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _guardar_checkpoint(checkpoint_path: str, checkpoint: Dict[str, Any]) -> None:
+    tmp_path = checkpoint_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f, ensure_ascii=False)
+    os.replace(tmp_path, checkpoint_path)
+
+
+def _fragmentos_nuevos(path: str, checkpoint: Dict[str, Any]) -> Iterator[Tuple[List[Dict[str, Any]], int, int]]:
+    """Genera (registros, inodo, offset) pendientes desde el checkpoint, siguiendo rotaciones."""
+    offset = checkpoint.get("offset", 0)
+    inode = checkpoint.get("inode")
+    stat = os.stat(path)
+    if inode is not None and (stat.st_ino != inode or stat.st_size < offset):
+        # Rotado (o truncado): primero se termina el segmento del checkpoint y despues
+        # los rotados posteriores, por si hubo mas de una rotacion entre ejecuciones
+        rotados = _rotados_desde(path, inode) if stat.st_ino != inode else []
+        for segmento, inodo in rotados:
+            registros, fin = _leer_desde(segmento, offset)
+            yield registros, inodo, fin
+            offset = 0
+        offset = 0
+    registros, offset = _leer_desde(path, offset)
+    yield registros, stat.st_ino, offset
+
+
+def analizar_incremental(path: str = LOG_PATH, checkpoint_path: str = CHECKPOINT_PATH) -> AgregadosLogs:
+    """Procesa solo lo agregado al log desde la ultima ejecucion y actualiza el checkpoint."""
+    checkpoint = _cargar_checkpoint(checkpoint_path)
+    agregados = AgregadosLogs.desde_checkpoint(checkpoint.get("agregados", {}))
+    nuevos = 0
+    for registros, inode, offset in _fragmentos_nuevos(path, checkpoint):
+        agregados.actualizar(registros)
+        nuevos += len(registros)
+        checkpoint = {"path": path, "inode": inode, "offset": offset}
+    checkpoint["agregados"] = asdict(agregados)
+    _guardar_checkpoint(checkpoint_path, checkpoint)
+    print(f"Registros nuevos procesados: {nuevos}\n")
+    return agregados
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Metricas de logs.jsonl y export para BI.")
+    parser.add_argument("--log", default=LOG_PATH, help="ruta del log JSONL")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="procesa solo las lineas nuevas y acumula en el checkpoint (no exporta CSV)",
+    )
+    parser.add_argument("--checkpoint", default=CHECKPOINT_PATH, help="archivo de checkpoint incremental")
+    parser.add_argument(
+        "--columnar",
+        choices=["parquet", "ipc"],
+        help="ademas del CSV, exporta particiones por dia en Parquet o Arrow IPC",
+    )
+    parser.add_argument("--columnar-dir", default=EXPORT_COLUMNAR_DIR, help="carpeta del export columnar")
+    args = parser.parse_args(argv)
+
+    if args.incremental:
+        imprimir_metricas_agregadas(analizar_incremental(args.log, args.checkpoint))
+        return
+
+    df = cargar_logs(args.log)
 
     if df.empty:
         print("No hay datos en logs.jsonl todavia.")
@@ -104,9 +559,24 @@ def main() -> None:
     print("\n")
     calcular_metricas(df)
 
+    latencias = calcular_latencias(df)
+    if not latencias.empty:
+        print("\n== Latencia por etapa (ms) ==")
+        print(latencias.to_string())
+
+    funnel = calcular_funnel(df)
+    print("\n== Funnel por paso del flujo ==")
+    print(funnel.to_string())
+    exportar_funnel(funnel)
+
     df_export = exportar_powerbi(df)
     if not df_export.empty:
         print(f"\nCSV exportado a {EXPORT_CSV} con {len(df_export)} filas.")
+    print(f"Funnel exportado a {EXPORT_FUNNEL_CSV}.")
+
+    if args.columnar:
+        escritos = exportar_columnar(df, args.columnar_dir, args.columnar)
+        print(f"Export columnar ({args.columnar}): {len(escritos)} particiones escritas en {args.columnar_dir}.")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,280 @@
+﻿import argparse
+import asyncio
+import datetime
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from benchmarks.fake_openai import FakeOpenAIServer
+
+RESULTADOS_DIR = Path(__file__).resolve().parent / "resultados"
+ESPECIALIDADES = ("cardiologia", "pediatria", "dermatologia")
+BLOQUES_POR_DIA = 18  # L-V 08:00-17:00 en bloques de 30 min (ver Agenda)
+
+
+def guion_conversacion(indice: int, inicio: datetime.date) -> List[str]:
+    """Mensajes de una conversacion completa; cada indice reserva un bloque distinto (sin conflictos)."""
+    especialidad = ESPECIALIDADES[indice % len(ESPECIALIDADES)]
+    posicion = indice // len(ESPECIALIDADES)
+    dia = inicio
+    for _ in range(posicion // BLOQUES_POR_DIA):
+        dia += datetime.timedelta(days=1)
+        while dia.weekday() >= 5:
+            dia += datetime.timedelta(days=1)
+    minutos = 8 * 60 + (posicion % BLOQUES_POR_DIA) * 30
+    return [
+        "Hola, quiero agendar una cita",
+        f"Me llamo Paciente {indice}",
+        f"Mi identificacion es {1_000_000 + indice}",
+        especialidad,
+        f"Para el {dia.isoformat()}",
+        f"{minutos // 60:02d}:{minutos % 60:02d}",
+        "virtual",
+        "si",
+    ]
+
+
+def _primer_dia_habil() -> datetime.date:
+    dia = datetime.date.today() + datetime.timedelta(days=1)
+    while dia.weekday() >= 5:
+        dia += datetime.timedelta(days=1)
+    return dia
+
+
+def rss_mb() -> float:
+    """RSS actual del proceso en MB (/proc en Linux; si no, el pico de getrusage)."""
+    try:
+        with open("/proc/self/statm") as f:
+            paginas = int(f.read().split()[1])
+        return paginas * os.sysconf("SC_PAGE_SIZE") / 1_048_576
+    except (OSError, ValueError, IndexError):
+        maximo = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maximo / (1_048_576 if sys.platform == "darwin" else 1024)
+
+
+def percentil(valores: List[float], p: float) -> Optional[float]:
+    """Percentil por rango mas cercano (valores sin ordenar)."""
+    if not valores:
+        return None
+    ordenados = sorted(valores)
+    indice = max(0, min(len(ordenados) - 1, int(round(p / 100 * len(ordenados) + 0.5)) - 1))
+    return round(ordenados[indice], 3)
+
+
+def commit_actual() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=Path(__file__).resolve().parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def _conversacion(
+    client: httpx.AsyncClient, mensajes: List[str], latencias: List[float], estados: Counter
+) -> bool:
+    session_id: Optional[str] = None
+    for mensaje in mensajes:
+        inicio = time.perf_counter()
+        response = await client.post("/api/v1/chat", json={"message": mensaje, "session_id": session_id})
+        latencias.append((time.perf_counter() - inicio) * 1000)
+        estados[str(response.status_code)] += 1
+        if response.status_code != 200:
+            return False
+        data = response.json()
+        if data["completed"]:
+            return True
+        session_id = data["session_id"]
+    return False
+
+
+async def ejecutar_benchmark(args: argparse.Namespace, fake: FakeOpenAIServer) -> Dict[str, Any]:
+    # Los modulos de la API leen su configuracion del entorno al importarse
+    from src.api.api import app
+    from src.api.routers import chat
+    from src.controllers.nlu_cache import NLU_CACHE
+
+    inicio_agenda = _primer_dia_habil()
+    guiones = [guion_conversacion(i, inicio_agenda) for i in range(args.conversaciones)]
+    latencias: List[float] = []
+    estados: Counter = Counter()
+    semaforo = asyncio.Semaphore(args.concurrencia)
+
+    async def _limitada(client: httpx.AsyncClient, mensajes: List[str]) -> bool:
+        async with semaforo:
+            return await _conversacion(client, mensajes, latencias, estados)
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            rss_inicial = rss_mb()
+            sesiones_inicial = chat.SESSION_STORE.stats()
+            peticiones_llm_inicial = fake.peticiones
+            inicio = time.perf_counter()
+            completadas = await asyncio.gather(*(_limitada(client, g) for g in guiones))
+            duracion = time.perf_counter() - inicio
+            rss_final = rss_mb()
+            sesiones_final = chat.SESSION_STORE.stats()
+            nlu_cache = NLU_CACHE.stats()
+
+    turnos = len(latencias)
+    llamadas_llm = fake.peticiones - peticiones_llm_inicial
+    return {
+        "version": commit_actual(),
+        "fecha": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "config": {
+            "conversaciones": args.conversaciones,
+            "concurrencia": args.concurrencia,
+            "latencia_ms": args.latencia_ms,
+            "distribucion": args.distribucion,
+            "jitter_ms": args.jitter_ms,
+            "tasa_error": args.tasa_error,
+            "llm_pool_size": int(os.environ.get("LLM_POOL_SIZE", 10)),
+            "nlu_cache_size": NLU_CACHE.max_size,
+            "log_mode": os.environ.get("LOG_MODE", "sync"),
+        },
+        "turnos": turnos,
+        "duracion_s": round(duracion, 3),
+        "turnos_por_s": round(turnos / duracion, 2) if duracion else None,
+        "latencia_ms": {
+            "p50": percentil(latencias, 50),
+            "p95": percentil(latencias, 95),
+            "p99": percentil(latencias, 99),
+            "max": round(max(latencias), 3) if latencias else None,
+        },
+        "respuestas_http": dict(estados),
+        "conversaciones_completadas": sum(completadas),
+        "llamadas_llm": llamadas_llm,
+        "llamadas_llm_por_turno": round(llamadas_llm / turnos, 3) if turnos else None,
+        "errores_llm_inyectados": fake.errores,
+        "rss_mb": {
+            "inicial": round(rss_inicial, 2),
+            "final": round(rss_final, 2),
+            "crecimiento": round(rss_final - rss_inicial, 2),
+        },
+        "session_store": {"inicial": sesiones_inicial, "final": sesiones_final},
+        "nlu_cache": nlu_cache,
+    }
+
+
+def comparar(actual: Dict[str, Any], previo: Dict[str, Any]) -> List[str]:
+    """Lineas con la variacion (%) de las metricas principales respecto a un resultado previo."""
+    metricas = [
+        ("turnos_por_s", lambda r: r.get("turnos_por_s")),
+        ("latencia p50", lambda r: r.get("latencia_ms", {}).get("p50")),
+        ("latencia p99", lambda r: r.get("latencia_ms", {}).get("p99")),
+        ("llamadas_llm_por_turno", lambda r: r.get("llamadas_llm_por_turno")),
+        ("crecimiento RSS (MB)", lambda r: r.get("rss_mb", {}).get("crecimiento")),
+    ]
+    lineas = [f"Comparacion contra {previo.get('version') or 'resultado previo'}:"]
+    for nombre, valor in metricas:
+        antes, ahora = valor(previo), valor(actual)
+        if antes is None or ahora is None:
+            continue
+        cambio = f"{(ahora - antes) / antes * 100:+.1f}%" if antes else "n/a"
+        lineas.append(f"  {nombre}: {antes} -> {ahora} ({cambio})")
+    return lineas
+
+
+def configurar_entorno(
+    directorio: str,
+    url_llm: str,
+    log_mode: str = "buffered",
+    max_sesiones: int = 10_000,
+    pool_size: Optional[int] = None,
+    nlu_cache_size: Optional[int] = None,
+    session_backend: str = "memory",
+) -> None:
+    """Apunta la API (aun sin importar) al LLM falso y a una BD/log dentro de `directorio`."""
+    os.environ["OPENAI_API_KEY"] = os.environ.get("OPENAI_API_KEY", "bench")
+    os.environ["OPENAI_API_URL"] = url_llm
+    os.environ["APPOINTMENTS_DB_PATH"] = os.path.join(directorio, "appointments.db")
+    os.environ["LOG_PATH"] = os.path.join(directorio, "logs.jsonl")
+    os.environ.setdefault("LOG_MODE", log_mode)
+    os.environ["SESSION_MAX"] = str(max_sesiones)
+    os.environ["SESSION_BACKEND"] = session_backend
+    os.environ["SESSION_DB_PATH"] = os.path.join(directorio, "sessions.db")
+    if pool_size is not None:
+        os.environ["LLM_POOL_SIZE"] = str(pool_size)
+    if nlu_cache_size is not None:
+        os.environ["NLU_CACHE_SIZE"] = str(nlu_cache_size)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Benchmark de /api/v1/chat contra un LLM falso local.")
+    parser.add_argument("--conversaciones", type=int, default=200, help="conversaciones completas a ejecutar")
+    parser.add_argument("--concurrencia", type=int, default=20, help="conversaciones simultaneas")
+    parser.add_argument("--latencia-ms", type=float, default=50.0, help="latencia del LLM falso")
+    parser.add_argument("--distribucion", choices=["fija", "uniforme", "lognormal"], default="lognormal")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="+- ms para la distribucion uniforme")
+    parser.add_argument("--tasa-error", type=float, default=0.0, help="probabilidad de 500 del LLM falso")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--pool-size", type=int, help="LLM_POOL_SIZE para el cliente LLM")
+    parser.add_argument("--nlu-cache-size", type=int, help="NLU_CACHE_SIZE (0 desactiva la cache)")
+    parser.add_argument("--log-mode", choices=["sync", "buffered"], default="buffered")
+    parser.add_argument("--session-backend", choices=["memory", "sqlite", "redis"], default="memory")
+    parser.add_argument("--salida", help="JSON de resultados (por defecto benchmarks/resultados/bench-<fecha>.json)")
+    parser.add_argument("--comparar", help="JSON de una corrida previa para mostrar la variacion")
+    args = parser.parse_args(argv)
+
+    fake = FakeOpenAIServer(
+        latencia_ms=args.latencia_ms,
+        distribucion=args.distribucion,
+        jitter_ms=args.jitter_ms,
+        tasa_error=args.tasa_error,
+        seed=args.seed,
+    ).start()
+    try:
+        with tempfile.TemporaryDirectory(prefix="bench-citas-") as directorio:
+            configurar_entorno(
+                directorio,
+                fake.url,
+                log_mode=args.log_mode,
+                max_sesiones=max(args.conversaciones * 2, 10_000),
+                pool_size=args.pool_size,
+                nlu_cache_size=args.nlu_cache_size,
+                session_backend=args.session_backend,
+            )
+            cwd = os.getcwd()
+            os.chdir(directorio)  # log_turno en modo sync escribe logs.jsonl relativo al cwd
+            try:
+                resultado = asyncio.run(ejecutar_benchmark(args, fake))
+            finally:
+                os.chdir(cwd)
+    finally:
+        fake.stop()
+
+    salida = Path(args.salida) if args.salida else RESULTADOS_DIR / (
+        "bench-" + datetime.datetime.now().strftime("%Y%m%dT%H%M%S") + ".json"
+    )
+    salida.parent.mkdir(parents=True, exist_ok=True)
+    salida.write_text(json.dumps(resultado, indent=2, ensure_ascii=False), encoding="utf-8")
+
+    print(
+        f"{resultado['turnos']} turnos en {resultado['duracion_s']} s -> {resultado['turnos_por_s']} turnos/s | "
+        f"p50 {resultado['latencia_ms']['p50']} ms, p99 {resultado['latencia_ms']['p99']} ms | "
+        f"{resultado['llamadas_llm_por_turno']} llamadas LLM/turno | "
+        f"RSS +{resultado['rss_mb']['crecimiento']} MB"
+    )
+    print(f"Conversaciones completadas: {resultado['conversaciones_completadas']}/{args.conversaciones}")
+    print(f"Resultados guardados en {salida}")
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as f:
+            print("\n".join(comparar(resultado, json.load(f))))
+
+
+if __name__ == "__main__":
+    main()
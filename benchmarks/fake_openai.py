@@ -0,0 +1,147 @@
+﻿import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional, Tuple
+
+# Respuestas "de libreto": el servidor extrae con regex lo mismo que el LLM real devolveria
+_ESPECIALIDADES = ("cardiologia", "pediatria", "dermatologia", "medicina general", "ginecologia")
+_NOMBRE_RE = re.compile(r"me llamo ([a-z0-9 ]+)", re.IGNORECASE)
+_IDENTIFICACION_RE = re.compile(r"\b(\d{6,})\b")
+_FECHA_RE = re.compile(r"\b(\d{4}-\d{2}-\d{2})\b")
+_HORA_RE = re.compile(r"\b(\d{1,2}:\d{2})\b")
+
+
+def respuesta_por_defecto(mensaje: str) -> Dict[str, Any]:
+    """JSON de NLU (intencion + entidades) deducido del mensaje con reglas simples."""
+    texto = mensaje.lower()
+    nombre = _NOMBRE_RE.search(mensaje)
+    identificacion = _IDENTIFICACION_RE.search(mensaje)
+    fecha = _FECHA_RE.search(mensaje)
+    hora = _HORA_RE.search(mensaje)
+    return {
+        "intent": "small_talk" if texto.strip() in ("hola", "buenas") else "agendar_cita",
+        "nombre": nombre.group(1).strip().title() if nombre else None,
+        "identificacion": identificacion.group(1) if identificacion else None,
+        "especialidad": next((e for e in _ESPECIALIDADES if e in texto), None),
+        "fecha": fecha.group(1) if fecha else None,
+        "hora": hora.group(1) if hora else None,
+        "medio": "virtual" if "virtual" in texto else ("presencial" if "presencial" in texto else None),
+    }
+
+
+class FakeOpenAIServer:
+    """Servidor HTTP local que imita /v1/chat/completions para benchmarks sin costo.
+
+    - Latencia por peticion segun `distribucion`: "fija" (latencia_ms), "uniforme"
+      (entre latencia_ms - jitter_ms y latencia_ms + jitter_ms) o "lognormal"
+      (mediana latencia_ms, dispersion sigma).
+    - `tasa_error`: probabilidad de responder 500 en vez de 200.
+    - `cuerpo_invalido`: responde 200 con un cuerpo que no es JSON.
+    - `respuestas`: mensaje de usuario exacto -> JSON a devolver; el resto usa
+      respuesta_por_defecto().
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latencia_ms: float = 0.0,
+        distribucion: str = "fija",
+        jitter_ms: float = 0.0,
+        sigma: float = 0.5,
+        tasa_error: float = 0.0,
+        cuerpo_invalido: bool = False,
+        respuestas: Optional[Dict[str, Dict[str, Any]]] = None,
+        seed: Optional[int] = None,
+    ):
+        if distribucion not in ("fija", "uniforme", "lognormal"):
+            raise ValueError("distribucion debe ser 'fija', 'uniforme' o 'lognormal'")
+        self.latencia_ms = latencia_ms
+        self.distribucion = distribucion
+        self.jitter_ms = jitter_ms
+        self.sigma = sigma
+        self.tasa_error = tasa_error
+        self.cuerpo_invalido = cuerpo_invalido
+        self.respuestas = respuestas or {}
+        self.peticiones = 0
+        self.errores = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._crear_handler())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1/chat/completions"
+
+    def start(self) -> "FakeOpenAIServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-openai", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _sortear(self) -> Tuple[float, bool]:
+        with self._lock:
+            self.peticiones += 1
+            if self.distribucion == "uniforme":
+                latencia = self._random.uniform(self.latencia_ms - self.jitter_ms, self.latencia_ms + self.jitter_ms)
+            elif self.distribucion == "lognormal" and self.latencia_ms > 0:
+                latencia = self._random.lognormvariate(0.0, self.sigma) * self.latencia_ms
+            else:
+                latencia = self.latencia_ms
+            fallar = self._random.random() < self.tasa_error
+            if fallar:
+                self.errores += 1
+        return max(0.0, latencia) / 1000, fallar
+
+    def _crear_handler(self) -> type:
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args: Any) -> None:
+                pass
+
+            def _enviar(self, status: int, cuerpo: bytes) -> None:
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(cuerpo)))
+                self.end_headers()
+                self.wfile.write(cuerpo)
+
+            def do_HEAD(self) -> None:  # warmup del LLMClient
+                self._enviar(405, b"")
+
+            def do_POST(self) -> None:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                espera, fallar = fake._sortear()
+                if espera:
+                    time.sleep(espera)
+                if fallar:
+                    self._enviar(500, b'{"error": {"message": "fake error"}}')
+                    return
+                if fake.cuerpo_invalido:
+                    self._enviar(200, b"<html>gateway</html>")
+                    return
+                mensaje = body.get("messages", [{}])[-1].get("content", "")
+                respuesta = fake.respuestas.get(mensaje) or respuesta_por_defecto(mensaje)
+                contenido = json.dumps(respuesta, ensure_ascii=False)
+                cuerpo = {
+                    "choices": [{"message": {"role": "assistant", "content": contenido}}],
+                    "usage": {
+                        "prompt_tokens": len(mensaje.split()) + 60,
+                        "completion_tokens": len(contenido.split()),
+                    },
+                }
+                self._enviar(200, json.dumps(cuerpo).encode("utf-8"))
+
+        return Handler
@@ -0,0 +1,329 @@
+﻿import argparse
+import asyncio
+import datetime
+import glob
+import json
+import os
+import random
+import tempfile
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import httpx
+
+from benchmarks.bench_api import RESULTADOS_DIR, commit_actual, configurar_entorno, percentil
+from benchmarks.fake_openai import FakeOpenAIServer
+from src.controllers.log_index import SUFIJOS_AUXILIARES
+
+ENTITY_FIELDS = ("nombre", "identificacion", "especialidad", "fecha", "hora", "medio")
+
+
+@dataclass
+class TurnoGrabado:
+    texto: str
+    paso: Optional[str]
+    intencion: Optional[str]
+    timestamp: Optional[datetime.datetime]
+    memoria: Dict[str, Optional[str]]
+
+
+@dataclass
+class ConversacionGrabada:
+    session_id: str
+    turnos: List[TurnoGrabado]
+
+    @property
+    def inicio(self) -> Optional[datetime.datetime]:
+        return self.turnos[0].timestamp if self.turnos else None
+
+
+@dataclass
+class ResultadoReplay:
+    latencias: List[float] = field(default_factory=list)
+    estados: Counter = field(default_factory=Counter)
+    turnos_comparados: int = 0
+    divergencias_paso: int = 0
+    divergencias_intencion: int = 0
+    transiciones_paso: Counter = field(default_factory=Counter)
+    conversaciones_divergentes: Set[str] = field(default_factory=set)
+    conversaciones_cortadas: int = 0
+
+
+def _parse_timestamp(valor: Any) -> Optional[datetime.datetime]:
+    # Los logs mas viejos no traen zona horaria: se asumen en UTC
+    try:
+        ts = datetime.datetime.fromisoformat(str(valor))
+    except ValueError:
+        return None
+    return ts if ts.tzinfo else ts.replace(tzinfo=datetime.timezone.utc)
+
+
+def cargar_conversaciones(paths: List[str]) -> List[ConversacionGrabada]:
+    """Agrupa los turnos por session_id y los ordena por turno/timestamp (orden de lectura si empatan).
+
+    Las lineas sin session_id o sin usuario_texto (formato anterior del log) se ignoran.
+    """
+    grupos: Dict[str, List[Tuple[float, datetime.datetime, int, TurnoGrabado]]] = {}
+    minimo = datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+    orden = 0
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    registro = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if not isinstance(registro, dict):
+                    continue
+                session_id, texto = registro.get("session_id"), registro.get("usuario_texto")
+                if not session_id or not isinstance(texto, str):
+                    continue
+                turno = TurnoGrabado(
+                    texto=texto,
+                    paso=registro.get("paso"),
+                    intencion=registro.get("intencion"),
+                    timestamp=_parse_timestamp(registro.get("timestamp")),
+                    memoria=registro.get("memoria") or {},
+                )
+                numero = registro.get("turno")
+                clave = float(numero) if isinstance(numero, (int, float)) else float("inf")
+                grupos.setdefault(session_id, []).append((clave, turno.timestamp or minimo, orden, turno))
+                orden += 1
+    conversaciones = [
+        ConversacionGrabada(session_id, [t for *_, t in sorted(turnos, key=lambda x: x[:3])])
+        for session_id, turnos in grupos.items()
+    ]
+    return sorted(conversaciones, key=lambda c: c.inicio or minimo)
+
+
+def respuestas_desde_logs(conversaciones: List[ConversacionGrabada]) -> Dict[str, Dict[str, Any]]:
+    """Respuestas de libreto para el LLM falso: lo que el LLM original extrajo de cada mensaje.
+
+    Las entidades se deducen de los slots que aparecen en la memoria despues del turno;
+    si el mismo texto aparece varias veces se usa la primera aparicion.
+    """
+    respuestas: Dict[str, Dict[str, Any]] = {}
+    for conversacion in conversaciones:
+        anterior: Dict[str, Optional[str]] = {}
+        for turno in conversacion.turnos:
+            nuevos = {
+                campo: turno.memoria.get(campo)
+                for campo in ENTITY_FIELDS
+                if turno.memoria.get(campo) and turno.memoria.get(campo) != anterior.get(campo)
+            }
+            respuesta: Dict[str, Any] = {"intent": turno.intencion or "desconocida"}
+            respuesta.update({campo: nuevos.get(campo) for campo in ENTITY_FIELDS})
+            respuestas.setdefault(turno.texto, respuesta)
+            anterior = turno.memoria
+    return respuestas
+
+
+def _pausa(anterior: TurnoGrabado, actual: TurnoGrabado, speedup: float, max_pausa: float) -> float:
+    """Think-time original entre dos turnos, escalado por speedup (0 = sin pausas)."""
+    if speedup <= 0 or anterior.timestamp is None or actual.timestamp is None:
+        return 0.0
+    return min(max_pausa, max(0.0, (actual.timestamp - anterior.timestamp).total_seconds() / speedup))
+
+
+async def reproducir_conversacion(
+    client: httpx.AsyncClient,
+    conversacion: ConversacionGrabada,
+    resultado: ResultadoReplay,
+    speedup: float,
+    max_pausa: float,
+) -> None:
+    session_id: Optional[str] = None
+    for i, turno in enumerate(conversacion.turnos):
+        if i:
+            espera = _pausa(conversacion.turnos[i - 1], turno, speedup, max_pausa)
+            if espera:
+                await asyncio.sleep(espera)
+        inicio = time.perf_counter()
+        response = await client.post("/api/v1/chat", json={"message": turno.texto, "session_id": session_id})
+        resultado.latencias.append((time.perf_counter() - inicio) * 1000)
+        resultado.estados[str(response.status_code)] += 1
+        if response.status_code != 200:
+            resultado.conversaciones_cortadas += 1
+            return
+        data = response.json()
+        session_id = data["session_id"]
+        resultado.turnos_comparados += 1
+        if data.get("paso") != turno.paso:
+            resultado.divergencias_paso += 1
+            resultado.transiciones_paso[(turno.paso, data.get("paso"))] += 1
+            resultado.conversaciones_divergentes.add(conversacion.session_id)
+        if data.get("intencion") != turno.intencion:
+            resultado.divergencias_intencion += 1
+            resultado.conversaciones_divergentes.add(conversacion.session_id)
+
+
+async def ejecutar_replay(
+    client: httpx.AsyncClient, conversaciones: List[ConversacionGrabada], args: argparse.Namespace
+) -> Tuple[ResultadoReplay, float]:
+    """Reproduce en lazo cerrado (concurrencia fija) o abierto (llegadas poisson u originales)."""
+    resultado = ResultadoReplay()
+    semaforo = asyncio.Semaphore(args.concurrencia)
+    rng = random.Random(args.seed)
+    primer_inicio = conversaciones[0].inicio if conversaciones else None
+
+    async def _cerrada(conversacion: ConversacionGrabada) -> None:
+        async with semaforo:
+            await reproducir_conversacion(client, conversacion, resultado, args.speedup, args.max_pausa)
+
+    async def _abierta(conversacion: ConversacionGrabada, retraso: float) -> None:
+        await asyncio.sleep(retraso)
+        await reproducir_conversacion(client, conversacion, resultado, args.speedup, args.max_pausa)
+
+    tareas = []
+    llegada = 0.0
+    for conversacion in conversaciones:
+        if args.llegadas == "cerrado":
+            tareas.append(_cerrada(conversacion))
+            continue
+        if args.llegadas == "poisson":
+            llegada += rng.expovariate(args.tasa)
+        elif conversacion.inicio is not None and primer_inicio is not None:
+            llegada = (conversacion.inicio - primer_inicio).total_seconds() / args.speedup
+        tareas.append(_abierta(conversacion, llegada))
+
+    inicio = time.perf_counter()
+    await asyncio.gather(*tareas)
+    return resultado, time.perf_counter() - inicio
+
+
+def resumen(resultado: ResultadoReplay, duracion: float, conversaciones: int, args: argparse.Namespace) -> Dict[str, Any]:
+    comparados = resultado.turnos_comparados
+    turnos = len(resultado.latencias)
+    return {
+        "version": commit_actual(),
+        "fecha": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "config": {
+            "logs": args.log,
+            "destino": args.url or "en proceso (LLM falso con respuestas del log)",
+            "llegadas": args.llegadas,
+            "concurrencia": args.concurrencia if args.llegadas == "cerrado" else None,
+            "tasa": args.tasa if args.llegadas == "poisson" else None,
+            "speedup": args.speedup,
+            "max_pausa": args.max_pausa,
+        },
+        "conversaciones": conversaciones,
+        "conversaciones_cortadas": resultado.conversaciones_cortadas,
+        "turnos": turnos,
+        "duracion_s": round(duracion, 3),
+        "turnos_por_s": round(turnos / duracion, 2) if duracion else None,
+        "latencia_ms": {
+            "p50": percentil(resultado.latencias, 50),
+            "p95": percentil(resultado.latencias, 95),
+            "p99": percentil(resultado.latencias, 99),
+        },
+        "respuestas_http": dict(resultado.estados),
+        "divergencia": {
+            "turnos_comparados": comparados,
+            "paso": resultado.divergencias_paso,
+            "pct_paso": round(resultado.divergencias_paso / comparados * 100, 2) if comparados else None,
+            "intencion": resultado.divergencias_intencion,
+            "pct_intencion": round(resultado.divergencias_intencion / comparados * 100, 2) if comparados else None,
+            "conversaciones": len(resultado.conversaciones_divergentes),
+            "transiciones_paso": [
+                {"grabado": grabado, "reproducido": reproducido, "turnos": n}
+                for (grabado, reproducido), n in resultado.transiciones_paso.most_common(10)
+            ],
+        },
+    }
+
+
+async def _replay_en_proceso(
+    conversaciones: List[ConversacionGrabada], args: argparse.Namespace
+) -> Tuple[ResultadoReplay, float]:
+    # Importacion tardia: la API lee su configuracion del entorno al importarse
+    from src.api.api import app
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://replay", timeout=None) as client:
+            return await ejecutar_replay(client, conversaciones, args)
+
+
+async def _replay_remoto(
+    conversaciones: List[ConversacionGrabada], args: argparse.Namespace
+) -> Tuple[ResultadoReplay, float]:
+    limites = httpx.Limits(max_connections=args.concurrencia if args.llegadas == "cerrado" else None)
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limites) as client:
+        return await ejecutar_replay(client, conversaciones, args)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Reproduce conversaciones de logs.jsonl contra la API.")
+    parser.add_argument("--log", nargs="+", default=["logs.jsonl"], help="archivos JSONL (acepta globs)")
+    parser.add_argument("--url", help="API ya levantada (p. ej. http://localhost:8000); por defecto en proceso")
+    parser.add_argument("--llegadas", choices=["cerrado", "poisson", "original"], default="cerrado")
+    parser.add_argument("--concurrencia", type=int, default=10, help="conversaciones simultaneas (lazo cerrado)")
+    parser.add_argument("--tasa", type=float, default=5.0, help="conversaciones nuevas por segundo (poisson)")
+    parser.add_argument("--speedup", type=float, default=0.0, help="acelera think-times y llegadas originales (0 = sin pausas)")
+    parser.add_argument("--max-pausa", type=float, default=30.0, help="tope en segundos de cada think-time ya escalado")
+    parser.add_argument("--limite", type=int, help="reproduce solo las primeras N conversaciones")
+    parser.add_argument("--latencia-ms", type=float, default=50.0, help="latencia del LLM falso (en proceso)")
+    parser.add_argument("--timeout", type=float, default=60.0, help="timeout HTTP en modo --url")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--salida", help="JSON de resultados (por defecto benchmarks/resultados/replay-<fecha>.json)")
+    args = parser.parse_args(argv)
+    if args.llegadas == "original" and args.speedup <= 0:
+        parser.error("--llegadas original necesita --speedup > 0")
+
+    # "logs.jsonl*" tambien trae el indice (.idx) y el lock del log: no son segmentos
+    paths = sorted(
+        {p for patron in args.log for p in (glob.glob(patron) or [patron]) if not p.endswith(SUFIJOS_AUXILIARES)}
+    )
+    conversaciones = cargar_conversaciones(paths)[: args.limite]
+    if not conversaciones:
+        print("No hay conversaciones con session_id en los logs indicados.")
+        return
+
+    if args.url:
+        resultado, duracion = asyncio.run(_replay_remoto(conversaciones, args))
+    else:
+        fake = FakeOpenAIServer(
+            latencia_ms=args.latencia_ms,
+            distribucion="lognormal",
+            respuestas=respuestas_desde_logs(conversaciones),
+            seed=args.seed,
+        ).start()
+        try:
+            with tempfile.TemporaryDirectory(prefix="replay-citas-") as directorio:
+                configurar_entorno(directorio, fake.url, max_sesiones=max(len(conversaciones) * 2, 10_000))
+                cwd = os.getcwd()
+                os.chdir(directorio)
+                try:
+                    resultado, duracion = asyncio.run(_replay_en_proceso(conversaciones, args))
+                finally:
+                    os.chdir(cwd)
+        finally:
+            fake.stop()
+
+    reporte = resumen(resultado, duracion, len(conversaciones), args)
+    salida = Path(args.salida) if args.salida else RESULTADOS_DIR / (
+        "replay-" + datetime.datetime.now().strftime("%Y%m%dT%H%M%S") + ".json"
+    )
+    salida.parent.mkdir(parents=True, exist_ok=True)
+    salida.write_text(json.dumps(reporte, indent=2, ensure_ascii=False), encoding="utf-8")
+
+    divergencia = reporte["divergencia"]
+    print(
+        f"{reporte['conversaciones']} conversaciones, {reporte['turnos']} turnos en {reporte['duracion_s']} s | "
+        f"p50 {reporte['latencia_ms']['p50']} ms, p95 {reporte['latencia_ms']['p95']} ms, "
+        f"p99 {reporte['latencia_ms']['p99']} ms"
+    )
+    print(
+        f"Divergencia: paso {divergencia['pct_paso']}%, intencion {divergencia['pct_intencion']}% "
+        f"({divergencia['conversaciones']} conversaciones afectadas)"
+    )
+    for transicion in divergencia["transiciones_paso"][:5]:
+        print(f"  {transicion['grabado']} -> {transicion['reproducido']}: {transicion['turnos']} turnos")
+    print(f"Resultados guardados en {salida}")
+
+
+if __name__ == "__main__":
+    main()
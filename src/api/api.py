@@ -1,11 +1,37 @@
-﻿from fastapi import FastAPI
+﻿import asyncio
+from contextlib import asynccontextmanager, suppress
+
+from fastapi import FastAPI
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 
-from src.api.routers import chat
+from src.api.db import detener_db, iniciar_db
+from src.api.routers import appointments, chat, sessions
+from src.controllers.logging_utils import detener_logger_buffered, iniciar_logger_desde_entorno
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Arranque/apagado de la API: BD, pool HTTP del LLM, logger de turnos y barrido de sesiones."""
+    await run_in_threadpool(iniciar_db)
+    iniciar_logger_desde_entorno()
+    await chat.warmup_llm_client()
+    sweeper = asyncio.create_task(chat.SESSION_STORE.run_sweeper(chat.SESSION_SWEEP_INTERVAL))
+    yield
+    sweeper.cancel()
+    with suppress(asyncio.CancelledError):
+        await sweeper
+    await chat.close_llm_client()
+    # Vacia los turnos y las citas pendientes antes de salir
+    detener_logger_buffered()
+    await run_in_threadpool(detener_db)
+    await run_in_threadpool(chat.SESSION_STORE.cerrar)
+
 
 app = FastAPI(
     title="Agente de Citas Medicas API",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
 )
 
 # CORS si usas frontend
@@ -19,3 +45,5 @@ app.add_middleware(
 
 # Aquí SÍ montamos el prefijo
 app.include_router(chat.router, prefix="/api/v1")
+app.include_router(sessions.router, prefix="/api/v1")
+app.include_router(appointments.router, prefix="/api/v1")
@@ -1,18 +1,95 @@
-﻿import sqlite3
+﻿import os
+import queue
+import sqlite3
+import threading
+from concurrent.futures import Future
 from pathlib import Path
-from typing import Optional
+from typing import Generator, List, Optional, Tuple, Union
 
-DB_PATH = Path(__file__).resolve().parent.parent / "data" / "appointments.db"
-DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+from src.controllers.agenda import AGENDA
+from src.controllers.metrics import cronometrado
+
+DB_PATH = Path(
+    os.environ.get(
+        "APPOINTMENTS_DB_PATH",
+        Path(__file__).resolve().parent.parent / "data" / "appointments.db",
+    )
+)
+
+# WAL: los lectores no bloquean al escritor. synchronous=NORMAL es seguro con WAL
+# (solo se puede perder la ultima transaccion ante un corte de energia).
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",
+)
+
+INSERT_APPOINTMENT_SQL = """
+    INSERT INTO appointments (nombre, identificacion, especialidad, fecha, hora, medio, session_id, bloque)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+APPOINTMENT_COLUMNS = "id, nombre, identificacion, especialidad, fecha, hora, medio, session_id, created_at"
+
+# Indices del listado de citas: cada uno termina en `fecha` (y SQLite agrega el rowid = id),
+# asi filtro + orden (fecha, id) salen del indice sin ordenar ni leer la tabla. Los de
+# identificacion y session_id reemplazan a los de una sola columna (siguen sirviendo para `=`).
+LIST_INDEXES = (
+    ("idx_appointments_fecha", "fecha"),
+    ("idx_appointments_especialidad_fecha", "especialidad, fecha"),
+    ("idx_appointments_identificacion_fecha", "identificacion, fecha"),
+    ("idx_appointments_session_id_fecha", "session_id, fecha"),
+)
+REPLACED_INDEXES = ("idx_appointments_session_id", "idx_appointments_identificacion")
+
+AppointmentRow = Tuple[
+    Optional[str], Optional[str], Optional[str], Optional[str], Optional[str], Optional[str], Optional[str]
+]
+
+
+class BloqueOcupadoError(Exception):
+    """El bloque de la agenda ya tiene una cita en la BD (otro worker lo confirmo primero)."""
+
+
+def _insertar(conn: sqlite3.Connection, row: AppointmentRow) -> int:
+    """Inserta la fila con su clave de bloque; el indice unico rechaza un bloque ya ocupado."""
+    _, _, especialidad, fecha, hora, _, _ = row
+    try:
+        return conn.execute(
+            INSERT_APPOINTMENT_SQL, (*row, AGENDA.clave_bloque(especialidad, fecha, hora))
+        ).lastrowid
+    except sqlite3.IntegrityError as e:
+        raise BloqueOcupadoError(f"{especialidad} {fecha} {hora}") from e
 
 
 def get_connection() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(DB_PATH, timeout=5.0)
     conn.row_factory = sqlite3.Row
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def get_read_connection() -> sqlite3.Connection:
+    """Conexion de solo lectura (consultas de la API de citas).
+
+    Con WAL los lectores no bloquean al escritor de citas ni esperan su COMMIT.
+    check_same_thread=False: un listado en streaming se consume desde varios
+    hilos del threadpool, pero nunca desde dos a la vez.
+    """
+    conn = sqlite3.connect(
+        f"{DB_PATH.resolve().as_uri()}?mode=ro", uri=True, timeout=5.0, check_same_thread=False
+    )
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA cache_size=-8000")
     return conn
 
 
 def init_db() -> None:
+    """Crea tablas e indices. Se llama explicitamente al arrancar la API."""
+    DB_PATH.parent.mkdir(parents=True, exist_ok=True)
     conn = get_connection()
     cur = conn.cursor()
     cur.execute(
@@ -26,10 +103,19 @@ def init_db() -> None:
             hora TEXT,
             medio TEXT,
             session_id TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            bloque TEXT
         )
         """
     )
+    if "bloque" not in {fila[1] for fila in cur.execute("PRAGMA table_info(appointments)")}:
+        cur.execute("ALTER TABLE appointments ADD COLUMN bloque TEXT")
+        _completar_bloques(cur)
+    # Un bloque de la agenda, una cita: es lo que decide entre workers (cada uno tiene su AGENDA)
+    cur.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_appointments_bloque ON appointments (bloque) "
+        "WHERE bloque IS NOT NULL"
+    )
     cur.execute(
         """
         CREATE TABLE IF NOT EXISTS patients (
@@ -40,10 +126,177 @@ def init_db() -> None:
         )
         """
     )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_appointments_slot ON appointments (especialidad, fecha, hora)"
+    )
+    for nombre in REPLACED_INDEXES:
+        cur.execute(f"DROP INDEX IF EXISTS {nombre}")
+    for nombre, columnas in LIST_INDEXES:
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {nombre} ON appointments ({columnas})")
     conn.commit()
     conn.close()
 
 
+def _completar_bloques(cur: sqlite3.Cursor) -> None:
+    """Migracion: clave de bloque de las citas previas a la columna.
+
+    Si un bloque ya tenia varias citas solo la primera se queda con la clave (las
+    demas no se borran, pero no cuentan para el indice unico).
+    """
+    vistos = set()
+    filas = cur.execute("SELECT id, especialidad, fecha, hora FROM appointments ORDER BY id").fetchall()
+    for appointment_id, especialidad, fecha, hora in filas:
+        bloque = AGENDA.clave_bloque(especialidad, fecha, hora)
+        if bloque is None or bloque in vistos:
+            continue
+        vistos.add(bloque)
+        cur.execute("UPDATE appointments SET bloque = ? WHERE id = ?", (bloque, appointment_id))
+
+
+class AppointmentWriter:
+    """Escritor dedicado de citas: una sola conexion y un hilo con group commit.
+
+    Los inserts que llegan mientras se confirma una transaccion se acumulan en la
+    cola y se confirman juntos en la siguiente (un solo COMMIT/fsync por lote).
+    Cada item del lote va en su propio savepoint: si su bloque ya esta ocupado
+    solo ese item falla (BloqueOcupadoError) y el resto del lote se confirma.
+    """
+
+    def __init__(self, max_batch: int = 256):
+        self.max_batch = max_batch
+        self.commits = 0
+        self.inserts = 0
+        self._queue: "queue.Queue[Optional[Tuple[AppointmentRow, Future]]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="appointment-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = 10.0) -> None:
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def submit(self, row: AppointmentRow) -> "Future[int]":
+        """Encola un insert; el Future se resuelve con el id de la cita tras el COMMIT."""
+        future: "Future[int]" = Future()
+        self._queue.put((row, future))
+        return future
+
+    def _run(self) -> None:
+        conn = get_connection()
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    return
+                lote = [item]
+                detener = False
+                while len(lote) < self.max_batch:
+                    try:
+                        siguiente = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if siguiente is None:
+                        detener = True
+                        break
+                    lote.append(siguiente)
+                self._escribir_lote(conn, lote)
+                if detener:
+                    return
+        finally:
+            conn.close()
+            # Inserts encolados despues del cierre: se fallan en vez de dejarlos colgados
+            while True:
+                try:
+                    pendiente = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if pendiente is not None:
+                    pendiente[1].set_exception(RuntimeError("El escritor de citas esta detenido."))
+
+    def _escribir_lote(
+        self, conn: sqlite3.Connection, lote: List[Tuple[AppointmentRow, Future]]
+    ) -> None:
+        resultados: List[Union[int, BloqueOcupadoError]] = []
+        try:
+            with conn:  # una transaccion para todo el lote
+                conn.execute("BEGIN")
+                for row, _ in lote:
+                    conn.execute("SAVEPOINT item")
+                    try:
+                        resultados.append(_insertar(conn, row))
+                    except BloqueOcupadoError as e:
+                        conn.execute("ROLLBACK TO item")
+                        resultados.append(e)
+                    conn.execute("RELEASE item")
+        except sqlite3.Error as e:
+            for _, future in lote:
+                future.set_exception(e)
+            return
+        self.commits += 1
+        for (_, future), resultado in zip(lote, resultados):
+            if isinstance(resultado, BloqueOcupadoError):
+                future.set_exception(resultado)
+            else:
+                self.inserts += 1
+                future.set_result(resultado)
+
+
+_WRITER: Optional[AppointmentWriter] = None
+_SCHEMA_LOCK = threading.Lock()
+_SCHEMA_READY = False
+
+
+def iniciar_db() -> None:
+    """Arranque de la BD para la API: esquema, indice de disponibilidad y escritor dedicado."""
+    global _WRITER, _SCHEMA_READY
+    with _SCHEMA_LOCK:
+        init_db()
+        _SCHEMA_READY = True
+    AGENDA.reconstruir(cargar_citas_ocupadas())
+    if _WRITER is None:
+        _WRITER = AppointmentWriter()
+        _WRITER.start()
+
+
+def detener_db() -> None:
+    """Confirma los inserts pendientes y detiene el escritor."""
+    global _WRITER
+    writer, _WRITER = _WRITER, None
+    if writer is not None:
+        writer.stop()
+
+
+def _asegurar_esquema() -> None:
+    # Para usos fuera de la API (scripts) que no llamaron a iniciar_db()
+    global _SCHEMA_READY
+    if _SCHEMA_READY:
+        return
+    with _SCHEMA_LOCK:
+        if not _SCHEMA_READY:
+            init_db()
+            _SCHEMA_READY = True
+
+
+def cargar_citas_ocupadas() -> List[Tuple[Optional[str], Optional[str], Optional[str]]]:
+    """(especialidad, fecha, hora) de todas las citas; lo resuelve el indice idx_appointments_slot."""
+    conn = get_connection()
+    try:
+        return [
+            tuple(row)
+            for row in conn.execute("SELECT especialidad, fecha, hora FROM appointments")
+        ]
+    finally:
+        conn.close()
+
+
+@cronometrado("registrar_cita")
 def registrar_cita(
     nombre: Optional[str],
     identificacion: Optional[str],
@@ -52,19 +305,105 @@ def registrar_cita(
     hora: Optional[str],
     medio: Optional[str],
     session_id: Optional[str] = None,
-) -> None:
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO appointments (nombre, identificacion, especialidad, fecha, hora, medio, session_id)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-        """,
-        (nombre, identificacion, especialidad, fecha, hora, medio, session_id),
+) -> int:
+    """Inserta una cita y devuelve su id.
+
+    Con el escritor activo (API) el insert se agrupa con los concurrentes en una
+    sola transaccion; la llamada espera hasta que su lote queda confirmado.
+    Tras el insert se marca el bloque como ocupado en la AGENDA. Si el bloque ya
+    tenia una cita en la BD lanza BloqueOcupadoError (y lo marca ocupado: la
+    AGENDA de este worker no lo sabia).
+    """
+    row: AppointmentRow = (nombre, identificacion, especialidad, fecha, hora, medio, session_id)
+    writer = _WRITER
+    try:
+        if writer is not None:
+            appointment_id = writer.submit(row).result()
+        else:
+            _asegurar_esquema()
+            conn = get_connection()
+            try:
+                with conn:
+                    appointment_id = _insertar(conn, row)
+            finally:
+                conn.close()
+    except BloqueOcupadoError:
+        AGENDA.ocupar(especialidad, fecha, hora)
+        raise
+    AGENDA.ocupar(especialidad, fecha, hora)
+    return appointment_id
+
+
+def listar_citas(
+    identificacion: Optional[str] = None,
+    especialidad: Optional[str] = None,
+    session_id: Optional[str] = None,
+    desde: Optional[str] = None,
+    hasta: Optional[str] = None,
+    despues_de: Optional[Tuple[Optional[str], int]] = None,
+    limite: int = 100,
+) -> Generator[sqlite3.Row, None, None]:
+    """Citas que cumplen los filtros, ordenadas por (fecha, id), a partir del cursor `despues_de`.
+
+    Paginacion por keyset: `despues_de` es (fecha, id) de la ultima cita de la
+    pagina anterior, asi cada pagina cuesta lo mismo sin importar cuantas haya
+    antes (OFFSET recorreria todas las saltadas). La subconsulta elige los ids
+    de la pagina solo con un indice de LIST_INDEXES; la tabla se lee para esas
+    `limite` filas. Es un generador: las filas se van leyendo a medida que se
+    consumen y la conexion se cierra al terminar.
+    """
+    condiciones: List[str] = []
+    params: List[object] = []
+    for columna, valor in (
+        ("identificacion", identificacion),
+        ("especialidad", especialidad),
+        ("session_id", session_id),
+    ):
+        if valor is not None:
+            condiciones.append(f"{columna} = ?")
+            params.append(valor)
+    if desde is not None:
+        condiciones.append("fecha >= ?")
+        params.append(desde)
+    if hasta is not None:
+        condiciones.append("fecha <= ?")
+        params.append(hasta)
+    if despues_de is not None:
+        fecha, appointment_id = despues_de
+        if fecha is None:
+            # Las citas sin fecha van primero (NULL ordena antes que cualquier texto)
+            condiciones.append("(fecha IS NULL AND id > ? OR fecha IS NOT NULL)")
+            params.append(appointment_id)
+        else:
+            condiciones.append("(fecha, id) > (?, ?)")
+            params.extend((fecha, appointment_id))
+    where = f"WHERE {' AND '.join(condiciones)}" if condiciones else ""
+    sql = (
+        f"SELECT {APPOINTMENT_COLUMNS} FROM appointments WHERE id IN ("
+        f"SELECT id FROM appointments {where} ORDER BY fecha, id LIMIT ?"
+        ") ORDER BY fecha, id"
     )
-    conn.commit()
-    conn.close()
+    params.append(limite)
+
+    _asegurar_esquema()
+    conn = get_read_connection()
+    try:
+        cursor = conn.execute(sql, params)
+        while True:
+            filas = cursor.fetchmany(100)
+            if not filas:
+                return
+            yield from filas
+    finally:
+        conn.close()
 
 
-# Inicializa la base al importar
-init_db()
+def obtener_cita(appointment_id: int) -> Optional[sqlite3.Row]:
+    _asegurar_esquema()
+    conn = get_read_connection()
+    try:
+        return conn.execute(
+            f"SELECT {APPOINTMENT_COLUMNS} FROM appointments WHERE id = ?", (appointment_id,)
+        ).fetchone()
+    finally:
+        conn.close()
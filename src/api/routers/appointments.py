@@ -0,0 +1,98 @@
+﻿# src/api/routers/appointments.py
+
+from __future__ import annotations
+
+import base64
+import datetime
+import json
+import os
+import sqlite3
+from typing import Generator, Iterator, Optional, Tuple
+
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import StreamingResponse
+
+from src.api.db import listar_citas, obtener_cita
+from src.api.schemas import AppointmentPage, AppointmentRecord
+from src.controllers.especialidades import canonizar_especialidad
+
+router = APIRouter(tags=["appointments"])
+
+APPOINTMENTS_PAGE_SIZE = int(os.environ.get("APPOINTMENTS_PAGE_SIZE", 100))
+APPOINTMENTS_PAGE_MAX = int(os.environ.get("APPOINTMENTS_PAGE_MAX", 1000))
+
+
+def _codificar_cursor(fila: sqlite3.Row) -> str:
+    """Cursor opaco con (fecha, id) de la ultima cita de la pagina."""
+    return base64.urlsafe_b64encode(json.dumps([fila["fecha"], fila["id"]]).encode("utf-8")).decode("ascii")
+
+
+def _decodificar_cursor(cursor: str) -> Tuple[Optional[str], int]:
+    try:
+        fecha, appointment_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        if (fecha is None or isinstance(fecha, str)) and isinstance(appointment_id, int):
+            return fecha, appointment_id
+    except (ValueError, TypeError, UnicodeError):
+        pass
+    raise HTTPException(status_code=400, detail="cursor inválido.")
+
+
+def _pagina_json(filas: Generator[sqlite3.Row, None, None], limite: int) -> Iterator[str]:
+    """Serializa la pagina a medida que llegan las filas: {"items": [...], "next_cursor": ...}."""
+    yield '{"items":['
+    ultima: Optional[sqlite3.Row] = None
+    enviadas = 0
+    hay_mas = False
+    try:
+        for fila in filas:
+            if enviadas == limite:
+                hay_mas = True  # se pidio una fila de mas solo para saber si sigue otra pagina
+                break
+            yield ("," if enviadas else "") + AppointmentRecord(**dict(fila)).model_dump_json()
+            ultima = fila
+            enviadas += 1
+    finally:
+        filas.close()  # cierra la conexion aunque el cliente corte la descarga
+    siguiente = _codificar_cursor(ultima) if hay_mas and ultima is not None else None
+    yield '],"next_cursor":' + json.dumps(siguiente) + "}"
+
+
+@router.get("/appointments", response_model=AppointmentPage)
+def list_appointments(
+    identificacion: Optional[str] = None,
+    especialidad: Optional[str] = None,
+    session_id: Optional[str] = None,
+    desde: Optional[datetime.date] = Query(None, description="fecha de la cita >= desde"),
+    hasta: Optional[datetime.date] = Query(None, description="fecha de la cita <= hasta"),
+    limit: int = Query(APPOINTMENTS_PAGE_SIZE, ge=1, le=APPOINTMENTS_PAGE_MAX),
+    cursor: Optional[str] = Query(None, description="next_cursor de la pagina anterior"),
+) -> StreamingResponse:
+    """
+    Citas registradas, filtradas y ordenadas por (fecha, id), en páginas por keyset:
+    para seguir se pasa el `next_cursor` de la respuesta como `cursor`. Cada página
+    cuesta lo mismo aunque haya miles antes, y se lee con una conexión de solo
+    lectura (no frena al escritor de citas del chat). La respuesta se escribe en
+    streaming a medida que se leen las filas.
+    - `especialidad` acepta alias del catálogo ("cardio" -> Cardiología).
+    """
+    despues_de = _decodificar_cursor(cursor) if cursor else None
+    if especialidad is not None:
+        especialidad = canonizar_especialidad(especialidad) or especialidad
+    filas = listar_citas(
+        identificacion=identificacion,
+        especialidad=especialidad,
+        session_id=session_id,
+        desde=desde.isoformat() if desde else None,
+        hasta=hasta.isoformat() if hasta else None,
+        despues_de=despues_de,
+        limite=limit + 1,
+    )
+    return StreamingResponse(_pagina_json(filas, limit), media_type="application/json")
+
+
+@router.get("/appointments/{appointment_id}", response_model=AppointmentRecord)
+def get_appointment(appointment_id: int) -> AppointmentRecord:
+    fila = obtener_cita(appointment_id)
+    if fila is None:
+        raise HTTPException(status_code=404, detail="Cita no encontrada.")
+    return AppointmentRecord(**dict(fila))
@@ -2,43 +2,191 @@
 
 from __future__ import annotations
 
-from typing import Dict, Optional
+import asyncio
+import os
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar, Union
 
 from fastapi import APIRouter, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse
 
-from src.controllers.dialog_manager import agente_citas
-from src.controllers.llm_client import LLMClient, OPENAI_API_URL, OPENAI_MODEL
-from src.controllers.logging_utils import log_turno
+from src.controllers.agenda import AGENDA
+from src.controllers.dialog_manager import agente_citas_async, next_bot_action
+from src.controllers.especialidades import get_catalogo
+from src.controllers.llm_client import (
+    DEFAULT_BREAKER_COOLDOWN,
+    DEFAULT_BREAKER_THRESHOLD,
+    DEFAULT_CONNECT_TIMEOUT,
+    DEFAULT_MAX_RETRIES,
+    DEFAULT_POOL_SIZE,
+    DEFAULT_READ_TIMEOUT,
+    DEFAULT_RETRY_BACKOFF,
+    DEFAULT_TURN_BUDGET,
+    CircuitBreaker,
+    LLMClient,
+    OPENAI_API_URL,
+    OPENAI_MODEL,
+)
+from src.controllers.logging_utils import escribir_registros, registro_turno
+from src.controllers.metrics import METRIC_PREFIX, REGISTRY, get_duraciones
+from src.controllers.nlu_cache import NLU_CACHE
 from src.models.domain import ConversationState, FlowStep
-from src.api.db import registrar_cita
-from src.api.schemas import ChatRequest, ChatResponse
+from src.api.db import BloqueOcupadoError, registrar_cita
+from src.api.session_store import (
+    DEFAULT_IDLE_TTL,
+    DEFAULT_LOCK_TIMEOUT,
+    DEFAULT_MAX_SESSIONS,
+    DEFAULT_SWEEP_INTERVAL,
+    SesionOcupadaError,
+    SessionLocks,
+    SessionStore,
+)
+from src.api.session_backends import (
+    DEFAULT_CACHE_SIZE,
+    DEFAULT_CACHE_TTL,
+    SharedSessionStore,
+    crear_backend,
+)
+from src.api.schemas import (
+    ChatBatchItem,
+    ChatBatchRequest,
+    ChatBatchResponse,
+    ChatRequest,
+    ChatResponse,
+)
 
 router = APIRouter(tags=["default"])
 
-# Almacena estados de conversación en memoria: session_id -> ConversationState
-SESSION_STORE: Dict[str, ConversationState] = {}
+T = TypeVar("T")
+
+
+def _crear_session_store() -> Union[SessionStore, SharedSessionStore]:
+    """SESSION_BACKEND=memory (por defecto, un solo worker) o sqlite/redis (compartido entre workers)."""
+    backend = os.environ.get("SESSION_BACKEND", "memory").strip().lower()
+    idle_ttl = float(os.environ.get("SESSION_IDLE_TTL", DEFAULT_IDLE_TTL))
+    if backend == "memory":
+        return SessionStore(
+            max_size=int(os.environ.get("SESSION_MAX", DEFAULT_MAX_SESSIONS)),
+            idle_ttl=idle_ttl,
+        )
+    return SharedSessionStore(
+        crear_backend(backend),
+        idle_ttl=idle_ttl,
+        cache_size=int(os.environ.get("SESSION_CACHE_SIZE", DEFAULT_CACHE_SIZE)),
+        cache_ttl=float(os.environ.get("SESSION_CACHE_TTL", DEFAULT_CACHE_TTL)),
+    )
+
+
+# Almacena estados de conversación: session_id -> ConversationState
+# (en memoria: LRU acotado + expiracion por inactividad, barrido en segundo plano;
+# compartido: SQLite/Redis con version por sesion y cache local)
+SESSION_STORE = _crear_session_store()
+SESSION_SWEEP_INTERVAL = float(os.environ.get("SESSION_SWEEP_INTERVAL", DEFAULT_SWEEP_INTERVAL))
+
+# Serializa los turnos de una misma sesion (reintentos / doble envio del cliente)
+SESSION_LOCKS = SessionLocks()
+SESSION_LOCK_TIMEOUT = float(os.environ.get("SESSION_LOCK_TIMEOUT", DEFAULT_LOCK_TIMEOUT))
+
+# Lote de /chat/batch: maximo de mensajes y de turnos procesandose a la vez
+CHAT_BATCH_MAX_ITEMS = int(os.environ.get("CHAT_BATCH_MAX_ITEMS", 100))
+CHAT_BATCH_FANOUT = int(os.environ.get("CHAT_BATCH_FANOUT", os.environ.get("LLM_POOL_SIZE", DEFAULT_POOL_SIZE)))
 
 # Cliente LLM singleton (se crea una sola vez)
 _LLM_CLIENT: Optional[LLMClient] = None
+_LLM_CLIENT_LOCK = threading.Lock()
 
 
 def get_llm_client() -> LLMClient:
-    """Devuelve un cliente LLM único para toda la API."""
+    """Devuelve un cliente LLM único para toda la API (comparte el pool de conexiones)."""
     global _LLM_CLIENT
     if _LLM_CLIENT is None:
-        import os
-
-        api_key = os.environ.get("OPENAI_API_KEY")
-        if not api_key:
-            raise RuntimeError("OPENAI_API_KEY no está configurada en el entorno.")
-        _LLM_CLIENT = LLMClient(api_key=api_key, model=OPENAI_MODEL, api_url=OPENAI_API_URL)
+        with _LLM_CLIENT_LOCK:
+            if _LLM_CLIENT is None:
+                api_key = os.environ.get("OPENAI_API_KEY")
+                if not api_key:
+                    raise RuntimeError("OPENAI_API_KEY no está configurada en el entorno.")
+                _LLM_CLIENT = LLMClient(
+                    api_key=api_key,
+                    model=OPENAI_MODEL,
+                    api_url=os.environ.get("OPENAI_API_URL", OPENAI_API_URL),
+                    pool_size=int(os.environ.get("LLM_POOL_SIZE", DEFAULT_POOL_SIZE)),
+                    connect_timeout=float(
+                        os.environ.get("LLM_CONNECT_TIMEOUT", DEFAULT_CONNECT_TIMEOUT)
+                    ),
+                    read_timeout=float(os.environ.get("LLM_READ_TIMEOUT", DEFAULT_READ_TIMEOUT)),
+                    turn_budget=float(os.environ.get("LLM_TURN_BUDGET", DEFAULT_TURN_BUDGET)),
+                    max_retries=int(os.environ.get("LLM_MAX_RETRIES", DEFAULT_MAX_RETRIES)),
+                    retry_backoff=float(os.environ.get("LLM_RETRY_BACKOFF", DEFAULT_RETRY_BACKOFF)),
+                    breaker=CircuitBreaker(
+                        umbral=int(os.environ.get("LLM_BREAKER_THRESHOLD", DEFAULT_BREAKER_THRESHOLD)),
+                        enfriamiento=float(
+                            os.environ.get("LLM_BREAKER_COOLDOWN", DEFAULT_BREAKER_COOLDOWN)
+                        ),
+                    ),
+                )
     return _LLM_CLIENT
 
 
+async def warmup_llm_client() -> int:
+    """Precalienta el pool (async) del cliente LLM (se llama al arrancar la API).
+
+    Si no hay OPENAI_API_KEY no falla: la API arranca igual y /chat reportara el error.
+    """
+    try:
+        llm_client = get_llm_client()
+    except RuntimeError:
+        return 0
+    return await llm_client.awarmup(int(os.environ.get("LLM_WARMUP_CONNECTIONS", 1)))
+
+
+async def close_llm_client() -> None:
+    """Cierra los pools del cliente LLM (se llama al apagar la API)."""
+    global _LLM_CLIENT
+    llm_client, _LLM_CLIENT = _LLM_CLIENT, None
+    if llm_client is not None:
+        await llm_client.aclose()
+
+
 @router.get("/health")
 def health() -> dict:
-    """Ping sencillo para saber si la API está viva."""
-    return {"status": "ok"}
+    """Ping sencillo para saber si la API está viva (gauges de sesiones, cache NLU y cliente LLM)."""
+    return {
+        "status": "ok",
+        "sessions": SESSION_STORE.stats(),
+        "nlu_cache": NLU_CACHE.stats(),
+        "llm": _LLM_CLIENT.stats() if _LLM_CLIENT is not None else None,
+        "especialidades": get_catalogo().stats(),
+    }
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+def metrics() -> PlainTextResponse:
+    """Metricas en formato de texto de Prometheus: latencia por etapa, llamadas, reintentos y
+    tokens del LLM, estado del circuit breaker y los gauges de sesiones y cache NLU de /health.
+    """
+    gauges = {
+        f"{METRIC_PREFIX}_session_store_{nombre}": valor for nombre, valor in SESSION_STORE.stats().items()
+    }
+    gauges.update(
+        {f"{METRIC_PREFIX}_nlu_cache_{nombre}": valor for nombre, valor in NLU_CACHE.stats().items()}
+    )
+    if _LLM_CLIENT is not None:
+        llm_stats = _LLM_CLIENT.stats()
+        breaker = llm_stats.pop("breaker")
+        # 0 = cerrado, 1 = semiabierto, 2 = abierto
+        gauges[f"{METRIC_PREFIX}_llm_breaker_state"] = {
+            CircuitBreaker.CERRADO: 0,
+            CircuitBreaker.SEMIABIERTO: 1,
+            CircuitBreaker.ABIERTO: 2,
+        }[breaker["estado"]]
+        gauges[f"{METRIC_PREFIX}_llm_breaker_openings"] = breaker["aperturas"]
+        # Los reintentos ya se exponen como contador (llm_retries_total)
+        gauges[f"{METRIC_PREFIX}_llm_short_circuits"] = llm_stats["short_circuits"]
+        gauges[f"{METRIC_PREFIX}_llm_budget_exhausted"] = llm_stats["budget_exhausted"]
+    return PlainTextResponse(
+        REGISTRY.render(gauges), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
 
 
 @router.post("/reset")
@@ -47,73 +195,220 @@ def reset_session(session_id: Optional[str] = None) -> dict:
     Resetea una sesión específica o todas si no se envía session_id.
     Útil para pruebas.
     """
-    global SESSION_STORE
     if session_id:
-        SESSION_STORE.pop(session_id, None)
+        SESSION_STORE.pop(session_id)
     else:
-        SESSION_STORE = {}
+        SESSION_STORE.clear()
     return {"status": "reset", "session_id": session_id}
 
 
 @router.post("/chat", response_model=ChatResponse)
-def chat_endpoint(payload: ChatRequest) -> ChatResponse:
+async def chat_endpoint(payload: ChatRequest) -> ChatResponse:
     """
-    Endpoint principal de chat.
+    Endpoint principal de chat (asincrono: no ocupa un hilo mientras espera al LLM).
     - Recibe session_id (opcional) y message.
     - Mantiene el estado de la conversación en SESSION_STORE.
-    - Llama al dialog_manager (agente_citas).
-    - Registra logs.
-    - Si el flujo se completa, guarda la cita en SQLite.
+    - Llama al dialog_manager (agente_citas_async).
+    - Si el flujo se completa, guarda la cita en SQLite (en el threadpool) antes de
+      reiniciar la sesión; si el insert falla la sesión queda como estaba.
+    - Registra logs (también en el threadpool, fuera del event loop).
+    - Los turnos de una misma sesión se serializan; si otro turno sigue en curso
+      pasado SESSION_LOCK_TIMEOUT se responde 409.
     """
     try:
-        # 1. Recuperar o crear estado de conversación
-        if payload.session_id and payload.session_id in SESSION_STORE:
-            state = SESSION_STORE[payload.session_id]
-        else:
-            state = ConversationState()
-            SESSION_STORE[state.session_id] = state
-
-        llm_client = get_llm_client()
-
-        # 2. Ejecutar turno del agente
-        respuesta_bot = agente_citas(payload.message, state, llm_client)
-
-        # 3. Log de turno
-        log_turno(
-            usuario_texto=payload.message,
-            bot_texto=respuesta_bot,
-            state=state,
+        async with SESSION_LOCKS.hold(payload.session_id, SESSION_LOCK_TIMEOUT):
+            return await _procesar_chat(payload)
+    except SesionOcupadaError:
+        raise HTTPException(
+            status_code=409,
+            detail="Ya hay un turno en curso para esta sesión. Reintenta en unos segundos.",
         )
-
-        # 4. ¿El flujo llegó a COMPLETADO?
-        completed = state.step == FlowStep.COMPLETADO
-
-        if completed:
-            # Registrar cita en la BD
-            registrar_cita(
-                session_id=state.session_id,
-                nombre=state.memory.nombre or "",
-                identificacion=state.memory.identificacion or "",
-                especialidad=state.memory.especialidad or "",
-                fecha=state.memory.fecha or "",
-                hora=state.memory.hora,
-                medio=state.memory.medio,
-            )
-            # IMPORTANTE: NO resetear state.session_id, solo vaciar memoria de slots
-            state.reset()
-
-        # 5. Construir respuesta que cumpla exactamente con ChatResponse
-        memory_dict = state.memory.to_dict()
-        return ChatResponse(
-            session_id=state.session_id,
-            reply=respuesta_bot,
-            completed=completed,
-            memory=memory_dict,
-        )
-
     except RuntimeError as e:
         # Errores de configuración (por ejemplo OPENAI_API_KEY)
         raise HTTPException(status_code=500, detail=str(e))
     except Exception as e:
         # Cualquier otro error inesperado
         raise HTTPException(status_code=500, detail=f"Error interno del servidor: {e}")
+
+
+async def _procesar_chat(payload: ChatRequest) -> ChatResponse:
+    """Ejecuta un turno completo; el llamador ya tiene el lock de la sesión."""
+    respuesta, registro = await _ejecutar_turno(payload)
+
+    # Log de turno (en el threadpool)
+    await run_in_threadpool(escribir_registros, [registro])
+    return respuesta
+
+
+async def _en_store(funcion: Callable[..., T], *args: Any) -> T:
+    """Operacion del SESSION_STORE; si es compartido hace I/O y va al threadpool."""
+    if SESSION_STORE.compartido:
+        return await run_in_threadpool(funcion, *args)
+    return funcion(*args)
+
+
+async def _registrar_cita_completada(state: ConversationState) -> bool:
+    """Inserta la cita del turno que completó el flujo, antes de reiniciar la sesión.
+
+    Primero retira la sesión del almacén (con uno compartido, condicionado a la
+    versión leída: de dos workers que completan el mismo turno solo sigue uno).
+    Devuelve False si el bloque ya tenía una cita en la BD (lo confirmó otro
+    worker): la sesión sigue y el llamador ofrece otra hora. Si algo más falla
+    el bloque reservado en la AGENDA se libera y, si la sesión ya se había
+    retirado, se vuelve a publicar en CONFIRMAR para que el usuario pueda
+    reintentar la confirmación.
+    """
+    memoria = state.memory
+    retirada = False
+    try:
+        await _en_store(SESSION_STORE.retirar, state)
+        retirada = True
+        await run_in_threadpool(
+            registrar_cita,
+            memoria.nombre or "",
+            memoria.identificacion or "",
+            memoria.especialidad or "",
+            memoria.fecha or "",
+            memoria.hora,
+            memoria.medio,
+            state.session_id,
+        )
+    except BloqueOcupadoError:
+        return False
+    except BaseException:
+        AGENDA.liberar(memoria.especialidad, memoria.fecha, memoria.hora)
+        if retirada:
+            state.step = FlowStep.CONFIRMAR
+            await _en_store(SESSION_STORE.put, state)
+        raise
+    return True
+
+
+async def _ejecutar_turno(payload: ChatRequest) -> Tuple[ChatResponse, Dict[str, Any]]:
+    """Turno del agente: devuelve la respuesta y el registro de log (si se completó, con la cita ya guardada).
+
+    El log queda a cargo del llamador para que /chat/batch pueda escribir los
+    de todo el lote juntos.
+    """
+    # 1. Recuperar o crear estado de conversación
+    state = await _en_store(SESSION_STORE.get, payload.session_id) if payload.session_id else None
+    if state is None:
+        state = ConversationState()
+
+    llm_client = get_llm_client()
+
+    # 2. Ejecutar turno del agente
+    respuesta_bot = await agente_citas_async(payload.message, state, llm_client)
+
+    # 3. Si el flujo llegó a COMPLETADO la cita se guarda antes del reset: si el
+    # insert falla la conversacion no se pierde. Con un almacen compartido la
+    # sesion se retira condicionada a la version leida: si otro worker ya
+    # completo este turno lanza ConflictoVersionError (409)
+    if state.step == FlowStep.COMPLETADO and not await _registrar_cita_completada(state):
+        # El bloque lo tomo otro worker (ya figura ocupado en la AGENDA): se pide otra hora
+        respuesta_bot = next_bot_action(state)
+
+    # 4. Registro del turno (se arma ahora: el estado cambia en el reset). Las
+    # duraciones se vuelven a leer para incluir registrar_cita (el threadpool copia el
+    # contexto pero comparte el dict del turno); log_turno se mide despues de armar la
+    # linea y queda solo en el histograma
+    state.duraciones_ms = get_duraciones()
+    registro = registro_turno(payload.message, respuesta_bot, state)
+
+    # 5. ¿El flujo llegó a COMPLETADO? (paso/intencion se toman antes del reset)
+    completed = state.step == FlowStep.COMPLETADO
+    paso = state.step.name
+    intencion = state.intent.value if state.intent else None
+
+    if completed:
+        # reset() genera un session_id nuevo: se re-indexa la sesion para que el id
+        # devuelto siga siendo valido y la entrada vieja no quede ocupando memoria
+        state.reset()
+    # Se publica al final del turno: con un almacen compartido, si otro worker
+    # guardo la sesion mientras tanto, lanza ConflictoVersionError (409)
+    await _en_store(SESSION_STORE.put, state)
+
+    # 6. Construir respuesta que cumpla exactamente con ChatResponse
+    memory_dict = state.memory.to_dict()
+    respuesta = ChatResponse(
+        session_id=state.session_id,
+        reply=respuesta_bot,
+        completed=completed,
+        memory=memory_dict,
+        paso=paso,
+        intencion=intencion,
+    )
+    return respuesta, registro
+
+
+def _item_error(e: Exception) -> ChatBatchItem:
+    """Mismo codigo y detalle que daria /chat para la excepcion."""
+    if isinstance(e, SesionOcupadaError):
+        return ChatBatchItem(
+            status_code=409,
+            error="Ya hay un turno en curso para esta sesión. Reintenta en unos segundos.",
+        )
+    if isinstance(e, RuntimeError):
+        return ChatBatchItem(status_code=500, error=str(e))
+    return ChatBatchItem(status_code=500, error=f"Error interno del servidor: {e}")
+
+
+@router.post("/chat/batch", response_model=ChatBatchResponse)
+async def chat_batch_endpoint(payload: ChatBatchRequest) -> ChatBatchResponse:
+    """
+    Procesa un lote de mensajes de varias sesiones (para agregadores de canales).
+    - Sesiones distintas se procesan en paralelo, con a lo sumo CHAT_BATCH_FANOUT
+      turnos a la vez (acota la concurrencia sobre el cliente LLM).
+    - Los mensajes de una misma sesión se procesan en el orden del lote; si uno
+      falla, los siguientes de esa sesión no se procesan (424).
+    - Cada cita completada se inserta con el lock de su sesión tomado; el escritor
+      de citas agrupa las concurrentes en una transacción, pero una que falla no
+      arrastra a las de otras sesiones. Los logs del lote se escriben juntos.
+    - Devuelve un resultado por mensaje, en el mismo orden, con su error si lo hubo.
+    """
+    mensajes = payload.messages
+    if len(mensajes) > CHAT_BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"El lote admite como máximo {CHAT_BATCH_MAX_ITEMS} mensajes.",
+        )
+
+    # Grupos por sesión (orden del lote); los mensajes sin session_id abren cada uno su sesión
+    grupos: Dict[Any, List[int]] = {}
+    for indice, mensaje in enumerate(mensajes):
+        grupos.setdefault(mensaje.session_id or indice, []).append(indice)
+
+    resultados: List[Optional[ChatBatchItem]] = [None] * len(mensajes)
+    registros: Dict[int, Dict[str, Any]] = {}
+    fanout = asyncio.Semaphore(max(1, CHAT_BATCH_FANOUT))
+
+    async def _procesar_grupo(indices: List[int]) -> None:
+        session_id = mensajes[indices[0]].session_id
+        try:
+            async with SESSION_LOCKS.hold(session_id, SESSION_LOCK_TIMEOUT):
+                for posicion, indice in enumerate(indices):
+                    try:
+                        async with fanout:
+                            respuesta, registro = await _ejecutar_turno(mensajes[indice])
+                    except Exception as e:
+                        resultados[indice] = _item_error(e)
+                        for siguiente in indices[posicion + 1:]:
+                            resultados[siguiente] = ChatBatchItem(
+                                status_code=424,
+                                error="No se procesó: falló un mensaje anterior de la misma sesión en el lote.",
+                            )
+                        return
+                    resultados[indice] = ChatBatchItem(status_code=200, response=respuesta)
+                    registros[indice] = registro
+        except SesionOcupadaError as e:
+            for indice in indices:
+                resultados[indice] = _item_error(e)
+
+    await asyncio.gather(*(_procesar_grupo(indices) for indices in grupos.values()))
+
+    # Un solo flush de logs para el lote
+    await run_in_threadpool(escribir_registros, [registros[i] for i in sorted(registros)])
+
+    # Cada mensaje quedo con su resultado (respuesta, error o 424)
+    assert all(item is not None for item in resultados)
+    return ChatBatchResponse(results=resultados)
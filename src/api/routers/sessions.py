@@ -0,0 +1,24 @@
+﻿# src/api/routers/sessions.py
+
+from __future__ import annotations
+
+from fastapi import APIRouter, HTTPException
+
+from src.controllers.log_index import transcript_sesion
+from src.controllers.logging_utils import ruta_log_activa
+from src.api.schemas import TranscriptResponse
+
+router = APIRouter(tags=["sessions"])
+
+
+@router.get("/sessions/{session_id}/transcript", response_model=TranscriptResponse)
+def session_transcript(session_id: str) -> TranscriptResponse:
+    """
+    Conversación completa de una sesión, leída del log de turnos (y sus segmentos
+    rotados) con el índice session_id -> offsets: no recorre el log entero.
+    Los turnos que el logger buffered aún no escribió (LOG_FLUSH_INTERVAL) no aparecen.
+    """
+    turnos = transcript_sesion(session_id, ruta_log_activa())
+    if not turnos:
+        raise HTTPException(status_code=404, detail="No hay turnos registrados para esta sesión.")
+    return TranscriptResponse(session_id=session_id, turnos=turnos)
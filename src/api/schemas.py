@@ -1,5 +1,5 @@
 ﻿# src/api/schemas.py
-from typing import Optional, Dict
+from typing import Any, Optional, Dict, List
 from pydantic import BaseModel
 
 
@@ -15,14 +15,46 @@ class ChatResponse(BaseModel):
     reply: str             # texto del bot
     completed: bool        # True si el flujo de la cita terminó
     memory: Dict[str, Optional[str]]  # estado de los slots (nombre, fecha, etc.)
+    paso: Optional[str] = None       # paso del flujo al cerrar el turno (el mismo que va al log)
+    intencion: Optional[str] = None  # intencion detectada al cerrar el turno
 
 
-class AppointmentRecord(BaseModel):
-    """Estructura de una cita registrada en la BD (para documentación)."""
+class ChatBatchRequest(BaseModel):
+    """Lote de mensajes (de varias sesiones) que envia un agregador de canales."""
+    messages: List[ChatRequest]
+
+
+class ChatBatchItem(BaseModel):
+    """Resultado de un mensaje del lote: la respuesta o el error, en la misma posicion."""
+    status_code: int                    # 200 si el turno se proceso; si no, el codigo que daria /chat
+    response: Optional[ChatResponse] = None
+    error: Optional[str] = None
+
+
+class ChatBatchResponse(BaseModel):
+    results: List[ChatBatchItem]        # mismo orden que ChatBatchRequest.messages
+
+
+class TranscriptResponse(BaseModel):
+    """Turnos de una sesion tal como quedaron en el log (mismo formato que logs.jsonl)."""
     session_id: str
-    nombre: str
-    identificacion: str
-    especialidad: str
-    fecha: str
+    turnos: List[Dict[str, Any]]        # en el orden en que se escribieron
+
+
+class AppointmentRecord(BaseModel):
+    """Cita registrada en la BD (respuesta de /appointments)."""
+    id: int
+    session_id: Optional[str] = None   # None en citas cargadas fuera del chat
+    nombre: Optional[str] = None
+    identificacion: Optional[str] = None
+    especialidad: Optional[str] = None
+    fecha: Optional[str] = None        # YYYY-MM-DD
     hora: Optional[str] = None
     medio: Optional[str] = None
+    created_at: Optional[str] = None   # UTC, "YYYY-MM-DD HH:MM:SS"
+
+
+class AppointmentPage(BaseModel):
+    """Pagina de citas ordenadas por (fecha, id)."""
+    items: List[AppointmentRecord]
+    next_cursor: Optional[str] = None   # se pasa como ?cursor= para la siguiente pagina; None si no hay mas
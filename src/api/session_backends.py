@@ -0,0 +1,492 @@
+﻿# src/api/session_backends.py
+
+from __future__ import annotations
+
+import asyncio
+import os
+import sqlite3
+import struct
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+from src.api.session_store import DEFAULT_IDLE_TTL, DEFAULT_SWEEP_INTERVAL, SesionOcupadaError
+from src.models.domain import ConversationState, FlowStep, Intent, Memory
+
+try:  # Backend Redis opcional (SESSION_BACKEND=redis)
+    import redis
+except ImportError:  # pragma: no cover - depende del entorno
+    redis = None  # type: ignore[assignment]
+
+DEFAULT_SESSION_DB_PATH = Path(__file__).resolve().parent.parent / "data" / "sessions.db"
+DEFAULT_REDIS_URL = "redis://localhost:6379/0"
+DEFAULT_CACHE_SIZE = 1024
+DEFAULT_CACHE_TTL = 1.0
+
+# --- Serializacion binaria -----------------------------------------------------------------
+
+# Formato v1: cabecera fija + session_id y los 6 campos de Memory como (largo uint16, utf-8).
+# Las tablas de codigos solo admiten agregar al final: el codigo es la posicion.
+_FORMATO = 1
+_CABECERA = struct.Struct("<BBBIH")  # formato, intent, paso, turn_counter, llm_failures
+_LARGO = struct.Struct("<H")
+_NULO = 0xFFFF
+_INTENTS: Tuple[Optional[Intent], ...] = (None, Intent.AGENDAR_CITA, Intent.SMALL_TALK, Intent.DESCONOCIDA)
+_PASOS: Tuple[FlowStep, ...] = (
+    FlowStep.INICIO,
+    FlowStep.PEDIR_NOMBRE,
+    FlowStep.PEDIR_IDENTIFICACION,
+    FlowStep.PEDIR_ESPECIALIDAD,
+    FlowStep.PEDIR_FECHA,
+    FlowStep.PEDIR_HORA,
+    FlowStep.PEDIR_MEDIO,
+    FlowStep.CONFIRMAR,
+    FlowStep.COMPLETADO,
+)
+_CODIGO_INTENT = {intent: codigo for codigo, intent in enumerate(_INTENTS)}
+_CODIGO_PASO = {paso: codigo for codigo, paso in enumerate(_PASOS)}
+_CAMPOS_MEMORIA = ("nombre", "identificacion", "especialidad", "fecha", "hora", "medio")
+
+
+class FormatoSesionError(ValueError):
+    """Los bytes no corresponden a un ConversationState serializado con un formato conocido."""
+
+
+def serializar_estado(state: ConversationState) -> bytes:
+    """ConversationState -> bytes compactos (~4x mas chico que el JSON equivalente).
+
+    Se guarda lo que sobrevive entre turnos; llm_calls y duraciones_ms son del
+    ultimo turno y la version la lleva el backend.
+    """
+    partes = [
+        _CABECERA.pack(
+            _FORMATO,
+            _CODIGO_INTENT[state.intent],
+            _CODIGO_PASO[state.step],
+            state.turn_counter,
+            min(state.llm_failures, 0xFFFF),
+        )
+    ]
+    for valor in (state.session_id, *(getattr(state.memory, campo) for campo in _CAMPOS_MEMORIA)):
+        if valor is None:
+            partes.append(_LARGO.pack(_NULO))
+        else:
+            datos = str(valor).encode("utf-8")[: _NULO - 1]
+            partes.append(_LARGO.pack(len(datos)))
+            partes.append(datos)
+    return b"".join(partes)
+
+
+def deserializar_estado(datos: bytes, version: int = 0) -> ConversationState:
+    try:
+        formato, intent, paso, turnos, fallos = _CABECERA.unpack_from(datos, 0)
+        if formato != _FORMATO:
+            raise FormatoSesionError(f"Formato de sesion desconocido: {formato}")
+        posicion = _CABECERA.size
+        valores: List[Optional[str]] = []
+        for _ in range(1 + len(_CAMPOS_MEMORIA)):
+            (largo,) = _LARGO.unpack_from(datos, posicion)
+            posicion += _LARGO.size
+            if largo == _NULO:
+                valores.append(None)
+            else:
+                valores.append(datos[posicion:posicion + largo].decode("utf-8"))
+                posicion += largo
+        return ConversationState(
+            intent=_INTENTS[intent],
+            step=_PASOS[paso],
+            memory=Memory(*valores[1:]),
+            session_id=valores[0] or "",
+            turn_counter=turnos,
+            llm_failures=fallos,
+            version=version,
+        )
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise FormatoSesionError(str(e)) from e
+
+
+# --- Backends ------------------------------------------------------------------------------
+
+
+class SessionBackend:
+    """Almacenamiento compartido de sesiones serializadas con version y expiracion.
+
+    `guardar` es un compare-and-set: solo escribe si la version guardada es
+    `version_esperada` (0 = la sesion no existe o expiro) y devuelve la nueva, o
+    None si otro worker la modifico antes. Los tiempos son epoch (time.time())
+    porque se comparan entre procesos.
+    """
+
+    def leer(self, session_id: str, ahora: float) -> Optional[Tuple[int, bytes]]:
+        raise NotImplementedError
+
+    def guardar(self, session_id: str, version_esperada: int, datos: bytes, expira_en: float) -> Optional[int]:
+        raise NotImplementedError
+
+    def borrar(self, session_id: str) -> None:
+        raise NotImplementedError
+
+    def borrar_si(self, session_id: str, version: int) -> bool:
+        """Borra la sesion solo si sigue en `version` (compare-and-delete).
+
+        Devuelve False si otro worker la modifico o la borro antes.
+        """
+        raise NotImplementedError
+
+    def borrar_todo(self) -> None:
+        raise NotImplementedError
+
+    def purgar(self, ahora: float) -> int:
+        """Elimina las sesiones expiradas. Devuelve cuantas elimino."""
+        raise NotImplementedError
+
+    def contar(self, ahora: float) -> int:
+        raise NotImplementedError
+
+    def cerrar(self) -> None:
+        pass
+
+
+class SQLiteSessionBackend(SessionBackend):
+    """Sesiones en un SQLite en modo WAL compartido por los workers de una maquina.
+
+    Una conexion por hilo; cada operacion es una sola sentencia (atomica), asi el
+    compare-and-set es un UPDATE ... WHERE version = ?.
+    """
+
+    PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA busy_timeout=5000",
+    )
+
+    def __init__(self, path: Union[str, Path] = DEFAULT_SESSION_DB_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._conexiones: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        self._conexion().execute(
+            """
+            CREATE TABLE IF NOT EXISTS sesiones (
+                session_id TEXT PRIMARY KEY,
+                version INTEGER NOT NULL,
+                expira_en REAL NOT NULL,
+                datos BLOB NOT NULL
+            ) WITHOUT ROWID
+            """
+        )
+        self._conexion().execute("CREATE INDEX IF NOT EXISTS idx_sesiones_expira_en ON sesiones (expira_en)")
+
+    def _conexion(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # Autocommit: cada sentencia es su propia transaccion
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            for pragma in self.PRAGMAS:
+                conn.execute(pragma)
+            self._local.conn = conn
+            with self._lock:
+                self._conexiones.append(conn)
+        return conn
+
+    def leer(self, session_id: str, ahora: float) -> Optional[Tuple[int, bytes]]:
+        fila = self._conexion().execute(
+            "SELECT version, datos FROM sesiones WHERE session_id = ? AND expira_en > ?",
+            (session_id, ahora),
+        ).fetchone()
+        return (fila[0], bytes(fila[1])) if fila else None
+
+    def guardar(self, session_id: str, version_esperada: int, datos: bytes, expira_en: float) -> Optional[int]:
+        conn = self._conexion()
+        if version_esperada == 0:
+            # Alta: solo si no existe o la que habia ya expiro
+            cursor = conn.execute(
+                """
+                INSERT INTO sesiones (session_id, version, expira_en, datos) VALUES (?, 1, ?, ?)
+                ON CONFLICT (session_id) DO UPDATE
+                SET version = 1, expira_en = excluded.expira_en, datos = excluded.datos
+                WHERE sesiones.expira_en <= ?
+                """,
+                (session_id, expira_en, datos, time.time()),
+            )
+        else:
+            cursor = conn.execute(
+                "UPDATE sesiones SET version = version + 1, expira_en = ?, datos = ? "
+                "WHERE session_id = ? AND version = ?",
+                (expira_en, datos, session_id, version_esperada),
+            )
+        return version_esperada + 1 if cursor.rowcount == 1 else None
+
+    def borrar(self, session_id: str) -> None:
+        self._conexion().execute("DELETE FROM sesiones WHERE session_id = ?", (session_id,))
+
+    def borrar_si(self, session_id: str, version: int) -> bool:
+        cursor = self._conexion().execute(
+            "DELETE FROM sesiones WHERE session_id = ? AND version = ?", (session_id, version)
+        )
+        return cursor.rowcount == 1
+
+    def borrar_todo(self) -> None:
+        self._conexion().execute("DELETE FROM sesiones")
+
+    def purgar(self, ahora: float) -> int:
+        return self._conexion().execute("DELETE FROM sesiones WHERE expira_en <= ?", (ahora,)).rowcount
+
+    def contar(self, ahora: float) -> int:
+        return self._conexion().execute(
+            "SELECT COUNT(*) FROM sesiones WHERE expira_en > ?", (ahora,)
+        ).fetchone()[0]
+
+    def cerrar(self) -> None:
+        with self._lock:
+            conexiones, self._conexiones = self._conexiones, []
+        for conn in conexiones:
+            conn.close()
+        self._local = threading.local()
+
+
+class RedisSessionBackend(SessionBackend):
+    """Sesiones en un servidor con protocolo Redis (Redis, Valkey, KeyDB...), compartido entre maquinas.
+
+    Cada sesion es un hash {v: version, d: datos} con PEXPIRE; el compare-and-set
+    es un script Lua (atomico en el servidor). La expiracion la hace el servidor.
+    """
+
+    _CAS = """
+    local actual = tonumber(redis.call('HGET', KEYS[1], 'v') or '0')
+    if actual ~= tonumber(ARGV[1]) then
+        return -1
+    end
+    redis.call('HSET', KEYS[1], 'v', actual + 1, 'd', ARGV[2])
+    redis.call('PEXPIRE', KEYS[1], ARGV[3])
+    return actual + 1
+    """
+
+    _BORRAR_SI = """
+    if tonumber(redis.call('HGET', KEYS[1], 'v') or '0') ~= tonumber(ARGV[1]) then
+        return 0
+    end
+    return redis.call('DEL', KEYS[1])
+    """
+
+    def __init__(self, url: str = DEFAULT_REDIS_URL, prefijo: str = "agente_citas:sesion:"):
+        if redis is None:
+            raise RuntimeError("SESSION_BACKEND=redis requiere el paquete 'redis' (pip install redis).")
+        self.prefijo = prefijo
+        self._cliente = redis.Redis.from_url(url)
+        self._cas = self._cliente.register_script(self._CAS)
+        self._borrar_si = self._cliente.register_script(self._BORRAR_SI)
+
+    def _clave(self, session_id: str) -> str:
+        return self.prefijo + session_id
+
+    def leer(self, session_id: str, ahora: float) -> Optional[Tuple[int, bytes]]:
+        version, datos = self._cliente.hmget(self._clave(session_id), "v", "d")
+        if version is None or datos is None:
+            return None
+        return int(version), bytes(datos)
+
+    def guardar(self, session_id: str, version_esperada: int, datos: bytes, expira_en: float) -> Optional[int]:
+        ttl_ms = max(1, int((expira_en - time.time()) * 1000))
+        nueva = int(self._cas(keys=[self._clave(session_id)], args=[version_esperada, datos, ttl_ms]))
+        return nueva if nueva > 0 else None
+
+    def borrar(self, session_id: str) -> None:
+        self._cliente.delete(self._clave(session_id))
+
+    def borrar_si(self, session_id: str, version: int) -> bool:
+        return int(self._borrar_si(keys=[self._clave(session_id)], args=[version])) == 1
+
+    def _claves(self) -> List[bytes]:
+        return list(self._cliente.scan_iter(match=self.prefijo + "*", count=1000))
+
+    def borrar_todo(self) -> None:
+        claves = self._claves()
+        for inicio in range(0, len(claves), 1000):
+            self._cliente.delete(*claves[inicio:inicio + 1000])
+
+    def purgar(self, ahora: float) -> int:
+        return 0  # el servidor expira las claves solo (PEXPIRE)
+
+    def contar(self, ahora: float) -> int:
+        return len(self._claves())
+
+    def cerrar(self) -> None:
+        self._cliente.close()
+
+
+def crear_backend(nombre: str) -> SessionBackend:
+    """Backend compartido segun SESSION_BACKEND ("sqlite" o "redis") y su configuracion del entorno."""
+    if nombre == "sqlite":
+        return SQLiteSessionBackend(os.environ.get("SESSION_DB_PATH", DEFAULT_SESSION_DB_PATH))
+    if nombre == "redis":
+        return RedisSessionBackend(os.environ.get("SESSION_REDIS_URL", DEFAULT_REDIS_URL))
+    raise ValueError(f"SESSION_BACKEND desconocido: {nombre!r} (memory, sqlite o redis)")
+
+
+# --- Almacen compartido --------------------------------------------------------------------
+
+
+class ConflictoVersionError(SesionOcupadaError):
+    """Otro worker guardo la sesion despues de que este la leyo (se responde 409 igual que a un turno en curso)."""
+
+
+class SharedSessionStore:
+    """Almacen de sesiones sobre un SessionBackend compartido (varios workers o replicas).
+
+    Misma interfaz que SessionStore, pero get() devuelve una copia deserializada:
+    los cambios del turno se publican con put(), que hace compare-and-set contra
+    la version leida (state.version) y lanza ConflictoVersionError si otro worker
+    la modifico entretanto, en vez de pisar su turno.
+
+    Cache local read-through: los bytes de las ultimas sesiones leidas o escritas
+    se reutilizan durante `cache_ttl` segundos sin ir al backend. Con ruteo por
+    sesion (sticky) casi siempre acierta; sin el, un dato viejo solo puede
+    producir un conflicto (nunca una escritura perdida).
+    La expiracion por inactividad la aplica el backend (idle_ttl desde el ultimo put).
+    """
+
+    compartido = True
+
+    def __init__(
+        self,
+        backend: SessionBackend,
+        idle_ttl: float = DEFAULT_IDLE_TTL,
+        cache_size: int = DEFAULT_CACHE_SIZE,
+        cache_ttl: float = DEFAULT_CACHE_TTL,
+    ):
+        self.backend = backend
+        self.idle_ttl = idle_ttl
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self._cache: "OrderedDict[str, Tuple[float, int, bytes]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.conflicts = 0
+        self.expirations = 0
+
+    # --- Cache local ---------------------------------------------------------------------
+
+    def _cache_get(self, session_id: str) -> Optional[Tuple[int, bytes]]:
+        with self._lock:
+            item = self._cache.get(session_id)
+            if item is None:
+                return None
+            guardado, version, datos = item
+            if time.monotonic() - guardado > self.cache_ttl:
+                del self._cache[session_id]
+                return None
+            self._cache.move_to_end(session_id)
+            return version, datos
+
+    def _cache_put(self, session_id: str, version: int, datos: bytes) -> None:
+        if self.cache_size <= 0:
+            return
+        with self._lock:
+            self._cache[session_id] = (time.monotonic(), version, datos)
+            self._cache.move_to_end(session_id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _cache_pop(self, session_id: str) -> None:
+        with self._lock:
+            self._cache.pop(session_id, None)
+
+    # --- Interfaz de SessionStore --------------------------------------------------------
+
+    def get(self, session_id: str) -> Optional[ConversationState]:
+        """Copia de la sesion (con su version) o None si no existe o expiro."""
+        item = self._cache_get(session_id)
+        if item is not None:
+            self.cache_hits += 1
+        else:
+            self.cache_misses += 1
+            item = self.backend.leer(session_id, time.time())
+            if item is None:
+                return None
+            self._cache_put(session_id, *item)
+        version, datos = item
+        try:
+            return deserializar_estado(datos, version)
+        except FormatoSesionError:
+            # Sesion ilegible (formato de otra version): se trata como inexistente
+            self._cache_pop(session_id)
+            return None
+
+    def put(self, state: ConversationState, session_id: Optional[str] = None) -> None:
+        """Publica la sesion si nadie la modifico desde que se leyo; actualiza state.version."""
+        key = session_id or state.session_id
+        datos = serializar_estado(state)
+        version = self.backend.guardar(key, state.version, datos, time.time() + self.idle_ttl)
+        if version is None:
+            self.conflicts += 1
+            self._cache_pop(key)
+            raise ConflictoVersionError(key)
+        state.version = version
+        self._cache_put(key, version, datos)
+
+    def pop(self, session_id: str) -> Optional[ConversationState]:
+        state = self.get(session_id)
+        self._cache_pop(session_id)
+        self.backend.borrar(session_id)
+        return state
+
+    def retirar(self, state: ConversationState) -> None:
+        """Borra la sesion al completarse el flujo si nadie la modifico desde que se leyo.
+
+        Lanza ConflictoVersionError si otro worker la guardo o la retiro entretanto
+        (el mismo "si" procesado por dos workers): solo uno sigue y registra la cita.
+        Deja state.version en 0, listo para publicarse de nuevo con put().
+        """
+        key = state.session_id
+        self._cache_pop(key)
+        if state.version and not self.backend.borrar_si(key, state.version):
+            self.conflicts += 1
+            raise ConflictoVersionError(key)
+        state.version = 0
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+        self.backend.borrar_todo()
+
+    def sweep(self) -> int:
+        """Elimina del backend las sesiones expiradas. Devuelve cuantas elimino."""
+        eliminadas = self.backend.purgar(time.time())
+        self.expirations += eliminadas
+        return eliminadas
+
+    async def run_sweeper(self, interval: float = DEFAULT_SWEEP_INTERVAL) -> None:
+        """Barrido periodico (en el threadpool: el backend hace I/O)."""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            await loop.run_in_executor(None, self.sweep)
+
+    def cerrar(self) -> None:
+        self.backend.cerrar()
+
+    def __len__(self) -> int:
+        return self.backend.contar(time.time())
+
+    def __contains__(self, session_id: object) -> bool:
+        return isinstance(session_id, str) and self.backend.leer(session_id, time.time()) is not None
+
+    def stats(self) -> Dict[str, float]:
+        """Gauges: sesiones vivas en el backend, bytes por sesion (serializada) y cache local."""
+        with self._lock:
+            muestra = [datos for _, _, datos in self._cache.values()]
+            en_cache = len(self._cache)
+        return {
+            "sessions": len(self),
+            "bytes_per_session": round(sum(map(len, muestra)) / len(muestra), 1) if muestra else 0.0,
+            "expirations": self.expirations,
+            "conflicts": self.conflicts,
+            "cache_entries": en_cache,
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+        }
@@ -0,0 +1,222 @@
+﻿# src/api/session_store.py
+
+from __future__ import annotations
+
+import asyncio
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from itertools import islice
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from src.models.domain import ConversationState
+
+DEFAULT_MAX_SESSIONS = 10_000
+DEFAULT_IDLE_TTL = 1800.0
+DEFAULT_SWEEP_INTERVAL = 60.0
+DEFAULT_LOCK_TIMEOUT = 2.0
+
+# Cuantas sesiones se miden para estimar bytes por sesion (medirlas todas es O(n))
+_MUESTRA_BYTES = 200
+
+EvictionListener = Callable[[str], None]
+
+
+def estimar_bytes(state: ConversationState) -> int:
+    """Estimacion (poco profunda) de la memoria que ocupa un ConversationState."""
+    total = sys.getsizeof(state) + sys.getsizeof(state.memory) + sys.getsizeof(state.session_id)
+    for value in state.memory.to_dict().values():
+        if value is not None:
+            total += sys.getsizeof(value)
+    return total
+
+
+class SessionStore:
+    """Almacen de sesiones en memoria con LRU acotado y expiracion por inactividad.
+
+    Thread-safe. Las sesiones expiradas se eliminan al accederlas y en el barrido
+    periodico (run_sweeper). Los listeners se llaman con el session_id de cada
+    sesion que sale del almacen (expirada, desalojada o borrada).
+    get() devuelve el mismo objeto que se guardo: los cambios del turno quedan
+    aplicados sin put() (ver SharedSessionStore para el caso con varios workers).
+    """
+
+    compartido = False
+
+    def __init__(self, max_size: int = DEFAULT_MAX_SESSIONS, idle_ttl: float = DEFAULT_IDLE_TTL):
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self._data: "OrderedDict[str, Tuple[float, ConversationState]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._listeners: List[EvictionListener] = []
+        self.evictions = 0
+        self.expirations = 0
+
+    def add_listener(self, listener: EvictionListener) -> None:
+        self._listeners.append(listener)
+
+    def _notify(self, session_ids: List[str]) -> None:
+        for session_id in session_ids:
+            for listener in self._listeners:
+                listener(session_id)
+
+    def get(self, session_id: str) -> Optional[ConversationState]:
+        """Devuelve la sesion (y renueva su ultimo acceso) o None si no existe o expiro."""
+        now = time.monotonic()
+        expirada = False
+        with self._lock:
+            item = self._data.get(session_id)
+            if item is None:
+                return None
+            last_access, state = item
+            if now - last_access > self.idle_ttl:
+                del self._data[session_id]
+                self.expirations += 1
+                expirada = True
+            else:
+                self._data[session_id] = (now, state)
+                self._data.move_to_end(session_id)
+        if expirada:
+            self._notify([session_id])
+            return None
+        return state
+
+    def put(self, state: ConversationState, session_id: Optional[str] = None) -> None:
+        """Guarda la sesion bajo session_id (por defecto state.session_id), desalojando la LRU si hace falta."""
+        key = session_id or state.session_id
+        desalojadas: List[str] = []
+        with self._lock:
+            self._data[key] = (time.monotonic(), state)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                old_key, _ = self._data.popitem(last=False)
+                desalojadas.append(old_key)
+                self.evictions += 1
+        self._notify(desalojadas)
+
+    def pop(self, session_id: str) -> Optional[ConversationState]:
+        with self._lock:
+            item = self._data.pop(session_id, None)
+        if item is None:
+            return None
+        self._notify([session_id])
+        return item[1]
+
+    def retirar(self, state: ConversationState) -> None:
+        """Borra la sesion al completarse el flujo (en un solo proceso SessionLocks ya serializa sus turnos)."""
+        self.pop(state.session_id)
+
+    def clear(self) -> None:
+        with self._lock:
+            session_ids = list(self._data)
+            self._data.clear()
+        self._notify(session_ids)
+
+    def sweep(self) -> int:
+        """Elimina las sesiones inactivas por mas de idle_ttl. Devuelve cuantas elimino."""
+        limite = time.monotonic() - self.idle_ttl
+        expiradas: List[str] = []
+        with self._lock:
+            # El OrderedDict esta ordenado por ultimo acceso: basta recorrer desde el inicio
+            for session_id, (last_access, _) in self._data.items():
+                if last_access > limite:
+                    break
+                expiradas.append(session_id)
+            for session_id in expiradas:
+                del self._data[session_id]
+            self.expirations += len(expiradas)
+        self._notify(expiradas)
+        return len(expiradas)
+
+    async def run_sweeper(self, interval: float = DEFAULT_SWEEP_INTERVAL) -> None:
+        """Barrido periodico en segundo plano (se lanza como tarea al arrancar la API)."""
+        while True:
+            await asyncio.sleep(interval)
+            self.sweep()
+
+    def cerrar(self) -> None:
+        pass
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, session_id: object) -> bool:
+        return session_id in self._data
+
+    def stats(self) -> Dict[str, float]:
+        """Gauges del almacen: sesiones vivas y bytes estimados por sesion."""
+        with self._lock:
+            total = len(self._data)
+            muestra = [state for _, state in islice(reversed(self._data.values()), _MUESTRA_BYTES)]
+        bytes_por_sesion = (
+            sum(estimar_bytes(state) for state in muestra) / len(muestra) if muestra else 0.0
+        )
+        return {
+            "sessions": total,
+            "max_sessions": self.max_size,
+            "bytes_per_session": round(bytes_por_sesion, 1),
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class SesionOcupadaError(Exception):
+    """Ya hay un turno en curso para la sesion y no se libero dentro del tiempo de espera."""
+
+
+class SessionLocks:
+    """Un asyncio.Lock por sesion para serializar sus turnos.
+
+    Sesiones distintas nunca se bloquean entre si. Cada lock lleva un contador de
+    usuarios (el que lo tiene + los que esperan) y se elimina cuando llega a cero:
+    solo existen locks de sesiones con turnos en vuelo, de modo que una sesion que
+    expira en el SessionStore nunca deja su lock atras.
+    Debe usarse desde un unico event loop.
+    """
+
+    def __init__(self) -> None:
+        self._locks: Dict[str, Tuple[asyncio.Lock, int]] = {}
+
+    @asynccontextmanager
+    async def hold(self, session_id: Optional[str], timeout: float) -> AsyncIterator[None]:
+        """Mantiene el lock de la sesion durante el bloque.
+
+        Espera como maximo `timeout` segundos; si no lo consigue lanza SesionOcupadaError.
+        Sin session_id (sesion nueva) no hay nada que serializar.
+        """
+        if not session_id:
+            yield
+            return
+
+        lock, usuarios = self._locks.get(session_id, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        self._locks[session_id] = (lock, usuarios + 1)
+        try:
+            if lock.locked():
+                try:
+                    await asyncio.wait_for(lock.acquire(), timeout)
+                except asyncio.TimeoutError:
+                    raise SesionOcupadaError(session_id) from None
+            else:
+                await lock.acquire()
+            try:
+                yield
+            finally:
+                lock.release()
+        finally:
+            self._release_ref(session_id, lock)
+
+    def _release_ref(self, session_id: str, lock: asyncio.Lock) -> None:
+        entry = self._locks.get(session_id)
+        if entry is None or entry[0] is not lock:
+            return
+        if entry[1] <= 1:
+            del self._locks[session_id]
+        else:
+            self._locks[session_id] = (lock, entry[1] - 1)
+
+    def __len__(self) -> int:
+        return len(self._locks)
@@ -0,0 +1,212 @@
+﻿import datetime
+import re
+import threading
+import unicodedata
+from typing import Dict, Iterable, List, Optional, Tuple
+
+DIAS_SEMANA = ["lunes", "martes", "miercoles", "jueves", "viernes", "sabado", "domingo"]
+
+_HORA_RE = re.compile(r"^\s*(\d{1,2})(?::(\d{2}))?\s*(am|pm|a\.m\.|p\.m\.)?\s*$")
+
+
+def normalizar_especialidad(especialidad: str) -> str:
+    """Clave de indice para la especialidad: minusculas, sin tildes ni espacios extra."""
+    texto = unicodedata.normalize("NFKD", especialidad.strip().lower())
+    return " ".join("".join(c for c in texto if not unicodedata.combining(c)).split())
+
+
+def parse_fecha(fecha: Optional[str]) -> Optional[datetime.date]:
+    """Interpreta fechas ya normalizadas (YYYY-MM-DD, DD/MM/YYYY, DD-MM-YYYY)."""
+    if not fecha:
+        return None
+    texto = fecha.strip()
+    for formato in ("%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y"):
+        try:
+            return datetime.datetime.strptime(texto, formato).date()
+        except ValueError:
+            continue
+    return None
+
+
+def parse_hora(hora: Optional[str]) -> Optional[datetime.time]:
+    """Interpreta horas simples (HH:MM, H, 10am, 3 pm)."""
+    if not hora:
+        return None
+    match = _HORA_RE.match(hora.lower())
+    if not match:
+        return None
+    horas, minutos = int(match.group(1)), int(match.group(2) or 0)
+    sufijo = match.group(3)
+    if sufijo and sufijo.startswith("p") and horas < 12:
+        horas += 12
+    elif sufijo and sufijo.startswith("a") and horas == 12:
+        horas = 0
+    if horas > 23 or minutos > 59:
+        return None
+    return datetime.time(horas, minutos)
+
+
+def formatear_bloque(inicio: datetime.datetime) -> str:
+    return f"{DIAS_SEMANA[inicio.weekday()]} {inicio:%d/%m} a las {inicio:%H:%M}"
+
+
+class Agenda:
+    """Calendario de bloques reservables por especialidad con indice de bitmaps en memoria.
+
+    Cada (especialidad, dia) tiene un entero cuyos bits marcan los bloques ocupados,
+    asi que comprobar un conflicto es O(1) y buscar los proximos N bloques libres
+    solo recorre los dias necesarios. El indice se reconstruye desde SQLite al
+    arrancar (reconstruir) y se mantiene al dia en cada insert (ocupar).
+    """
+
+    def __init__(
+        self,
+        hora_inicio: datetime.time = datetime.time(8, 0),
+        hora_fin: datetime.time = datetime.time(17, 0),
+        minutos_bloque: int = 30,
+        dias_habiles: Tuple[int, ...] = (0, 1, 2, 3, 4),
+    ):
+        self.hora_inicio = hora_inicio
+        self.minutos_bloque = minutos_bloque
+        self.dias_habiles = frozenset(dias_habiles)
+        self._inicio_min = hora_inicio.hour * 60 + hora_inicio.minute
+        self.bloques_por_dia = (hora_fin.hour * 60 + hora_fin.minute - self._inicio_min) // minutos_bloque
+        self._dia_completo = (1 << self.bloques_por_dia) - 1
+        self._ocupados: Dict[Tuple[str, datetime.date], int] = {}
+        self._lock = threading.Lock()
+
+    # --- Indice ------------------------------------------------------------------------
+
+    def _bloque(self, fecha: datetime.date, hora: datetime.time) -> Optional[int]:
+        """Indice del bloque que contiene la hora, o None si cae fuera del horario."""
+        if fecha.weekday() not in self.dias_habiles:
+            return None
+        indice = (hora.hour * 60 + hora.minute - self._inicio_min) // self.minutos_bloque
+        if hora.hour * 60 + hora.minute < self._inicio_min or indice >= self.bloques_por_dia:
+            return None
+        return indice
+
+    def _resolver(
+        self, especialidad: Optional[str], fecha: Optional[str], hora: Optional[str]
+    ) -> Optional[Tuple[str, datetime.date, Optional[int]]]:
+        dia = parse_fecha(fecha)
+        hora_t = parse_hora(hora)
+        if not especialidad or dia is None or hora_t is None:
+            return None
+        return normalizar_especialidad(especialidad), dia, self._bloque(dia, hora_t)
+
+    def clave_bloque(
+        self, especialidad: Optional[str], fecha: Optional[str], hora: Optional[str]
+    ) -> Optional[str]:
+        """Clave unica del bloque ("cardiologia|2026-10-20|4") que usa el indice de la BD.
+
+        None si no se puede interpretar o cae fuera del horario (la cita no ocupa un bloque).
+        """
+        resuelto = self._resolver(especialidad, fecha, hora)
+        if resuelto is None or resuelto[2] is None:
+            return None
+        clave, dia, bloque = resuelto
+        return f"{clave}|{dia.isoformat()}|{bloque}"
+
+    def reconstruir(self, citas: Iterable[Tuple[Optional[str], Optional[str], Optional[str]]]) -> int:
+        """Reconstruye el indice desde filas (especialidad, fecha, hora). Devuelve bloques indexados."""
+        nuevos: Dict[Tuple[str, datetime.date], int] = {}
+        total = 0
+        for especialidad, fecha, hora in citas:
+            resuelto = self._resolver(especialidad, fecha, hora)
+            if resuelto is None or resuelto[2] is None:
+                continue
+            clave, dia, bloque = resuelto
+            nuevos[(clave, dia)] = nuevos.get((clave, dia), 0) | (1 << bloque)
+            total += 1
+        with self._lock:
+            self._ocupados = nuevos
+        return total
+
+    def ocupar(self, especialidad: Optional[str], fecha: Optional[str], hora: Optional[str]) -> None:
+        """Marca el bloque como ocupado (idempotente). Se llama tras cada insert en la BD."""
+        resuelto = self._resolver(especialidad, fecha, hora)
+        if resuelto is None or resuelto[2] is None:
+            return
+        clave, dia, bloque = resuelto
+        with self._lock:
+            self._ocupados[(clave, dia)] = self._ocupados.get((clave, dia), 0) | (1 << bloque)
+
+    def liberar(self, especialidad: Optional[str], fecha: Optional[str], hora: Optional[str]) -> None:
+        resuelto = self._resolver(especialidad, fecha, hora)
+        if resuelto is None or resuelto[2] is None:
+            return
+        clave, dia, bloque = resuelto
+        with self._lock:
+            self._ocupados[(clave, dia)] = self._ocupados.get((clave, dia), 0) & ~(1 << bloque)
+
+    # --- Consultas ---------------------------------------------------------------------
+
+    def esta_libre(
+        self, especialidad: Optional[str], fecha: Optional[str], hora: Optional[str]
+    ) -> Optional[bool]:
+        """True/False si el bloque esta libre; None si fecha u hora no se pudieron interpretar.
+
+        Un horario fuera de la jornada o en dia no habil cuenta como no disponible.
+        """
+        resuelto = self._resolver(especialidad, fecha, hora)
+        if resuelto is None:
+            return None
+        clave, dia, bloque = resuelto
+        if bloque is None:
+            return False
+        return not (self._ocupados.get((clave, dia), 0) >> bloque) & 1
+
+    def reservar(self, especialidad: Optional[str], fecha: Optional[str], hora: Optional[str]) -> Optional[bool]:
+        """Comprueba y ocupa el bloque de forma atomica (evita dobles reservas concurrentes).
+
+        Devuelve True si quedo reservado, False si estaba ocupado o fuera de horario y
+        None si no se pudo interpretar (en ese caso no se reserva nada).
+        La reserva es del proceso: quien reserva libera el bloque si la cita no llega
+        a insertarse, y entre workers decide el indice unico de la BD (clave_bloque).
+        """
+        resuelto = self._resolver(especialidad, fecha, hora)
+        if resuelto is None:
+            return None
+        clave, dia, bloque = resuelto
+        if bloque is None:
+            return False
+        with self._lock:
+            mascara = self._ocupados.get((clave, dia), 0)
+            if (mascara >> bloque) & 1:
+                return False
+            self._ocupados[(clave, dia)] = mascara | (1 << bloque)
+        return True
+
+    def proximos_libres(
+        self,
+        especialidad: str,
+        desde: datetime.datetime,
+        n: int = 3,
+        max_dias: int = 60,
+        solo_dia: bool = False,
+    ) -> List[datetime.datetime]:
+        """Los proximos n bloques libres desde `desde` (o solo ese dia si solo_dia=True)."""
+        clave = normalizar_especialidad(especialidad)
+        libres: List[datetime.datetime] = []
+        dia = desde.date()
+        for _ in range(1 if solo_dia else max_dias):
+            if dia.weekday() in self.dias_habiles:
+                mascara = self._ocupados.get((clave, dia), 0)
+                if mascara != self._dia_completo:
+                    base = datetime.datetime.combine(dia, self.hora_inicio)
+                    for bloque in range(self.bloques_por_dia):
+                        if (mascara >> bloque) & 1:
+                            continue
+                        inicio = base + datetime.timedelta(minutes=bloque * self.minutos_bloque)
+                        if inicio < desde:
+                            continue
+                        libres.append(inicio)
+                        if len(libres) >= n:
+                            return libres
+            dia += datetime.timedelta(days=1)
+        return libres
+
+
+# Agenda compartida por el proceso (la API la reconstruye desde SQLite al arrancar)
+AGENDA = Agenda()
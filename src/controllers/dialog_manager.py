@@ -1,14 +1,63 @@
-﻿from typing import Dict, Optional
+﻿import datetime
+from typing import Dict, List, Optional
 
-from src.models.domain import ConversationState, FlowStep, Intent, get_missing_slots
-from src.controllers.llm_client import LLMClient
-from src.controllers.nlu import detectar_intencion_llm, extraer_entidades_llm
+from src.models.domain import (
+    OPTIONAL_SLOTS_BY_INTENT,
+    REQUIRED_SLOTS_BY_INTENT,
+    ConversationState,
+    FlowStep,
+    Intent,
+    get_missing_slots,
+)
+from src.controllers.agenda import AGENDA, formatear_bloque, parse_fecha
+from src.controllers.fechas import ahora as ahora_referencia
+from src.controllers.lexicon import get_lexicon
+from src.controllers.llm_client import LLMClient, get_llm_calls, iniciar_presupuesto, reset_llm_calls
+from src.controllers.metrics import get_duraciones, medir, reset_duraciones
+from src.controllers.nlu import (
+    analizar_mensaje_llm,
+    analizar_mensaje_llm_async,
+    extraer_entidades_llm,
+    extraer_entidades_llm_async,
+)
 
 FALLBACK_MESSAGE = (
     "Estoy teniendo problemas para procesar tu solicitud en este momento. "
     "Puedes reformular tu mensaje o intentarlo de nuevo mas tarde?"
 )
 
+# Cuantos horarios libres se ofrecen como alternativa
+ALTERNATIVAS_OFRECIDAS = 3
+
+
+def _horarios_libres(state: ConversationState, solo_dia: bool = False) -> str:
+    """Texto con los proximos bloques libres de la especialidad (vacio si no aplica)."""
+    especialidad = state.memory.especialidad
+    if not especialidad:
+        return ""
+    # Mismo reloj y zona horaria con que se resuelven "hoy" o "manana" (la agenda usa hora local sin zona)
+    ahora = ahora_referencia().replace(tzinfo=None)
+    desde = ahora
+    dia = parse_fecha(state.memory.fecha)
+    if solo_dia:
+        if dia is None:
+            return ""
+        desde = max(ahora, datetime.datetime.combine(dia, datetime.time.min))
+    libres = AGENDA.proximos_libres(
+        especialidad, desde, n=ALTERNATIVAS_OFRECIDAS, solo_dia=solo_dia
+    )
+    if not libres and solo_dia:
+        libres = AGENDA.proximos_libres(especialidad, desde, n=ALTERNATIVAS_OFRECIDAS)
+        if libres:
+            return (
+                " Ese dia no quedan horarios libres; los proximos son: "
+                + ", ".join(formatear_bloque(inicio) for inicio in libres)
+                + "."
+            )
+    if not libres:
+        return ""
+    return " Horarios disponibles: " + ", ".join(formatear_bloque(inicio) for inicio in libres) + "."
+
 
 def next_bot_action(state: ConversationState) -> str:
     """Determina el siguiente mensaje del bot basado en el flujo y slots faltantes."""
@@ -35,11 +84,20 @@ def next_bot_action(state: ConversationState) -> str:
 
     if "fecha" in missing_slots:
         state.step = FlowStep.PEDIR_FECHA
-        return "Para que fecha deseas agendar la cita?"
+        return "Para que fecha deseas agendar la cita?" + _horarios_libres(state)
 
     if not state.memory.hora:
         state.step = FlowStep.PEDIR_HORA
-        return "Tienes alguna hora preferida para la cita?"
+        return "Tienes alguna hora preferida para la cita?" + _horarios_libres(state, solo_dia=True)
+
+    if AGENDA.esta_libre(state.memory.especialidad, state.memory.fecha, state.memory.hora) is False:
+        hora_ocupada = state.memory.hora
+        state.memory.hora = None
+        state.step = FlowStep.PEDIR_HORA
+        return (
+            f"El horario {hora_ocupada} del {state.memory.fecha} no esta disponible. "
+            "Que otra hora te sirve?" + _horarios_libres(state, solo_dia=True)
+        )
 
     if not state.memory.medio:
         state.step = FlowStep.PEDIR_MEDIO
@@ -64,44 +122,181 @@ def next_bot_action(state: ConversationState) -> str:
 def agente_citas(
     mensaje_usuario: str, state: ConversationState, llm: LLMClient
 ) -> str:
-    """Gestiona el ciclo conversacional, NLU y respuestas con manejo de fallback."""
-    mensaje_usuario_lower = mensaje_usuario.strip().lower()
+    """Gestiona el ciclo conversacional, NLU y respuestas con manejo de fallback.
+
+    Deja en state.llm_calls cuantas llamadas al LLM necesito el turno y en
+    state.duraciones_ms cuanto tardo cada etapa (vacio con METRICS_ENABLED=0).
+    Todas las llamadas al LLM del turno comparten el presupuesto llm.turn_budget.
+    """
+    reset_llm_calls()
+    iniciar_presupuesto(llm.turn_budget)
+    reset_duraciones()
+    try:
+        with medir("agente_citas"):
+            return _procesar_turno(mensaje_usuario, state, llm)
+    finally:
+        iniciar_presupuesto(None)
+        state.llm_calls = get_llm_calls()
+        state.duraciones_ms = get_duraciones()
+
+
+async def agente_citas_async(
+    mensaje_usuario: str, state: ConversationState, llm: LLMClient
+) -> str:
+    """Version asincrona de agente_citas (usa LLMClient.achat, no bloquea el event loop)."""
+    reset_llm_calls()
+    iniciar_presupuesto(llm.turn_budget)
+    reset_duraciones()
+    try:
+        with medir("agente_citas"):
+            return await _procesar_turno_async(mensaje_usuario, state, llm)
+    finally:
+        iniciar_presupuesto(None)
+        state.llm_calls = get_llm_calls()
+        state.duraciones_ms = get_duraciones()
+
+
+def _procesar_turno(
+    mensaje_usuario: str, state: ConversationState, llm: LLMClient
+) -> str:
+    respuesta = _aplicar_reglas(mensaje_usuario, state)
+    if respuesta is not None:
+        return respuesta
+
+    entidades: Optional[Dict[str, Optional[str]]] = None
+    if _necesita_intencion(state):
+        # Intencion y entidades en una sola llamada al LLM
+        intent_detectada, entidades = analizar_mensaje_llm(mensaje_usuario, llm)
+        _registrar_intencion(state, intent_detectada)
+
+    if state.intent == Intent.AGENDAR_CITA:
+        if entidades is None:
+            entidades = extraer_entidades_llm(
+                mensaje_usuario, llm, _slots_a_extraer(mensaje_usuario, state), state.step
+            )
+        corregido = _aplicar_entidades(state, entidades)
+        _hora_textual(mensaje_usuario, state)
+        return _responder(mensaje_usuario, state, corregido)
+
+    return _responder(mensaje_usuario, state)
+
+
+async def _procesar_turno_async(
+    mensaje_usuario: str, state: ConversationState, llm: LLMClient
+) -> str:
+    respuesta = _aplicar_reglas(mensaje_usuario, state)
+    if respuesta is not None:
+        return respuesta
+
+    entidades: Optional[Dict[str, Optional[str]]] = None
+    if _necesita_intencion(state):
+        intent_detectada, entidades = await analizar_mensaje_llm_async(mensaje_usuario, llm)
+        _registrar_intencion(state, intent_detectada)
+
+    if state.intent == Intent.AGENDAR_CITA:
+        if entidades is None:
+            entidades = await extraer_entidades_llm_async(
+                mensaje_usuario, llm, _slots_a_extraer(mensaje_usuario, state), state.step
+            )
+        corregido = _aplicar_entidades(state, entidades)
+        _hora_textual(mensaje_usuario, state)
+        return _responder(mensaje_usuario, state, corregido)
+
+    return _responder(mensaje_usuario, state)
+
+
+def _aplicar_reglas(mensaje_usuario: str, state: ConversationState) -> Optional[str]:
+    """Reglas previas al NLU. Devuelve una respuesta si el turno se resuelve sin LLM."""
+    coincidencias = get_lexicon().buscar(mensaje_usuario)
 
     if state.intent == Intent.SMALL_TALK:
-        afirmativos = ["si", "claro", "obvio", "dale", "por supuesto", "ok", "vale"]
-        if any(pal in mensaje_usuario_lower for pal in afirmativos):
+        if _es_afirmacion(mensaje_usuario):
             state.intent = Intent.AGENDAR_CITA
         else:
             return "Soy un asistente para agendar citas medicas, deseas programar una?"
 
     if state.intent == Intent.AGENDAR_CITA:
-        if state.step == FlowStep.PEDIR_HORA and not state.memory.hora:
-            state.memory.hora = mensaje_usuario.strip()
-        elif state.step == FlowStep.PEDIR_MEDIO and not state.memory.medio:
-            medio = mensaje_usuario_lower
-            if "presencial" in medio:
-                state.memory.medio = "presencial"
-            elif "virtual" in medio or "online" in medio:
-                state.memory.medio = "virtual"
-            else:
-                state.memory.medio = mensaje_usuario.strip()
-
-    if state.intent is None or state.intent == Intent.DESCONOCIDA:
-        intent_detectada = detectar_intencion_llm(mensaje_usuario, llm)
-        state.intent = intent_detectada
-        if intent_detectada == Intent.DESCONOCIDA:
-            state.llm_failures += 1
-        else:
-            state.llm_failures = 0
+        # La hora la normaliza el NLU (parser local y, si no lo entiende, el LLM)
+        if state.step == FlowStep.PEDIR_MEDIO and not state.memory.medio:
+            state.memory.medio = coincidencias.unico("modalidad") or mensaje_usuario.strip()
+    return None
 
-    if state.intent == Intent.AGENDAR_CITA:
-        entidades: Dict[str, Optional[str]] = extraer_entidades_llm(mensaje_usuario, llm)
-        for key, value in entidades.items():
-            if value and getattr(state.memory, key) in (None, ""):
-                setattr(state.memory, key, value)
+
+def _hora_textual(mensaje_usuario: str, state: ConversationState) -> None:
+    """La hora es opcional: si ni el parser ni el LLM la entendieron se guarda el texto
+    tal cual ("cualquiera", "no tengo preferencia") para no volver a preguntarla."""
+    if state.step == FlowStep.PEDIR_HORA and not state.memory.hora:
+        state.memory.hora = mensaje_usuario.strip()
+
+
+def _es_afirmacion(mensaje_usuario: str) -> bool:
+    """Afirmacion sin negacion segun el lexicon ("si", "claro"...; no coincide dentro de "asi")."""
+    coincidencias = get_lexicon().buscar(mensaje_usuario)
+    return coincidencias.tiene("afirmacion") and not coincidencias.tiene("negacion")
+
+
+def _slots_a_extraer(mensaje_usuario: str, state: ConversationState) -> List[str]:
+    """Slots que se le piden al NLU en este turno.
+
+    Los obligatorios faltantes y los opcionales aun vacios: el usuario puede
+    adelantar la hora o el medio ("cardiologia, manana a las 10"). Al confirmar,
+    todos, porque la respuesta puede corregir uno ya dado ("no, mejor el viernes");
+    un "si" o un "no" a secas no necesita NLU.
+    """
+    if state.intent is None:
+        return []
+    opcionales = OPTIONAL_SLOTS_BY_INTENT.get(state.intent, [])
+    if state.step == FlowStep.CONFIRMAR:
+        if get_lexicon().buscar(mensaje_usuario).completo:
+            return []
+        return REQUIRED_SLOTS_BY_INTENT.get(state.intent, []) + opcionales
+    faltantes = get_missing_slots(state)
+    faltantes.extend(slot for slot in opcionales if not getattr(state.memory, slot))
+    return faltantes
+
+
+def _necesita_intencion(state: ConversationState) -> bool:
+    return state.intent is None or state.intent == Intent.DESCONOCIDA
+
+
+def _registrar_intencion(state: ConversationState, intent_detectada: Intent) -> None:
+    state.intent = intent_detectada
+    if intent_detectada == Intent.DESCONOCIDA:
+        state.llm_failures += 1
+    else:
         state.llm_failures = 0
 
-    if state.step == FlowStep.CONFIRMAR and "si" in mensaje_usuario_lower:
+
+def _aplicar_entidades(
+    state: ConversationState, entidades: Dict[str, Optional[str]]
+) -> bool:
+    """Llena los slots vacios con lo extraido. Al confirmar tambien reemplaza los ya
+    dados (una correccion del usuario); devuelve si hubo alguna correccion."""
+    corregir = state.step == FlowStep.CONFIRMAR
+    corregido = False
+    for key, value in entidades.items():
+        if not value:
+            continue
+        actual = getattr(state.memory, key)
+        if actual in (None, ""):
+            setattr(state.memory, key, value)
+        elif corregir and value != actual:
+            setattr(state.memory, key, value)
+            corregido = True
+    state.llm_failures = 0
+    return corregido
+
+
+def _responder(mensaje_usuario: str, state: ConversationState, corregido: bool = False) -> str:
+    """Construye la respuesta del turno una vez aplicado el NLU.
+
+    Con una correccion al confirmar ("si, pero a las 10") no se reserva: se vuelve
+    a mostrar el resumen con los datos nuevos.
+    """
+    if state.step == FlowStep.CONFIRMAR and _es_afirmacion(mensaje_usuario) and not corregido:
+        # Reserva atomica del bloque: otra sesion pudo tomarlo mientras se confirmaba
+        if AGENDA.reservar(state.memory.especialidad, state.memory.fecha, state.memory.hora) is False:
+            return next_bot_action(state)
         respuesta = "Tu cita ha sido registrada."
         state.step = FlowStep.COMPLETADO
         state.intent = Intent.AGENDAR_CITA
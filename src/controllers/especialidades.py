@@ -0,0 +1,252 @@
+﻿import functools
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+from src.controllers.lexicon import normalizar_texto
+from src.models.domain import registrar_vocabulario
+
+DEFAULT_CATALOGO_PATH = Path(__file__).resolve().parent.parent / "data" / "especialidades.json"
+
+# Score minimo para aceptar una especialidad sin preguntarle al LLM
+UMBRAL_CONFIANZA = float(os.environ.get("ESPECIALIDAD_MIN_SCORE", 0.75))
+# Cada cuantos segundos se revisa si el archivo del catalogo cambio (recarga en caliente)
+RECARGA_INTERVALO = float(os.environ.get("ESPECIALIDADES_RELOAD_INTERVAL", 5.0))
+
+# Ventanas mas cortas solo producen trigramas espurios ("de", "el", "con")
+_MIN_CARACTERES_DIFUSO = 4
+# Alias con mas trigramas en comun que se vuelven a puntuar por distancia de edicion
+# (solo si ya se parecen algo: la distancia de edicion es la parte cara)
+_CANDIDATOS_EDICION = 3
+_MIN_DICE_EDICION = 0.4
+
+
+def _trigramas(texto: str) -> frozenset:
+    relleno = f" {texto} "
+    return frozenset(relleno[i:i + 3] for i in range(len(relleno) - 2))
+
+
+def _distancia_edicion(a: str, b: str, maximo: int) -> int:
+    """Distancia de Damerau-Levenshtein (OSA, una transposicion cuenta como un error) acotada.
+
+    Solo calcula la banda |i - j| <= maximo y corta en cuanto una fila entera lo
+    supera; en ese caso devuelve maximo + 1.
+    """
+    fuera = maximo + 1
+    if abs(len(a) - len(b)) > maximo:
+        return fuera
+    anterior2: List[int] = []
+    anterior = [j if j <= maximo else fuera for j in range(len(b) + 1)]
+    for i in range(1, len(a) + 1):
+        ca = a[i - 1]
+        actual = [i if i <= maximo else fuera] + [fuera] * len(b)
+        minimo_fila = actual[0]
+        for j in range(max(1, i - maximo), min(len(b), i + maximo) + 1):
+            cb = b[j - 1]
+            valor = anterior[j - 1] + (ca != cb)
+            if anterior[j] + 1 < valor:
+                valor = anterior[j] + 1
+            if actual[j - 1] + 1 < valor:
+                valor = actual[j - 1] + 1
+            if i > 1 and j > 1 and ca == b[j - 2] and a[i - 2] == cb and anterior2[j - 2] + 1 < valor:
+                valor = anterior2[j - 2] + 1
+            if valor > fuera:
+                valor = fuera
+            actual[j] = valor
+            if valor < minimo_fila:
+                minimo_fila = valor
+        if minimo_fila > maximo:
+            return fuera
+        anterior2, anterior = anterior, actual
+    return anterior[-1]
+
+
+@dataclass(frozen=True)
+class CoincidenciaEspecialidad:
+    """Especialidad canonica encontrada, con su score (1.0 = alias exacto) y el alias que coincidio.
+
+    `ambigua`: el texto nombra mas de una especialidad ("dermatologia o cardiologia");
+    `canonica` es entonces solo la primera encontrada.
+    """
+
+    canonica: str
+    score: float
+    alias: str
+    ambigua: bool = False
+
+
+class CatalogoEspecialidades:
+    """Catalogo de especialidades con indice de trigramas de caracteres en memoria.
+
+    Cada alias (normalizado: minusculas, sin tildes) apunta a su nombre canonico.
+    `resolver` prueba primero las ventanas de palabras del texto contra los alias
+    exactos ("el cardiologo" -> Cardiología, score 1.0) y si no hay, puntua las
+    ventanas por similitud de trigramas (Dice) usando un indice invertido. Los
+    alias mas parecidos se vuelven a puntuar por distancia de edicion (errores de
+    tipeo: "cardiolojia", "piscologo") y una ventana que es prefijo de un alias
+    recibe un bonus ("pedia" -> Pediatría). Los resultados se memorizan por texto
+    normalizado. Si hay alias exactos de mas de una especialidad (en ventanas que
+    no se solapan) la coincidencia se marca como ambigua.
+    """
+
+    def __init__(
+        self,
+        entradas: Dict[str, List[str]],
+        cache_size: int = 4096,
+        path: Optional[Union[str, Path]] = None,
+        mtime: Optional[float] = None,
+    ):
+        self.path = path
+        self.mtime = mtime
+        self.canonicas = tuple(entradas)
+        self._exactos: Dict[str, str] = {}
+        self._alias: List[Tuple[str, str, frozenset]] = []
+        self._indice: Dict[str, List[int]] = {}
+        for canonica, alias in entradas.items():
+            for frase in [canonica] + list(alias):
+                clave = normalizar_texto(frase)
+                if not clave or clave in self._exactos:
+                    continue
+                self._exactos[clave] = canonica
+                trigramas = _trigramas(clave)
+                for trigrama in trigramas:
+                    self._indice.setdefault(trigrama, []).append(len(self._alias))
+                self._alias.append((clave, canonica, trigramas))
+        self._max_palabras = max((len(a.split()) for a in self._exactos), default=1)
+        self._resolver_normalizado = functools.lru_cache(maxsize=cache_size)(self._resolver)
+
+    @classmethod
+    def desde_archivo(cls, path: Union[str, Path]) -> "CatalogoEspecialidades":
+        mtime = os.stat(path).st_mtime
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(json.load(f), path=path, mtime=mtime)
+
+    def resolver(self, texto: str) -> Optional[CoincidenciaEspecialidad]:
+        """Mejor especialidad para el texto (None si ningun alias se parece)."""
+        return self._resolver_normalizado(normalizar_texto(texto))
+
+    def _resolver(self, texto: str) -> Optional[CoincidenciaEspecialidad]:
+        palabras = texto.split()
+        posiciones = [
+            (i, n)
+            for n in range(min(self._max_palabras, len(palabras)), 0, -1)
+            for i in range(len(palabras) - n + 1)
+        ]
+        ventanas = [" ".join(palabras[i:i + n]) for i, n in posiciones]
+        exacta: Optional[CoincidenciaEspecialidad] = None
+        cubiertas: set = set()
+        # De la mas larga a la mas corta: "medico general" antes que "general" (que ya no
+        # cuenta aparte porque se solapa con ella)
+        for (i, n), ventana in zip(posiciones, ventanas):
+            canonica = self._exactos.get(ventana)
+            if canonica is None or not cubiertas.isdisjoint(range(i, i + n)):
+                continue
+            cubiertas.update(range(i, i + n))
+            if exacta is None:
+                exacta = CoincidenciaEspecialidad(canonica, 1.0, ventana)
+            elif canonica != exacta.canonica:
+                return CoincidenciaEspecialidad(exacta.canonica, 1.0, exacta.alias, ambigua=True)
+        if exacta is not None:
+            return exacta
+        mejor: Optional[CoincidenciaEspecialidad] = None
+        for ventana in reversed(ventanas):  # las palabras sueltas primero: suben el piso rapido
+            if len(ventana) < _MIN_CARACTERES_DIFUSO:
+                continue
+            candidata = self._difuso(ventana, mejor.score if mejor is not None else 0.0)
+            if candidata is not None:
+                mejor = candidata
+        return mejor
+
+    def _difuso(self, ventana: str, piso: float) -> Optional[CoincidenciaEspecialidad]:
+        """Mejor alias para la ventana si supera `piso` (el mejor score ya encontrado)."""
+        trigramas = _trigramas(ventana)
+        comunes: Dict[int, int] = {}
+        for trigrama in trigramas:
+            for indice in self._indice.get(trigrama, ()):
+                comunes[indice] = comunes.get(indice, 0) + 1
+        puntajes: List[Tuple[float, int]] = []
+        for indice, n in comunes.items():
+            alias, _, trigramas_alias = self._alias[indice]
+            score = 2.0 * n / (len(trigramas) + len(trigramas_alias))
+            if alias.startswith(ventana):
+                score = max(score, 0.8 + 0.2 * len(ventana) / len(alias))
+            puntajes.append((score, indice))
+        # Ordenados por score, el mejor queda entre los primeros aun tras refinarlos
+        puntajes.sort(reverse=True)
+        mejor: Optional[CoincidenciaEspecialidad] = None
+        for score, indice in puntajes[:_CANDIDATOS_EDICION]:
+            alias, canonica, _ = self._alias[indice]
+            # Solo interesan distancias que mejoren este score y el mejor hasta ahora
+            objetivo = max(score, mejor.score if mejor is not None else piso)
+            largo = max(len(ventana), len(alias))
+            # Cota: la distancia es al menos la diferencia de largos
+            if score >= _MIN_DICE_EDICION and 1.0 - abs(len(ventana) - len(alias)) / largo > objetivo:
+                maximo = int((1.0 - objetivo) * largo)
+                score = max(score, 1.0 - _distancia_edicion(ventana, alias, maximo) / largo)
+            if score > (mejor.score if mejor is not None else piso):
+                mejor = CoincidenciaEspecialidad(canonica, round(score, 3), alias)
+        return mejor
+
+    def stats(self) -> Dict[str, int]:
+        return {"especialidades": len(self.canonicas), "alias": len(self._alias)}
+
+
+_CATALOGO: Optional[CatalogoEspecialidades] = None
+_CATALOGO_LOCK = threading.Lock()
+_REVISADO = 0.0
+
+
+def _ruta_catalogo() -> Union[str, Path]:
+    return os.environ.get("ESPECIALIDADES_PATH", DEFAULT_CATALOGO_PATH)
+
+
+def get_catalogo() -> CatalogoEspecialidades:
+    """Catalogo del proceso (ESPECIALIDADES_PATH o src/data/especialidades.json).
+
+    Cada RECARGA_INTERVALO segundos se compara el mtime de su archivo y, si cambio,
+    se recarga sin reiniciar. Si el archivo nuevo no se puede leer se sigue con
+    el catalogo anterior.
+    """
+    global _CATALOGO, _REVISADO
+    catalogo = _CATALOGO
+    if catalogo is not None and time.monotonic() - _REVISADO < RECARGA_INTERVALO:
+        return catalogo
+    with _CATALOGO_LOCK:
+        if _CATALOGO is not None and time.monotonic() - _REVISADO < RECARGA_INTERVALO:
+            return _CATALOGO
+        path = _CATALOGO.path if _CATALOGO is not None else _ruta_catalogo()
+        try:
+            if _CATALOGO is None or os.stat(path).st_mtime != _CATALOGO.mtime:
+                _CATALOGO = CatalogoEspecialidades.desde_archivo(path)
+                registrar_vocabulario("especialidad", _CATALOGO.canonicas)
+        except (OSError, ValueError):
+            if _CATALOGO is None:
+                raise
+        _REVISADO = time.monotonic()
+        return _CATALOGO
+
+
+def cargar_catalogo(path: Optional[Union[str, Path]] = None) -> CatalogoEspecialidades:
+    """(Re)carga el catalogo desde `path` (por defecto ESPECIALIDADES_PATH o el del repo) y lo activa."""
+    global _CATALOGO, _REVISADO
+    catalogo = CatalogoEspecialidades.desde_archivo(path or _ruta_catalogo())
+    with _CATALOGO_LOCK:
+        _CATALOGO = catalogo
+        _REVISADO = time.monotonic()
+    registrar_vocabulario("especialidad", catalogo.canonicas)
+    return catalogo
+
+
+def canonizar_especialidad(texto: str, umbral: Optional[float] = None) -> Optional[str]:
+    """Nombre canonico si el score llega al umbral (UMBRAL_CONFIANZA por defecto) y el texto
+    nombra una sola especialidad; si no, None."""
+    coincidencia = get_catalogo().resolver(texto)
+    if coincidencia is None or coincidencia.ambigua:
+        return None
+    if coincidencia.score < (UMBRAL_CONFIANZA if umbral is None else umbral):
+        return None
+    return coincidencia.canonica
@@ -0,0 +1,303 @@
+﻿import datetime
+import functools
+import os
+import re
+import unicodedata
+from dataclasses import dataclass
+from typing import Callable, Optional, Tuple
+from zoneinfo import ZoneInfo
+
+from src.controllers.agenda import DIAS_SEMANA
+
+# Confianza minima para usar el valor local sin preguntarle al LLM
+UMBRAL_CONFIANZA = float(os.environ.get("FECHA_MIN_SCORE", 0.7))
+
+# Zona horaria para resolver "hoy", "manana", "el proximo lunes" (por defecto la del servidor)
+ZONA_HORARIA: Optional[datetime.tzinfo] = (
+    ZoneInfo(os.environ["APP_TIMEZONE"]) if os.environ.get("APP_TIMEZONE") else None
+)
+
+Reloj = Callable[[], datetime.datetime]
+# (fecha, confianza) y (horas, minutos, am/pm, confianza) que devuelven las reglas; los minutos
+# son negativos con "menos" ("la una menos cuarto" = 1, -15)
+_Fecha = Tuple[Optional[datetime.date], float]
+_Hora = Tuple[int, int, Optional[str], float]
+
+MESES = {
+    "enero": 1, "ene": 1, "febrero": 2, "feb": 2, "marzo": 3, "mar": 3, "abril": 4, "abr": 4,
+    "mayo": 5, "may": 5, "junio": 6, "jun": 6, "julio": 7, "jul": 7, "agosto": 8, "ago": 8,
+    "septiembre": 9, "setiembre": 9, "sept": 9, "sep": 9, "set": 9, "octubre": 10, "oct": 10,
+    "noviembre": 11, "nov": 11, "diciembre": 12, "dic": 12,
+}
+NUMEROS = {
+    "un": 1, "una": 1, "uno": 1, "dos": 2, "tres": 3, "cuatro": 4, "cinco": 5, "seis": 6,
+    "siete": 7, "ocho": 8, "nueve": 9, "diez": 10, "once": 11, "doce": 12,
+}
+
+_MES = "|".join(sorted(MESES, key=len, reverse=True))
+_DIA = "|".join(DIAS_SEMANA)
+_NUM = r"\d{1,2}|" + "|".join(sorted(NUMEROS, key=len, reverse=True))
+_SUFIJO = r"a\.?\s?m\.?|p\.?\s?m\.?"
+
+_SIGNOS = re.compile(r"[^a-z0-9/:.\- ]+")
+
+_FECHA_ISO = re.compile(r"\b(\d{4})-(\d{1,2})-(\d{1,2})\b")
+_FECHA_NUMERICA = re.compile(r"\b(\d{1,2})[/-](\d{1,2})(?:[/-](\d{4}|\d{2}))?\b")
+_DIA_MES = re.compile(rf"\b(\d{{1,2}}|primero)\s+(?:de\s+)?({_MES})\b\.?(?:\s+(?:de\s+|del\s+)?(\d{{4}}))?")
+_MES_DIA = re.compile(rf"\b({_MES})\.?\s+(\d{{1,2}})\b(?:\s+(?:de\s+|del\s+)?(\d{{4}}))?")
+_PASADO_MANANA = re.compile(r"\bpasado manana\b")
+_HOY = re.compile(r"\bhoy\b")
+_MANANA = re.compile(r"(?<!la )(?<!esta )\bmanana\b")  # "de la manana" es una hora, no una fecha
+_EN_DIAS = re.compile(rf"\b(?:dentro de|en)\s+({_NUM})\s+(dias?|semanas?)\b")
+_DIA_SEMANA = re.compile(
+    rf"\b(?:(proximo|siguiente|este)\s+)?({_DIA})\b"
+    r"(?:\s+(que viene|proximo|siguiente|de la (?:proxima|siguiente) semana))?"
+)
+_PROXIMA_SEMANA = re.compile(r"\b(?:proxima|siguiente) semana\b|\bsemana que viene\b")
+_SOLO_DIA = re.compile(r"\bel (?:dia )?(\d{1,2})\b(?!\s*(?:[:/.-]|de la|am|pm|h\b|hrs?\b|horas\b))")
+
+_MEDIODIA = re.compile(r"\b(?:mediodia|medio dia)\b")
+_HORA_RELOJ = re.compile(rf"\b(\d{{1,2}}):(\d{{2}})\b\s*({_SUFIJO})?")
+_HORA_SUFIJO = re.compile(rf"\b(\d{{1,2}})\s*({_SUFIJO})(?![a-z])")
+_HORA_H = re.compile(r"\b(\d{1,2})\s*(?:h|hrs?|horas)\b")
+_HORA_A_LAS = re.compile(
+    rf"\b(?:a las|a la|las|la)\s+({_NUM})\b"
+    rf"(?:\s+y\s+(media|cuarto|{_NUM}))?(?:\s+menos\s+(cuarto|{_NUM}))?\b"
+)
+_PERIODO = re.compile(r"\b(?:de|en|por) la (manana|tarde|noche|madrugada)\b")
+
+
+@dataclass(frozen=True)
+class Normalizado:
+    """Valor ISO (YYYY-MM-DD para fechas, HH:MM para horas) con su confianza (0 a 1)."""
+
+    valor: str
+    confianza: float
+
+
+def _reloj_sistema() -> datetime.datetime:
+    return datetime.datetime.now(ZONA_HORARIA) if ZONA_HORARIA else datetime.datetime.now().astimezone()
+
+
+_RELOJ: Reloj = _reloj_sistema
+
+
+def ahora() -> datetime.datetime:
+    """Instante de referencia (con zona horaria) para resolver expresiones relativas."""
+    return _RELOJ()
+
+
+def fijar_reloj(reloj: Optional[Reloj] = None) -> None:
+    """Cambia el reloj de referencia (p. ej. uno fijo para pruebas o replays); None vuelve al del sistema."""
+    global _RELOJ
+    _RELOJ = reloj or _reloj_sistema
+
+
+def _plegar(texto: str) -> str:
+    """Minusculas y sin tildes; conserva '/', ':', '-' y '.' de fechas y horas."""
+    plegado = unicodedata.normalize("NFKD", texto.lower())
+    plegado = "".join(c for c in plegado if not unicodedata.combining(c))
+    return " ".join(_SIGNOS.sub(" ", plegado).split())
+
+
+def _numero(token: str) -> int:
+    return int(token) if token.isdigit() else NUMEROS[token]
+
+
+def _fecha(anio: int, mes: int, dia: int) -> Optional[datetime.date]:
+    try:
+        return datetime.date(anio, mes, dia)
+    except ValueError:
+        return None
+
+
+def _proxima(mes: int, dia: int, referencia: datetime.date) -> Optional[datetime.date]:
+    """Proxima ocurrencia de dia/mes desde referencia (este anio o el siguiente)."""
+    fecha = _fecha(referencia.year, mes, dia)
+    if fecha is not None and fecha < referencia:
+        fecha = _fecha(referencia.year + 1, mes, dia)
+    return fecha
+
+
+def _con_anio(mes: int, dia: int, anio: Optional[str], referencia: datetime.date) -> _Fecha:
+    if anio:
+        numero = int(anio)
+        return _fecha(numero + 2000 if numero < 100 else numero, mes, dia), 1.0
+    return _proxima(mes, dia, referencia), 0.9
+
+
+def normalizar_fecha(texto: str, referencia: Optional[datetime.date] = None) -> Optional[Normalizado]:
+    """Fecha en ISO a partir de texto libre en espanol, resolviendo lo relativo contra `referencia`.
+
+    Entiende fechas ISO y numericas (15/12, 15-12-2026), "15 de diciembre",
+    "hoy", "manana", "pasado manana", "en 3 dias", "el lunes", "el proximo lunes",
+    "el lunes de la proxima semana" y "el dia 15". Sin referencia se usa el dia
+    de ahora() (zona APP_TIMEZONE). Devuelve None si no reconoce ninguna fecha.
+    """
+    return _normalizar_fecha(_plegar(texto), referencia or ahora().date())
+
+
+def _regla_iso(m: "re.Match[str]", texto: str, referencia: datetime.date) -> _Fecha:
+    return _fecha(int(m.group(1)), int(m.group(2)), int(m.group(3))), 1.0
+
+
+def _regla_numerica(m: "re.Match[str]", texto: str, referencia: datetime.date) -> _Fecha:
+    return _con_anio(int(m.group(2)), int(m.group(1)), m.group(3), referencia)
+
+
+def _regla_dia_mes(m: "re.Match[str]", texto: str, referencia: datetime.date) -> _Fecha:
+    dia = 1 if m.group(1) == "primero" else int(m.group(1))
+    return _con_anio(MESES[m.group(2)], dia, m.group(3), referencia)
+
+
+def _regla_mes_dia(m: "re.Match[str]", texto: str, referencia: datetime.date) -> _Fecha:
+    return _con_anio(MESES[m.group(1)], int(m.group(2)), m.group(3), referencia)
+
+
+def _regla_en_dias(m: "re.Match[str]", texto: str, referencia: datetime.date) -> _Fecha:
+    dias = _numero(m.group(1)) * (7 if m.group(2).startswith("semana") else 1)
+    return referencia + datetime.timedelta(days=dias), 0.85
+
+
+def _regla_dia_semana(m: "re.Match[str]", texto: str, referencia: datetime.date) -> _Fecha:
+    objetivo = DIAS_SEMANA.index(m.group(2))
+    if (m.group(3) or "").endswith("semana") or _PROXIMA_SEMANA.search(texto):
+        # Ese dia de la semana siguiente (lunes = inicio de semana)
+        lunes = referencia - datetime.timedelta(days=referencia.weekday())
+        return lunes + datetime.timedelta(days=7 + objetivo), 0.9
+    dias = (objetivo - referencia.weekday()) % 7
+    if m.group(1) != "este" and dias == 0:
+        dias = 7  # "el lunes" dicho un lunes: el de la semana que viene
+    return referencia + datetime.timedelta(days=dias), 0.9
+
+
+def _regla_solo_dia(m: "re.Match[str]", texto: str, referencia: datetime.date) -> _Fecha:
+    dia = int(m.group(1))
+    fecha = _fecha(referencia.year, referencia.month, dia)
+    if fecha is None or fecha < referencia:
+        siguiente = referencia.replace(day=1) + datetime.timedelta(days=32)
+        fecha = _fecha(siguiente.year, siguiente.month, dia)
+    return fecha, 0.75
+
+
+def _desplazamiento(dias: int, confianza: float) -> Callable[..., _Fecha]:
+    return lambda m, texto, referencia: (referencia + datetime.timedelta(days=dias), confianza)
+
+
+# En orden de prioridad: gana la primera regla que encuentra algo en el texto
+_REGLAS_FECHA = (
+    (_FECHA_ISO, _regla_iso),
+    (_FECHA_NUMERICA, _regla_numerica),
+    (_DIA_MES, _regla_dia_mes),
+    (_MES_DIA, _regla_mes_dia),
+    (_PASADO_MANANA, _desplazamiento(2, 1.0)),
+    (_HOY, _desplazamiento(0, 1.0)),
+    (_MANANA, _desplazamiento(1, 0.95)),
+    (_EN_DIAS, _regla_en_dias),
+    (_DIA_SEMANA, _regla_dia_semana),
+    (_SOLO_DIA, _regla_solo_dia),
+)
+
+
+@functools.lru_cache(maxsize=4096)
+def _normalizar_fecha(texto: str, referencia: datetime.date) -> Optional[Normalizado]:
+    for patron, regla in _REGLAS_FECHA:
+        m = patron.search(texto)
+        if m is None:
+            continue
+        fecha, confianza = regla(m, texto, referencia)
+        return Normalizado(fecha.isoformat(), confianza) if fecha is not None else None
+    return None
+
+
+def normalizar_hora(texto: str) -> Optional[Normalizado]:
+    """Hora en ISO (HH:MM) a partir de texto libre en espanol.
+
+    Entiende "15:30", "3:30 pm", "3pm", "15 h", "a las 3 de la tarde",
+    "a las tres y media", "a las 4 menos cuarto" y "mediodia". Sin am/pm ni
+    "de la tarde" se asume el horario de atencion (de 1 a 7 es de la tarde),
+    con menos confianza; "las 12 de la noche" es medianoche. Devuelve None si no
+    reconoce ninguna hora.
+    """
+    return _normalizar_hora(_plegar(texto))
+
+
+def _regla_reloj(m: "re.Match[str]") -> _Hora:
+    return int(m.group(1)), int(m.group(2)), m.group(3), 1.0
+
+
+def _regla_sufijo(m: "re.Match[str]") -> _Hora:
+    return int(m.group(1)), 0, m.group(2), 1.0
+
+
+def _regla_h(m: "re.Match[str]") -> _Hora:
+    return int(m.group(1)), 0, None, 0.9
+
+
+def _regla_a_las(m: "re.Match[str]") -> _Hora:
+    horas, minutos = _numero(m.group(1)), 0
+    y, menos = m.group(2), m.group(3)
+    if y:
+        minutos = {"media": 30, "cuarto": 15}.get(y) or _numero(y)
+    elif menos:
+        # Se descuenta despues de ubicar la hora dicha en la manana o la tarde
+        minutos = -({"cuarto": 15}.get(menos) or _numero(menos))
+    return horas, minutos, None, 0.85
+
+
+_REGLAS_HORA = (
+    (_MEDIODIA, lambda m: (12, 0, None, 0.95)),
+    (_HORA_RELOJ, _regla_reloj),
+    (_HORA_SUFIJO, _regla_sufijo),
+    (_HORA_H, _regla_h),
+    (_HORA_A_LAS, _regla_a_las),
+)
+
+
+@functools.lru_cache(maxsize=4096)
+def _normalizar_hora(texto: str) -> Optional[Normalizado]:
+    for patron, regla in _REGLAS_HORA:
+        m = patron.search(texto)
+        if m is not None:
+            horas, minutos, sufijo, confianza = regla(m)
+            break
+    else:
+        return None
+
+    periodo = _PERIODO.search(texto)
+    if sufijo:
+        pm = sufijo.startswith("p")
+        if pm and horas < 12:
+            horas += 12
+        elif not pm and horas == 12:
+            horas = 0
+    elif periodo is not None:
+        if periodo.group(1) in ("tarde", "noche") and horas < 12:
+            horas += 12
+        elif periodo.group(1) in ("noche", "madrugada") and horas == 12:
+            horas = 0
+        confianza = max(confianza, 0.95)
+    elif 1 <= horas <= 7:
+        # Sin indicacion: fuera del horario de la manana se asume la tarde
+        horas += 12
+        confianza = min(confianza, 0.75)
+    if not 0 <= horas <= 23 or not -59 <= minutos <= 59:
+        return None
+    horas, minutos = divmod((horas * 60 + minutos) % (24 * 60), 60)
+    return Normalizado(f"{horas:02d}:{minutos:02d}", confianza)
+
+
+def fecha_iso(texto: str, umbral: Optional[float] = None) -> Optional[str]:
+    """Fecha ISO si la confianza llega al umbral (UMBRAL_CONFIANZA por defecto); si no, None."""
+    resultado = normalizar_fecha(texto)
+    if resultado is None or resultado.confianza < (UMBRAL_CONFIANZA if umbral is None else umbral):
+        return None
+    return resultado.valor
+
+
+def hora_iso(texto: str, umbral: Optional[float] = None) -> Optional[str]:
+    """Hora HH:MM si la confianza llega al umbral (UMBRAL_CONFIANZA por defecto); si no, None."""
+    resultado = normalizar_hora(texto)
+    if resultado is None or resultado.confianza < (UMBRAL_CONFIANZA if umbral is None else umbral):
+        return None
+    return resultado.valor
@@ -0,0 +1,122 @@
+﻿import functools
+import json
+import os
+import re
+import threading
+import unicodedata
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+from src.models.domain import registrar_vocabulario
+
+DEFAULT_LEXICON_PATH = Path(__file__).resolve().parent.parent / "data" / "lexicon.json"
+
+_NO_ALFANUMERICO = re.compile(r"[^a-z0-9]+")
+
+
+def normalizar_texto(texto: str) -> str:
+    """Minusculas, sin tildes y con signos de puntuacion convertidos en espacios (tokens separados por uno)."""
+    plegado = unicodedata.normalize("NFKD", texto.lower())
+    plegado = "".join(c for c in plegado if not unicodedata.combining(c))
+    return " ".join(_NO_ALFANUMERICO.sub(" ", plegado).split())
+
+
+@dataclass(frozen=True)
+class Coincidencias:
+    """Resultado de buscar el lexicon en un mensaje.
+
+    `por_categoria`: categoria -> valores canonicos en orden de aparicion (sin repetir).
+    `completo`: las frases encontradas cubren todo el mensaje (p. ej. un saludo solo).
+    """
+
+    por_categoria: Dict[str, Tuple[str, ...]]
+    completo: bool
+
+    def valores(self, categoria: str) -> Tuple[str, ...]:
+        return self.por_categoria.get(categoria, ())
+
+    def tiene(self, categoria: str, valor: Optional[str] = None) -> bool:
+        valores = self.valores(categoria)
+        return bool(valores) if valor is None else valor in valores
+
+    def unico(self, categoria: str) -> Optional[str]:
+        """El valor de la categoria si hubo exactamente uno (None si ninguno o ambiguo)."""
+        valores = self.valores(categoria)
+        return valores[0] if len(valores) == 1 else None
+
+
+class Lexicon:
+    """Lexicon de reglas (intenciones, afirmaciones, negaciones, modalidades).
+
+    Todas las frases se compilan en una sola expresion regular sobre texto
+    normalizado (sin tildes, tokens separados por un espacio) con limites de
+    palabra, de modo que una pasada por mensaje devuelve todas las coincidencias
+    ("si" no coincide dentro de "asi" ni de "visita"). Ante frases solapadas gana
+    la mas larga. Las busquedas se memorizan por mensaje normalizado.
+    """
+
+    def __init__(self, entradas: Dict[str, Dict[str, List[str]]], cache_size: int = 4096):
+        self._destinos: Dict[str, List[Tuple[str, str]]] = {}
+        for categoria, valores in entradas.items():
+            for valor, frases in valores.items():
+                for frase in list(frases) + [valor]:
+                    clave = normalizar_texto(frase)
+                    if clave and (categoria, valor) not in self._destinos.get(clave, []):
+                        self._destinos.setdefault(clave, []).append((categoria, valor))
+        self.categorias = tuple(entradas)
+        self.valores = {categoria: tuple(valores) for categoria, valores in entradas.items()}
+        alternativas = sorted(self._destinos, key=len, reverse=True)
+        self._patron = re.compile(
+            r"\b(?:" + "|".join(re.escape(frase) for frase in alternativas) + r")\b"
+        ) if alternativas else None
+        self._buscar_normalizado = functools.lru_cache(maxsize=cache_size)(self._buscar)
+
+    @classmethod
+    def desde_archivo(cls, path: Union[str, Path]) -> "Lexicon":
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def buscar(self, texto: str) -> Coincidencias:
+        return self._buscar_normalizado(normalizar_texto(texto))
+
+    def _buscar(self, texto: str) -> Coincidencias:
+        por_categoria: Dict[str, List[str]] = {}
+        sin_cubrir: List[str] = []
+        posicion = 0
+        if self._patron is not None:
+            for match in self._patron.finditer(texto):
+                sin_cubrir.append(texto[posicion:match.start()])
+                posicion = match.end()
+                for categoria, valor in self._destinos[match.group(0)]:
+                    valores = por_categoria.setdefault(categoria, [])
+                    if valor not in valores:
+                        valores.append(valor)
+        sin_cubrir.append(texto[posicion:])
+        completo = bool(por_categoria) and not "".join(sin_cubrir).strip()
+        return Coincidencias({c: tuple(v) for c, v in por_categoria.items()}, completo)
+
+
+_LEXICON: Optional[Lexicon] = None
+_LEXICON_LOCK = threading.Lock()
+
+
+def get_lexicon() -> Lexicon:
+    """Lexicon del proceso; se carga una sola vez (LEXICON_PATH o src/data/lexicon.json)."""
+    global _LEXICON
+    if _LEXICON is None:
+        with _LEXICON_LOCK:
+            if _LEXICON is None:
+                _LEXICON = Lexicon.desde_archivo(os.environ.get("LEXICON_PATH", DEFAULT_LEXICON_PATH))
+                registrar_vocabulario("medio", _LEXICON.valores.get("modalidad", ()))
+    return _LEXICON
+
+
+def cargar_lexicon(path: Optional[Union[str, Path]] = None) -> Lexicon:
+    """(Re)carga el lexicon desde `path` (por defecto LEXICON_PATH o el del repo) y lo activa."""
+    global _LEXICON
+    lexicon = Lexicon.desde_archivo(path or os.environ.get("LEXICON_PATH", DEFAULT_LEXICON_PATH))
+    with _LEXICON_LOCK:
+        _LEXICON = lexicon
+    registrar_vocabulario("medio", lexicon.valores.get("modalidad", ()))
+    return lexicon
@@ -1,49 +1,441 @@
-﻿from typing import Any, Dict, List, Optional
+﻿import asyncio
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional, Tuple
 
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
+
+from src.controllers.metrics import registrar_llamada_llm, registrar_reintento_llm
 
 OPENAI_API_URL = "https://api.openai.com/v1/chat/completions"
 OPENAI_MODEL = "gpt-4.1-mini"
 
+# Valores por defecto del pool HTTP (sobrescribibles por constructor)
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 5.0
+DEFAULT_READ_TIMEOUT = 30.0
+DEFAULT_MAX_TOKENS = 200
+
+# Presupuesto de tiempo por turno, reintentos y circuit breaker
+DEFAULT_TURN_BUDGET = 20.0
+DEFAULT_MAX_RETRIES = 2
+DEFAULT_RETRY_BACKOFF = 0.25
+DEFAULT_BREAKER_THRESHOLD = 5
+DEFAULT_BREAKER_COOLDOWN = 30.0
+
+# Solo estos codigos (y los errores de red/timeouts) justifican reintentar
+RETRYABLE_STATUS = frozenset({408, 429, 500, 502, 503, 504})
+
+# Llamadas al LLM hechas en el turno actual (aislado por hilo/tarea via contextvars)
+_LLM_CALLS: ContextVar[int] = ContextVar("llm_calls", default=0)
+
+# Instante (time.monotonic) en que vence el presupuesto del turno actual; None = sin limite
+_DEADLINE: ContextVar[Optional[float]] = ContextVar("llm_deadline", default=None)
+
+
+def reset_llm_calls() -> None:
+    """Reinicia el contador de llamadas al LLM del turno actual."""
+    _LLM_CALLS.set(0)
+
+
+def get_llm_calls() -> int:
+    """Devuelve cuantas llamadas al LLM se hicieron desde el ultimo reset_llm_calls()."""
+    return _LLM_CALLS.get()
+
+
+def iniciar_presupuesto(segundos: Optional[float]) -> None:
+    """Fija el presupuesto de tiempo que comparten todas las llamadas al LLM del turno."""
+    _DEADLINE.set(time.monotonic() + segundos if segundos and segundos > 0 else None)
+
+
+def presupuesto_restante() -> Optional[float]:
+    """Segundos que le quedan al turno actual (None si no hay presupuesto fijado)."""
+    deadline = _DEADLINE.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+class CircuitBreaker:
+    """Circuit breaker del backend LLM (cerrado -> abierto -> semiabierto).
+
+    Tras `umbral` fallos seguidos (timeouts, errores de red o codigos reintentables)
+    se abre y rechaza las llamadas durante `enfriamiento` segundos; luego deja pasar
+    una sola llamada de prueba: si sale bien se cierra, si falla vuelve a abrirse.
+    Thread-safe.
+    """
+
+    CERRADO = "cerrado"
+    ABIERTO = "abierto"
+    SEMIABIERTO = "semiabierto"
+
+    def __init__(self, umbral: int = DEFAULT_BREAKER_THRESHOLD, enfriamiento: float = DEFAULT_BREAKER_COOLDOWN):
+        self.umbral = max(1, umbral)
+        self.enfriamiento = enfriamiento
+        self.estado = self.CERRADO
+        self.fallos_seguidos = 0
+        self.aperturas = 0
+        self._abierto_desde = 0.0
+        self._prueba_en_curso = False
+        self._lock = threading.Lock()
+
+    def permitir(self) -> bool:
+        """True si la llamada puede salir (en semiabierto, solo la llamada de prueba)."""
+        with self._lock:
+            if self.estado == self.CERRADO:
+                return True
+            if self.estado == self.ABIERTO:
+                if time.monotonic() - self._abierto_desde < self.enfriamiento:
+                    return False
+                self.estado = self.SEMIABIERTO
+                self._prueba_en_curso = False
+            if self._prueba_en_curso:
+                return False
+            self._prueba_en_curso = True
+            return True
+
+    @property
+    def abierto(self) -> bool:
+        return self.estado == self.ABIERTO
+
+    def disponible(self) -> bool:
+        """Como permitir() pero sin reservar la llamada de prueba (solo consulta)."""
+        with self._lock:
+            if self.estado == self.CERRADO:
+                return True
+            if self.estado == self.ABIERTO:
+                return time.monotonic() - self._abierto_desde >= self.enfriamiento
+            return not self._prueba_en_curso
+
+    def registrar_exito(self) -> None:
+        with self._lock:
+            self.estado = self.CERRADO
+            self.fallos_seguidos = 0
+            self._prueba_en_curso = False
+
+    def liberar_prueba(self) -> None:
+        """La llamada termino sin resultado (cancelada o error inesperado): otra puede hacer la prueba."""
+        with self._lock:
+            if self.estado == self.SEMIABIERTO:
+                self._prueba_en_curso = False
+
+    def registrar_fallo(self) -> None:
+        with self._lock:
+            self.fallos_seguidos += 1
+            if self.estado == self.SEMIABIERTO or (
+                self.estado == self.CERRADO and self.fallos_seguidos >= self.umbral
+            ):
+                self.estado = self.ABIERTO
+                self._abierto_desde = time.monotonic()
+                self._prueba_en_curso = False
+                self.aperturas += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "estado": self.estado,
+                "fallos_seguidos": self.fallos_seguidos,
+                "aperturas": self.aperturas,
+            }
+
 
 class LLMClient:
-    def __init__(self, api_key: str, model: str, api_url: str = OPENAI_API_URL):
+    def __init__(
+        self,
+        api_key: str,
+        model: str,
+        api_url: str = OPENAI_API_URL,
+        pool_size: int = DEFAULT_POOL_SIZE,
+        connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+        read_timeout: float = DEFAULT_READ_TIMEOUT,
+        turn_budget: Optional[float] = DEFAULT_TURN_BUDGET,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        retry_backoff: float = DEFAULT_RETRY_BACKOFF,
+        breaker: Optional[CircuitBreaker] = None,
+    ):
         self.api_key = api_key
         self.model = model
         self.api_url = api_url
+        self.pool_size = max(1, pool_size)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        # Presupuesto por turno: lo fija el dialog_manager (iniciar_presupuesto) al empezar cada turno
+        self.turn_budget = turn_budget
+        self.max_retries = max(0, max_retries)
+        self.retry_backoff = retry_backoff
+        self.breaker = breaker or CircuitBreaker()
+        # Contadores: los incrementan hilos del threadpool a la vez, con su lock como el breaker
+        self.retries = 0
+        self.short_circuits = 0
+        self.budget_exhausted = 0
+        self._lock = threading.Lock()
+        self._session = self._crear_sesion()
+        # Pool asincrono (httpx) para la ruta async de la API; se crea al primer uso
+        self._async_client: Optional[httpx.AsyncClient] = None
 
-    def chat(
+    def _crear_sesion(self) -> requests.Session:
+        """Crea una sesion HTTP con pool acotado y keep-alive.
+
+        El pool es thread-safe (urllib3) y con pool_block=True nunca abre mas de
+        `pool_size` conexiones simultaneas: los hilos extra esperan una libre.
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.pool_size,
+            pool_block=True,
+            max_retries=0,
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update(
+            {
+                "Authorization": f"Bearer {self.api_key}",
+                "Content-Type": "application/json",
+            }
+        )
+        return session
+
+    def warmup(self, conexiones: int = 1) -> int:
+        """Abre conexiones (TCP+TLS) por adelantado para que el primer turno no pague el handshake.
+
+        Devuelve cuantas conexiones quedaron abiertas en el pool.
+        """
+        conexiones = max(1, min(conexiones, self.pool_size))
+
+        def _abrir(_: int) -> bool:
+            try:
+                # Cualquier respuesta HTTP (404/405 incluidos) deja la conexion viva en el pool
+                self._session.head(
+                    self.api_url, timeout=(self.connect_timeout, self.connect_timeout)
+                )
+                return True
+            except requests.RequestException:
+                return False
+
+        with ThreadPoolExecutor(max_workers=conexiones) as executor:
+            return sum(executor.map(_abrir, range(conexiones)))
+
+    def close(self) -> None:
+        """Cierra las conexiones del pool."""
+        self._session.close()
+
+    def _build_payload(
         self,
         messages: List[Dict[str, str]],
         response_format: Optional[Dict[str, str]] = None,
-    ) -> Optional[str]:
-        """Envia un chat completion a OpenAI y devuelve el contenido del mensaje del asistente.
-
-        Devuelve None en caso de error o respuesta inesperada.
-        """
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json",
-        }
+        max_tokens: Optional[int] = None,
+    ) -> Dict[str, Any]:
         payload: Dict[str, Any] = {
             "model": self.model,
             "messages": messages,
-            "max_tokens": 200,
+            "max_tokens": max_tokens or DEFAULT_MAX_TOKENS,
         }
         if response_format:
             payload["response_format"] = response_format
+        return payload
+
+    @staticmethod
+    def _extract_content(data: Dict[str, Any]) -> Optional[str]:
+        return (
+            data.get("choices", [{}])[0]
+            .get("message", {})
+            .get("content")
+        )
+
+    def disponible(self) -> bool:
+        """False mientras el circuit breaker esta abierto (el NLU usa entonces solo reglas)."""
+        return self.breaker.disponible()
 
+    def _timeout_intento(self) -> Optional[Tuple[float, float]]:
+        """(connect, read) para el proximo intento, recortados al presupuesto del turno.
+
+        None si no hay que llamar: presupuesto agotado o circuito abierto.
+        """
+        restante = presupuesto_restante()
+        if restante is not None and restante <= 0:
+            with self._lock:
+                self.budget_exhausted += 1
+            return None
+        if not self.breaker.permitir():
+            with self._lock:
+                self.short_circuits += 1
+            return None
+        lectura = self.read_timeout if restante is None else min(self.read_timeout, restante)
+        return min(self.connect_timeout, lectura), lectura
+
+    def _espera_reintento(self, intento: int, reintentable: bool) -> Optional[float]:
+        """Segundos a esperar antes de reintentar (backoff exponencial con jitter) o None si no se reintenta."""
+        if not reintentable or intento >= self.max_retries or self.breaker.abierto:
+            return None
+        espera = self.retry_backoff * (2 ** intento) * random.uniform(0.5, 1.5)
+        restante = presupuesto_restante()
+        if restante is not None and espera >= restante:
+            return None
+        with self._lock:
+            self.retries += 1
+        registrar_reintento_llm()
+        return espera
+
+    def _resultado_http(self, status_code: int) -> bool:
+        """Actualiza el breaker segun el codigo HTTP. Devuelve si el error es reintentable."""
+        if status_code in RETRYABLE_STATUS:
+            self.breaker.registrar_fallo()
+            return True
+        # 200 u otros 4xx: el backend respondio, no cuenta como caida
+        self.breaker.registrar_exito()
+        return False
+
+    def _leer_respuesta(self, response: Any) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+        """(contenido, usage) de una respuesta 200; (None, None) si el cuerpo no es el esperado.
+
+        Un cuerpo invalido no se reintenta ni cuenta como caida (el backend respondio).
+        Va aparte del manejo de errores de red: en requests, JSONDecodeError tambien
+        es un RequestException.
+        """
         try:
-            response = requests.post(
-                self.api_url, headers=headers, json=payload, timeout=30
-            )
+            data = response.json()
+            return self._extract_content(data), data.get("usage")
+        except (ValueError, AttributeError, IndexError, TypeError):
+            return None, None
+
+    def chat(
+        self,
+        messages: List[Dict[str, str]],
+        response_format: Optional[Dict[str, str]] = None,
+        max_tokens: Optional[int] = None,
+    ) -> Optional[str]:
+        """Envia un chat completion a OpenAI y devuelve el contenido del mensaje del asistente.
+
+        Reintenta (con jitter) solo errores reintentables y mientras quede presupuesto
+        del turno. Devuelve None en caso de error, respuesta inesperada, presupuesto
+        agotado o circuito abierto.
+        """
+        payload = self._build_payload(messages, response_format, max_tokens)
+        intento = 0
+        while True:
+            timeout = self._timeout_intento()
+            if timeout is None:
+                return None
+            contenido, reintentable = self._intentar(payload, timeout)
+            espera = self._espera_reintento(intento, reintentable)
+            if espera is None:
+                return contenido
+            time.sleep(espera)
+            intento += 1
+
+    def _intentar(self, payload: Dict[str, Any], timeout: Tuple[float, float]) -> Tuple[Optional[str], bool]:
+        """Un intento HTTP. Devuelve (contenido, reintentable)."""
+        _LLM_CALLS.set(_LLM_CALLS.get() + 1)
+        inicio = time.perf_counter()
+        status, usage = "error", None
+        try:
+            response = self._session.post(self.api_url, json=payload, timeout=timeout)
+            status = str(response.status_code)
             if response.status_code != 200:
+                return None, self._resultado_http(response.status_code)
+            self.breaker.registrar_exito()
+            contenido, usage = self._leer_respuesta(response)
+            return contenido, False
+        except requests.RequestException:
+            # Timeouts y errores de conexion
+            self.breaker.registrar_fallo()
+            return None, True
+        except BaseException:
+            # Sin resultado: si era la llamada de prueba del breaker no puede quedar tomada
+            self.breaker.liberar_prueba()
+            raise
+        finally:
+            registrar_llamada_llm(status, time.perf_counter() - inicio, usage)
+
+    def _get_async_client(self) -> httpx.AsyncClient:
+        if self._async_client is None:
+            self._async_client = httpx.AsyncClient(
+                headers=self._session.headers.copy(),
+                timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(
+                    max_connections=self.pool_size,
+                    max_keepalive_connections=self.pool_size,
+                ),
+            )
+        return self._async_client
+
+    async def achat(
+        self,
+        messages: List[Dict[str, str]],
+        response_format: Optional[Dict[str, str]] = None,
+        max_tokens: Optional[int] = None,
+    ) -> Optional[str]:
+        """Version asincrona de chat() (pool httpx propio, mismas reglas de error y reintento)."""
+        payload = self._build_payload(messages, response_format, max_tokens)
+        intento = 0
+        while True:
+            timeout = self._timeout_intento()
+            if timeout is None:
                 return None
-            data = response.json()
-            return (
-                data.get("choices", [{}])[0]
-                .get("message", {})
-                .get("content")
+            contenido, reintentable = await self._aintentar(payload, timeout)
+            espera = self._espera_reintento(intento, reintentable)
+            if espera is None:
+                return contenido
+            await asyncio.sleep(espera)
+            intento += 1
+
+    async def _aintentar(
+        self, payload: Dict[str, Any], timeout: Tuple[float, float]
+    ) -> Tuple[Optional[str], bool]:
+        _LLM_CALLS.set(_LLM_CALLS.get() + 1)
+        inicio = time.perf_counter()
+        status, usage = "error", None
+        try:
+            response = await self._get_async_client().post(
+                self.api_url, json=payload, timeout=httpx.Timeout(timeout[1], connect=timeout[0])
             )
-        except (requests.RequestException, ValueError):
-            return None
+            status = str(response.status_code)
+            if response.status_code != 200:
+                return None, self._resultado_http(response.status_code)
+            self.breaker.registrar_exito()
+            contenido, usage = self._leer_respuesta(response)
+            return contenido, False
+        except httpx.HTTPError:
+            self.breaker.registrar_fallo()
+            return None, True
+        except BaseException:
+            # Tarea cancelada (cliente desconectado, timeout del turno...): libera la prueba del breaker
+            self.breaker.liberar_prueba()
+            raise
+        finally:
+            registrar_llamada_llm(status, time.perf_counter() - inicio, usage)
+
+    async def awarmup(self, conexiones: int = 1) -> int:
+        """Version asincrona de warmup() para el pool httpx."""
+        conexiones = max(1, min(conexiones, self.pool_size))
+        client = self._get_async_client()
+
+        async def _abrir() -> bool:
+            try:
+                await client.head(self.api_url, timeout=self.connect_timeout)
+                return True
+            except httpx.HTTPError:
+                return False
+
+        resultados = await asyncio.gather(*(_abrir() for _ in range(conexiones)))
+        return sum(resultados)
+
+    async def aclose(self) -> None:
+        """Cierra el pool asincrono y el sincrono."""
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+        self.close()
+
+    def stats(self) -> Dict[str, Any]:
+        """Estado del circuit breaker y contadores de reintentos / llamadas evitadas."""
+        return {
+            "breaker": self.breaker.stats(),
+            "retries": self.retries,
+            "short_circuits": self.short_circuits,
+            "budget_exhausted": self.budget_exhausted,
+        }
@@ -0,0 +1,391 @@
+﻿import argparse
+import glob
+import hashlib
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+try:  # Bloqueo entre procesos (POSIX). En Windows se omite.
+    import fcntl
+except ImportError:  # pragma: no cover - depende de la plataforma
+    fcntl = None  # type: ignore[assignment]
+
+INDICE_SUFIJO = ".idx"
+# Archivos junto al log que no son segmentos (indices, lock de escritura, temporales)
+SUFIJOS_AUXILIARES = (INDICE_SUFIJO, ".lock", ".tmp")
+
+# Entrada del indice: clave de la sesion (8 bytes de blake2b), offset y largo de la linea
+_ENTRADA = struct.Struct("<8sQI")
+_CLAVE = 8
+# Bloque de entradas que se lee por vez al recorrer el indice del segmento activo
+_BLOQUE_INDICE = _ENTRADA.size * 65536
+
+# Entradas del segmento activo que se guardan en memoria. Sin rotacion el segmento crece
+# sin cota: pasado el limite cada consulta recorre `<log>.idx` por bloques (mas lenta,
+# memoria acotada). Con LOG_ROTATE_BYTES/LOG_ROTATE_SECONDS no se llega al limite
+MAX_ENTRADAS_ACTIVO = int(os.environ.get("LOG_INDEX_MAX_ACTIVE", 1_000_000))
+
+# Sufijo de un segmento rotado: <YYYYmmddTHHMMSS> y -<n> si ya habia otro en ese segundo
+_SUFIJO_SEGMENTO = re.compile(r"(\d{8}T\d{6})(?:-(\d+))?")
+
+
+def clave_sesion(session_id: str) -> bytes:
+    return hashlib.blake2b(session_id.encode("utf-8"), digest_size=_CLAVE).digest()
+
+
+def entradas_indice(offset: int, lineas: List[Tuple[str, bytes]]) -> bytes:
+    """Entradas para (session_id, linea) escritas de corrido en el log a partir de `offset`."""
+    partes = []
+    for session_id, linea in lineas:
+        partes.append(_ENTRADA.pack(clave_sesion(session_id), offset, len(linea)))
+        offset += len(linea)
+    return b"".join(partes)
+
+
+def anexar_indice(log_path: str, offset: int, lineas: List[Tuple[str, bytes]]) -> None:
+    """Agrega al indice del log las lineas recien escritas (el llamador tiene el lock del log)."""
+    with open(log_path + INDICE_SUFIJO, "ab") as f:
+        f.write(entradas_indice(offset, lineas))
+
+
+def _escribir_ordenado(destino: str, datos: bytes) -> None:
+    completos = len(datos) - len(datos) % _ENTRADA.size
+    entradas = sorted(datos[i:i + _ENTRADA.size] for i in range(0, completos, _ENTRADA.size))
+    # Temporal propio: el escritor y un lector pueden sellar el mismo segmento a la vez
+    tmp = f"{destino}{INDICE_SUFIJO}.{os.getpid()}-{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(b"".join(entradas))
+    os.replace(tmp, destino + INDICE_SUFIJO)
+
+
+def sellar_indice(log_path: str, segmento: str) -> None:
+    """Tras rotar `log_path` a `segmento`: su indice pasa al segmento ordenado por clave (busqueda binaria).
+
+    Las lineas que no estaban en el indice (escritas antes de que existiera o por
+    un proceso sin indice) se indexan recorriendo esos tramos del segmento.
+    """
+    try:
+        with open(log_path + INDICE_SUFIJO, "rb") as f:
+            datos = f.read()
+    except FileNotFoundError:
+        return
+    entradas = _completar_huecos(segmento, datos)
+    _escribir_ordenado(segmento, b"".join(_ENTRADA.pack(*entrada) for entrada in entradas))
+    os.remove(log_path + INDICE_SUFIJO)
+
+
+def _indexar_lineas(
+    path: str, desde: int = 0, hasta: Optional[int] = None
+) -> Tuple[List[Tuple[bytes, int, int]], int]:
+    """(clave, offset, largo) de las lineas completas de `path` entre `desde` y `hasta` (o el final) y el offset final."""
+    entradas: List[Tuple[bytes, int, int]] = []
+    offset = desde
+    with open(path, "rb") as f:
+        f.seek(desde)
+        for raw in f:
+            if hasta is not None and offset >= hasta:
+                break
+            if not raw.endswith(b"\n"):
+                break  # escritura a medias
+            try:
+                session_id = json.loads(raw).get("session_id")
+            except ValueError:
+                session_id = None
+            if isinstance(session_id, str):
+                entradas.append((clave_sesion(session_id), offset, len(raw)))
+            offset += len(raw)
+    return entradas, offset
+
+
+def _completar_huecos(path: str, datos: bytes) -> List[Tuple[bytes, int, int]]:
+    """Entradas de un indice en orden de escritura mas las de las lineas de `path` que no estan
+    en el: antes de la primera entrada (log previo al indice), entre entradas y al final."""
+    completos = len(datos) - len(datos) % _ENTRADA.size
+    entradas: List[Tuple[bytes, int, int]] = []
+    cubierto = 0
+    for clave, offset, largo in _ENTRADA.iter_unpack(datos[:completos]):
+        if offset > cubierto:
+            entradas.extend(_indexar_lineas(path, cubierto, offset)[0])
+        entradas.append((clave, offset, largo))
+        cubierto = max(cubierto, offset + largo)
+    entradas.extend(_indexar_lineas(path, cubierto)[0])
+    return entradas
+
+
+def reconstruir_indice_activo(log_path: str) -> int:
+    """Rehace `<log>.idx` del log que se sigue escribiendo (en orden de escritura), con el lock
+    del log tomado. Incluye las lineas previas al indice. Devuelve las entradas."""
+    with open(log_path + ".lock", "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            with open(log_path + INDICE_SUFIJO, "rb") as f:
+                datos = f.read()
+        except FileNotFoundError:
+            datos = b""
+        entradas = _completar_huecos(log_path, datos)
+        tmp = f"{log_path}{INDICE_SUFIJO}.{os.getpid()}-{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(b"".join(_ENTRADA.pack(*entrada) for entrada in entradas))
+        os.replace(tmp, log_path + INDICE_SUFIJO)
+    return len(entradas)
+
+
+def reconstruir_indice(segmento: str) -> int:
+    """Indice ordenado de un segmento rotado recorriendo el archivo (logs previos al indice). Devuelve las entradas."""
+    entradas, _ = _indexar_lineas(segmento)
+    _escribir_ordenado(segmento, b"".join(_ENTRADA.pack(*entrada) for entrada in entradas))
+    return len(entradas)
+
+
+def _orden_segmento(log_path: str, segmento: str) -> Tuple[str, int]:
+    """(timestamp, n) del sufijo: "-10" va despues de "-2" (el orden de los nombres no sirve)."""
+    sufijo = segmento[len(log_path) + 1:]
+    m = _SUFIJO_SEGMENTO.fullmatch(sufijo)
+    if m is None:
+        return sufijo, 0
+    return m.group(1), int(m.group(2) or 0)
+
+
+def segmentos_log(log_path: str) -> List[str]:
+    """Segmentos rotados (logs.jsonl.<YYYYmmddTHHMMSS>[-n], del mas viejo al mas nuevo) y el log actual al final."""
+    rotados = sorted(
+        (
+            path
+            for path in glob.glob(glob.escape(log_path) + ".*")
+            if not path.endswith(SUFIJOS_AUXILIARES)
+        ),
+        key=lambda path: _orden_segmento(log_path, path),
+    )
+    return rotados + ([log_path] if os.path.exists(log_path) else [])
+
+
+def _buscar_ordenado(segmento: str, clave: bytes) -> List[Tuple[int, int]]:
+    """(offset, largo) de la clave en el indice ordenado del segmento: busqueda binaria sobre un mmap."""
+    if not os.path.exists(segmento + INDICE_SUFIJO):
+        reconstruir_indice(segmento)
+    with open(segmento + INDICE_SUFIJO, "rb") as f:
+        total = os.fstat(f.fileno()).st_size // _ENTRADA.size
+        if total == 0:
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as datos:
+            inicio, fin = 0, total
+            while inicio < fin:
+                medio = (inicio + fin) // 2
+                posicion = medio * _ENTRADA.size
+                if datos[posicion:posicion + _CLAVE] < clave:
+                    inicio = medio + 1
+                else:
+                    fin = medio
+            encontradas: List[Tuple[int, int]] = []
+            while inicio < total:
+                entrada_clave, offset, largo = _ENTRADA.unpack_from(datos, inicio * _ENTRADA.size)
+                if entrada_clave != clave:
+                    break
+                encontradas.append((offset, largo))
+                inicio += 1
+    # El orden de bytes de la entrada no ordena los offsets (little-endian)
+    return sorted(encontradas)
+
+
+def _recorrer_activo(log_path: str, clave: bytes) -> List[Tuple[int, int]]:
+    """(offset, largo) de la clave recorriendo por bloques el indice sin ordenar del segmento
+    activo, mas la cola del log que aun no esta en el indice."""
+    posiciones: Dict[int, int] = {}
+    cubierto = 0
+    try:
+        with open(log_path + INDICE_SUFIJO, "rb") as f:
+            while True:
+                bloque = f.read(_BLOQUE_INDICE)
+                bloque = bloque[: len(bloque) - len(bloque) % _ENTRADA.size]
+                if not bloque:
+                    break
+                for entrada_clave, offset, largo in _ENTRADA.iter_unpack(bloque):
+                    if offset > cubierto:
+                        # Lineas sin indice (previas al .idx o de un proceso sin indice)
+                        entradas, _ = _indexar_lineas(log_path, cubierto, offset)
+                        posiciones.update((o, n) for c, o, n in entradas if c == clave)
+                    cubierto = max(cubierto, offset + largo)
+                    if entrada_clave == clave:
+                        posiciones[offset] = largo
+    except FileNotFoundError:
+        pass
+    entradas, _ = _indexar_lineas(log_path, cubierto)
+    posiciones.update((offset, largo) for entrada_clave, offset, largo in entradas if entrada_clave == clave)
+    return sorted(posiciones.items())
+
+
+class _IndiceActivo:
+    """Indice en memoria del segmento que se sigue escribiendo.
+
+    Lee solo lo agregado a `<log>.idx` desde la ultima consulta y, si el log va
+    por delante del indice (lote escrito pero aun no indexado, o escrito por un
+    proceso sin indice), indexa en memoria esa cola del log; lo mismo con los
+    tramos que quedan antes o entre entradas del indice. Guarda a lo sumo
+    `max_entradas` lineas: pasado ese limite libera la memoria y cada consulta
+    recorre el indice del archivo (ver MAX_ENTRADAS_ACTIVO).
+    """
+
+    def __init__(self, max_entradas: int = MAX_ENTRADAS_ACTIVO) -> None:
+        self.max_entradas = max_entradas
+        self._reiniciar(None)
+
+    def _reiniciar(self, inodo: Optional[int]) -> None:
+        self.inodo = inodo
+        self.leido_indice = 0
+        self.indexado_log = 0
+        self.entradas = 0
+        self.desbordado = False
+        self.posiciones: Dict[bytes, Dict[int, int]] = {}
+
+    def buscar(self, log_path: str, clave: bytes) -> List[Tuple[int, int]]:
+        try:
+            estado = os.stat(log_path)
+        except FileNotFoundError:
+            return []
+        if estado.st_ino != self.inodo or estado.st_size < self.indexado_log:
+            # Rotado o truncado: se empieza de cero con el archivo nuevo
+            self._reiniciar(estado.st_ino)
+        if self.desbordado:
+            return _recorrer_activo(log_path, clave)
+        try:
+            with open(log_path + INDICE_SUFIJO, "rb") as f:
+                f.seek(self.leido_indice)
+                cola = f.read()
+        except FileNotFoundError:
+            cola = b""
+        cola = cola[: len(cola) - len(cola) % _ENTRADA.size]
+        self.leido_indice += len(cola)
+        for entrada_clave, offset, largo in _ENTRADA.iter_unpack(cola):
+            if offset > self.indexado_log:
+                # Lineas que no estan en el indice (el log es previo al .idx o las escribio
+                # un proceso sin indice): se indexan recorriendo ese tramo del log
+                entradas, _ = _indexar_lineas(log_path, self.indexado_log, offset)
+                for entrada in entradas:
+                    self._agregar(*entrada)
+            self._agregar(entrada_clave, offset, largo)
+        if estado.st_size > self.indexado_log:
+            entradas, _ = _indexar_lineas(log_path, self.indexado_log)
+            for entrada in entradas:
+                self._agregar(*entrada)
+        posiciones = sorted(self.posiciones.get(clave, {}).items())
+        if self.entradas > self.max_entradas:
+            self.desbordado = True
+            self.posiciones = {}
+        return posiciones
+
+    def _agregar(self, clave: bytes, offset: int, largo: int) -> None:
+        self.posiciones.setdefault(clave, {})[offset] = largo
+        self.indexado_log = max(self.indexado_log, offset + largo)
+        self.entradas += 1
+
+
+class IndiceTranscripts:
+    """Busqueda de los turnos de una sesion en el log y sus segmentos rotados sin recorrerlos.
+
+    Costo por consulta: una busqueda binaria por segmento rotado, lo nuevo del
+    indice del segmento activo y una lectura por turno de la sesion.
+    """
+
+    def __init__(self, log_path: str):
+        self.log_path = log_path
+        self._activo = _IndiceActivo()
+        self._lock = threading.Lock()
+
+    def transcript(self, session_id: str) -> List[Dict[str, Any]]:
+        """Turnos de la sesion en el orden en que se escribieron (vacio si no hay)."""
+        clave = clave_sesion(session_id)
+        turnos: List[Dict[str, Any]] = []
+        for segmento in segmentos_log(self.log_path):
+            if segmento == self.log_path:
+                with self._lock:
+                    posiciones = self._activo.buscar(segmento, clave)
+            else:
+                posiciones = _buscar_ordenado(segmento, clave)
+            if posiciones:
+                turnos.extend(_leer_turnos(segmento, posiciones, session_id))
+        return turnos
+
+
+def _leer_turnos(segmento: str, posiciones: List[Tuple[int, int]], session_id: str) -> List[Dict[str, Any]]:
+    turnos = []
+    with open(segmento, "rb") as f:
+        for offset, largo in posiciones:
+            f.seek(offset)
+            try:
+                registro = json.loads(f.read(largo))
+            except ValueError:
+                continue
+            # La clave es un hash de 8 bytes: se confirma el session_id
+            if isinstance(registro, dict) and registro.get("session_id") == session_id:
+                turnos.append(registro)
+    return turnos
+
+
+_INDICES: Dict[str, IndiceTranscripts] = {}
+_INDICES_LOCK = threading.Lock()
+
+
+def get_indice(log_path: str) -> IndiceTranscripts:
+    """Indice del proceso para `log_path` (conserva lo ya leido del segmento activo entre consultas)."""
+    clave = os.path.abspath(log_path)
+    with _INDICES_LOCK:
+        indice = _INDICES.get(clave)
+        if indice is None:
+            indice = _INDICES[clave] = IndiceTranscripts(log_path)
+        return indice
+
+
+def transcript_sesion(session_id: str, log_path: str) -> List[Dict[str, Any]]:
+    return get_indice(log_path).transcript(session_id)
+
+
+def _imprimir_turno(registro: Dict[str, Any]) -> None:
+    print(f"[{registro.get('turno')}] {registro.get('timestamp')} {registro.get('paso')}")
+    print(f"  Usuario: {registro.get('usuario_texto')}")
+    print(f"  Bot: {registro.get('bot_texto')}")
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    from src.controllers.logging_utils import DEFAULT_LOG_PATH
+
+    parser = argparse.ArgumentParser(description="Conversacion de una sesion desde el log JSONL usando su indice.")
+    parser.add_argument("session_id", nargs="?", help="session_id a buscar")
+    parser.add_argument("--log", default=os.environ.get("LOG_PATH", DEFAULT_LOG_PATH), help="ruta del log JSONL")
+    parser.add_argument("--json", action="store_true", help="imprime los turnos como JSONL")
+    parser.add_argument(
+        "--reindexar",
+        action="store_true",
+        help="reconstruye los indices del log y de sus segmentos rotados (logs escritos antes del indice)",
+    )
+    args = parser.parse_args(argv)
+
+    if args.reindexar:
+        for segmento in segmentos_log(args.log):
+            if segmento == args.log:
+                print(f"{segmento}: {reconstruir_indice_activo(segmento)} turnos indexados")
+            else:
+                print(f"{segmento}: {reconstruir_indice(segmento)} turnos indexados")
+    if not args.session_id:
+        if not args.reindexar:
+            parser.error("falta session_id")
+        return
+
+    turnos = transcript_sesion(args.session_id, args.log)
+    if not turnos:
+        print(f"No hay turnos para la sesion {args.session_id}.", file=sys.stderr)
+        sys.exit(1)
+    for registro in turnos:
+        if args.json:
+            print(json.dumps(registro, ensure_ascii=False))
+        else:
+            _imprimir_turno(registro)
+
+
+if __name__ == "__main__":
+    main()
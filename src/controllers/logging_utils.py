@@ -1,17 +1,39 @@
 ﻿import datetime
 import json
-from typing import Optional
+import os
+import queue
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
 
+from src.controllers.log_index import anexar_indice, sellar_indice
+from src.controllers.metrics import cronometrado
 from src.models.domain import ConversationState
 
+try:  # Bloqueo entre procesos (POSIX). En Windows se omite.
+    import fcntl
+except ImportError:  # pragma: no cover - depende de la plataforma
+    fcntl = None  # type: ignore[assignment]
+
+DEFAULT_LOG_PATH = "logs.jsonl"
+
 
 def log_turno(
     usuario_texto: str,
     bot_texto: str,
     state: ConversationState,
-    log_path: str = "logs.jsonl",
+    log_path: Optional[str] = None,
 ) -> None:
-    """Persistencia JSONL de cada turno con session_id y contador de turno."""
+    """Persistencia JSONL de cada turno con session_id y contador de turno.
+
+    Si hay un BufferedTurnLogger activo (y log_path es el suyo o no se indica), el
+    turno se encola y lo escribe el hilo de fondo; si no, se escribe directamente.
+    """
+    escribir_registros([registro_turno(usuario_texto, bot_texto, state)], log_path)
+
+
+def registro_turno(usuario_texto: str, bot_texto: str, state: ConversationState) -> Dict[str, Any]:
+    """Arma el registro JSONL del turno (avanza el contador de turno de la sesion)."""
     registro = {
         "session_id": state.session_id,
         "turno": state.next_turn(),
@@ -20,7 +42,276 @@ def log_turno(
         "memoria": state.memory.to_dict(),
         "intencion": state.intent.value if state.intent else None,
         "paso": state.step.name,
+        "llamadas_llm": state.llm_calls,
         "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
     }
-    with open(log_path, "a", encoding="utf-8") as f:
-        f.write(json.dumps(registro, ensure_ascii=False) + "\n")
+    if state.duraciones_ms:
+        registro["duraciones_ms"] = state.duraciones_ms
+    return registro
+
+
+@cronometrado("log_turno")
+def escribir_registros(registros: List[Dict[str, Any]], log_path: Optional[str] = None) -> None:
+    """Escribe varios turnos juntos: un solo item en la cola del logger buffered o un solo write."""
+    if not registros:
+        return
+    logger = _TURN_LOGGER
+    if logger is not None and log_path in (None, logger.log_path):
+        logger.submit_many(registros)
+        return
+    log_path = log_path or DEFAULT_LOG_PATH
+    lineas = [_linea(registro) for registro in registros]
+    with open(log_path + ".lock", "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        with open(log_path, "ab") as f:
+            offset = f.seek(0, os.SEEK_END)
+            f.write(b"".join(linea for _, linea in lineas))
+        anexar_indice(log_path, offset, lineas)
+
+
+def ruta_log_activa() -> str:
+    """Log al que van los turnos: el del logger buffered si esta activo, si no DEFAULT_LOG_PATH."""
+    logger = _TURN_LOGGER
+    return logger.log_path if logger is not None else DEFAULT_LOG_PATH
+
+
+def _linea(registro: Dict[str, Any]) -> Tuple[str, bytes]:
+    """(session_id, linea JSONL) del turno: el indice de transcripts necesita ambos."""
+    return registro.get("session_id") or "", (json.dumps(registro, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+class BufferedTurnLogger:
+    """Escritor JSONL en segundo plano: encola turnos y los escribe por lotes.
+
+    - Vacia el lote al llegar a `batch_size` registros, cada `flush_interval` segundos
+      y al detenerse (stop()).
+    - Cola acotada: con policy="drop" los turnos que no caben se descartan (y se
+      cuentan en `dropped`); con policy="block" el productor espera hasta
+      `block_timeout` segundos antes de descartar.
+    - Mantiene un solo descriptor abierto (O_APPEND) y escribe cada lote con un
+      unico write bajo un flock del archivo `<log_path>.lock`, asi varios workers
+      pueden compartir el directorio sin intercalar lineas.
+    - Rotacion opcional por tamano (`rotate_bytes`) o por tiempo (`rotate_interval`,
+      contado desde el timestamp del primer turno del archivo: el mismo para todos
+      los workers que lo comparten): el archivo actual se renombra a
+      `<log_path>.<YYYYmmddTHHMMSS>`.
+    - Cada lote agrega sus offsets al indice `<log_path>.idx` (session_id -> lineas),
+      que al rotar pasa ordenado al segmento (ver log_index).
+    """
+
+    def __init__(
+        self,
+        log_path: str = DEFAULT_LOG_PATH,
+        max_queue: int = 10_000,
+        batch_size: int = 100,
+        flush_interval: float = 1.0,
+        policy: str = "drop",
+        block_timeout: Optional[float] = None,
+        rotate_bytes: Optional[int] = None,
+        rotate_interval: Optional[float] = None,
+    ):
+        if policy not in ("drop", "block"):
+            raise ValueError("policy debe ser 'drop' o 'block'")
+        self.log_path = log_path
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.rotate_bytes = rotate_bytes
+        self.rotate_interval = rotate_interval
+        self.dropped = 0
+        self.written = 0
+        # Cada item es un turno o una lista de turnos que se escriben en el mismo lote
+        self._queue: "queue.Queue[Optional[Any]]" = queue.Queue(maxsize=max_queue)
+        self._thread: Optional[threading.Thread] = None
+        self._detener = threading.Event()
+        self._fd: Optional[int] = None
+        self._inicio: Optional[Tuple[int, float]] = None  # (inodo, epoch del primer turno)
+
+    # --- Productores -------------------------------------------------------------------
+
+    def submit(self, registro: Dict[str, Any]) -> bool:
+        """Encola un turno. Devuelve False si se descarto por cola llena."""
+        return self._encolar(registro, 1)
+
+    def submit_many(self, registros: List[Dict[str, Any]]) -> bool:
+        """Encola varios turnos como un solo item: se escriben juntos en el mismo lote."""
+        return self._encolar(list(registros), len(registros))
+
+    def _encolar(self, item: Any, cantidad: int) -> bool:
+        try:
+            if self.policy == "block":
+                self._queue.put(item, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(item)
+            return True
+        except queue.Full:
+            self.dropped += cantidad
+            return False
+
+    # --- Ciclo de vida -----------------------------------------------------------------
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._detener.clear()
+        self._thread = threading.Thread(target=self._run, name="turn-logger", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = 10.0) -> None:
+        """Vacia lo pendiente, cierra el archivo y detiene el hilo (espera a lo sumo `timeout`)."""
+        if self._thread is None:
+            return
+        limite = None if timeout is None else time.monotonic() + timeout
+        self._detener.set()
+        try:
+            # Centinela: se procesa despues de todo lo ya encolado. Con la cola llena no se
+            # espera mas de `timeout`; el hilo igual termina al vaciarla (ve el evento)
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(None if limite is None else max(0.0, limite - time.monotonic()))
+        self._thread = None
+
+    def _run(self) -> None:
+        lote: List[Tuple[str, bytes]] = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                registro = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                if registro is None:
+                    self._flush(lote)
+                    self._close()
+                    return
+                if isinstance(registro, list):
+                    lote.extend(_linea(r) for r in registro)
+                else:
+                    lote.append(_linea(registro))
+            except queue.Empty:
+                if self._detener.is_set():
+                    self._flush(lote)
+                    self._close()
+                    return
+            if len(lote) >= self.batch_size or time.monotonic() >= deadline:
+                self._flush(lote)
+                lote = []
+                deadline = time.monotonic() + self.flush_interval
+
+    # --- Escritura y rotacion ----------------------------------------------------------
+
+    def _flush(self, lote: List[Tuple[str, bytes]]) -> None:
+        if not lote:
+            return
+        data = b"".join(linea for _, linea in lote)
+        try:
+            with open(self.log_path + ".lock", "a") as lock_file:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                self._ensure_open()
+                if self._debe_rotar(len(data)):
+                    self._rotar()
+                # Con el lock tomado nadie mas escribe: el lote empieza en el tamano actual
+                offset = os.fstat(self._fd).st_size  # type: ignore[arg-type]
+                os.write(self._fd, data)  # type: ignore[arg-type]
+                anexar_indice(self.log_path, offset, lote)
+            self.written += len(lote)
+        except OSError:
+            # El logging nunca debe tumbar la API: se descarta el lote y se cuenta
+            self.dropped += len(lote)
+
+    def _ensure_open(self) -> None:
+        """Abre el log o lo reabre si otro worker lo roto (el inodo ya no coincide)."""
+        if self._fd is not None:
+            try:
+                if os.stat(self.log_path).st_ino == os.fstat(self._fd).st_ino:
+                    return
+            except FileNotFoundError:
+                pass
+            self._close()
+        self._fd = os.open(self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def _debe_rotar(self, nuevos_bytes: int) -> bool:
+        tamano = os.fstat(self._fd).st_size  # type: ignore[arg-type]
+        if tamano == 0:
+            return False
+        if self.rotate_bytes and tamano + nuevos_bytes > self.rotate_bytes:
+            return True
+        if self.rotate_interval and time.time() - self._inicio_archivo() >= self.rotate_interval:
+            return True
+        return False
+
+    def _inicio_archivo(self) -> float:
+        """Epoch del primer turno del log abierto (se lee una vez por archivo, con el lock tomado).
+
+        No depende de cuando lo abrio este worker: un worker que arranca o reabre el
+        log tras una rotacion ajena no le reinicia la edad.
+        """
+        inodo = os.fstat(self._fd).st_ino  # type: ignore[arg-type]
+        if self._inicio is None or self._inicio[0] != inodo:
+            inicio = time.time()  # primera linea ilegible: se cuenta desde ahora
+            try:
+                with open(self.log_path, "rb") as f:
+                    primera = json.loads(f.readline())
+                inicio = datetime.datetime.fromisoformat(primera["timestamp"]).timestamp()
+            except (OSError, ValueError, TypeError, KeyError):
+                pass
+            self._inicio = (inodo, inicio)
+        return self._inicio[1]
+
+    def _rotar(self) -> None:
+        sufijo = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%S")
+        destino = f"{self.log_path}.{sufijo}"
+        n = 1
+        while os.path.exists(destino):
+            destino = f"{self.log_path}.{sufijo}-{n}"
+            n += 1
+        self._close()
+        os.replace(self.log_path, destino)
+        sellar_indice(self.log_path, destino)
+        self._ensure_open()
+
+    def _close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+_TURN_LOGGER: Optional[BufferedTurnLogger] = None
+
+
+def iniciar_logger_buffered(**kwargs: Any) -> BufferedTurnLogger:
+    """Activa el modo buffered de log_turno (un solo logger por proceso)."""
+    global _TURN_LOGGER
+    detener_logger_buffered()
+    logger = BufferedTurnLogger(**kwargs)
+    logger.start()
+    _TURN_LOGGER = logger
+    return logger
+
+
+def iniciar_logger_desde_entorno() -> Optional[BufferedTurnLogger]:
+    """Activa el modo buffered si LOG_MODE=buffered (parametros LOG_* del entorno)."""
+    if os.environ.get("LOG_MODE", "sync").lower() != "buffered":
+        return None
+    rotate_bytes = os.environ.get("LOG_ROTATE_BYTES")
+    rotate_seconds = os.environ.get("LOG_ROTATE_SECONDS")
+    block_timeout = os.environ.get("LOG_BLOCK_TIMEOUT")
+    return iniciar_logger_buffered(
+        log_path=os.environ.get("LOG_PATH", DEFAULT_LOG_PATH),
+        max_queue=int(os.environ.get("LOG_QUEUE_SIZE", 10_000)),
+        batch_size=int(os.environ.get("LOG_BATCH_SIZE", 100)),
+        flush_interval=float(os.environ.get("LOG_FLUSH_INTERVAL", 1.0)),
+        policy=os.environ.get("LOG_QUEUE_POLICY", "drop"),
+        block_timeout=float(block_timeout) if block_timeout else None,
+        rotate_bytes=int(rotate_bytes) if rotate_bytes else None,
+        rotate_interval=float(rotate_seconds) if rotate_seconds else None,
+    )
+
+
+def detener_logger_buffered() -> None:
+    """Vacia y detiene el logger buffered; log_turno vuelve a escribir directo."""
+    global _TURN_LOGGER
+    logger, _TURN_LOGGER = _TURN_LOGGER, None
+    if logger is not None:
+        logger.stop()
@@ -0,0 +1,231 @@
+﻿import functools
+import inspect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, TypeVar
+
+# METRICS_ENABLED=0 desactiva toda la instrumentacion (los decoradores devuelven la funcion tal cual)
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1").lower() not in ("0", "false", "no")
+
+METRIC_PREFIX = "agente_citas"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+def _escapar(valor: str) -> str:
+    return valor.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _formatear_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    pares = list(labels) + ([extra] if extra else [])
+    if not pares:
+        return ""
+    return "{" + ",".join(f'{k}="{_escapar(v)}"' for k, v in pares) + "}"
+
+
+def _formatear_valor(valor: float) -> str:
+    return repr(float(valor)) if valor != int(valor) else str(int(valor))
+
+
+class Counter:
+    """Contador monotono con labels (thread-safe)."""
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lineas = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, valor in items:
+            lineas.append(f"{self.name}{_formatear_labels(labels)} {_formatear_valor(valor)}")
+        return lineas
+
+
+class Histogram:
+    """Histograma acumulativo al estilo Prometheus (buckets fijos, sum y count por serie)."""
+
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [conteo por bucket..., suma, total]
+        self._series: Dict[Labels, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            serie = self._series.get(key)
+            if serie is None:
+                serie = self._series[key] = [0.0] * (len(self.buckets) + 2)
+            for i, limite in enumerate(self.buckets):
+                if value <= limite:
+                    serie[i] += 1
+                    break
+            serie[-2] += value
+            serie[-1] += 1
+
+    def render(self) -> List[str]:
+        lineas = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((labels, list(serie)) for labels, serie in self._series.items())
+        for labels, serie in items:
+            acumulado = 0.0
+            for limite, conteo in zip(self.buckets, serie):
+                acumulado += conteo
+                lineas.append(
+                    f"{self.name}_bucket{_formatear_labels(labels, ('le', repr(limite)))} "
+                    f"{_formatear_valor(acumulado)}"
+                )
+            lineas.append(
+                f"{self.name}_bucket{_formatear_labels(labels, ('le', '+Inf'))} {_formatear_valor(serie[-1])}"
+            )
+            lineas.append(f"{self.name}_sum{_formatear_labels(labels)} {serie[-2]!r}")
+            lineas.append(f"{self.name}_count{_formatear_labels(labels)} {_formatear_valor(serie[-1])}")
+        return lineas
+
+
+class MetricsRegistry:
+    """Conjunto de metricas del proceso, serializable en formato de texto de Prometheus."""
+
+    def __init__(self) -> None:
+        self._metrics: List[Any] = []
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        metric = Counter(name, help_text)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, help_text, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self, gauges: Optional[Dict[str, float]] = None) -> str:
+        """Texto de exposicion (version 0.0.4). `gauges` agrega valores instantaneos (nombre -> valor)."""
+        lineas: List[str] = []
+        for metric in self._metrics:
+            lineas.extend(metric.render())
+        for nombre, valor in (gauges or {}).items():
+            lineas.append(f"# TYPE {nombre} gauge")
+            lineas.append(f"{nombre} {_formatear_valor(valor)}")
+        return "\n".join(lineas) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    f"{METRIC_PREFIX}_stage_duration_seconds",
+    "Duracion de cada etapa del turno (llm, nlu_*, agente_citas, log_turno, registrar_cita).",
+)
+LLM_REQUESTS = REGISTRY.counter(
+    f"{METRIC_PREFIX}_llm_requests_total",
+    "Llamadas al LLM por codigo de estado HTTP ('error' si no hubo respuesta).",
+)
+LLM_RETRIES = REGISTRY.counter(
+    f"{METRIC_PREFIX}_llm_retries_total",
+    "Reintentos de llamadas al LLM (errores reintentables con presupuesto disponible).",
+)
+LLM_TOKENS = REGISTRY.counter(
+    f"{METRIC_PREFIX}_llm_tokens_total",
+    "Tokens reportados por la API del LLM (usage), por tipo.",
+)
+
+# Duraciones (ms) por etapa del turno actual; las lee el dialog_manager para el log JSONL
+_DURACIONES: ContextVar[Optional[Dict[str, float]]] = ContextVar("duraciones_turno", default=None)
+
+
+def reset_duraciones() -> None:
+    """Empieza a acumular las duraciones por etapa de un turno nuevo."""
+    if METRICS_ENABLED:
+        _DURACIONES.set({})
+
+
+def get_duraciones() -> Dict[str, float]:
+    """Duraciones en ms acumuladas desde el ultimo reset_duraciones() (vacio si no hay turno)."""
+    duraciones = _DURACIONES.get()
+    return {etapa: round(ms, 3) for etapa, ms in duraciones.items()} if duraciones else {}
+
+
+def observar(etapa: str, segundos: float) -> None:
+    """Registra la duracion de una etapa en el histograma y en las duraciones del turno."""
+    STAGE_SECONDS.observe(segundos, stage=etapa)
+    duraciones = _DURACIONES.get()
+    if duraciones is not None:
+        duraciones[etapa] = duraciones.get(etapa, 0.0) + segundos * 1000
+
+
+@contextmanager
+def medir(etapa: str) -> Iterator[None]:
+    """Mide el bloque como la etapa `etapa` (no hace nada con METRICS_ENABLED=0)."""
+    if not METRICS_ENABLED:
+        yield
+        return
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        observar(etapa, time.perf_counter() - inicio)
+
+
+def cronometrado(etapa: str) -> Callable[[F], F]:
+    """Decorador que mide cada llamada (funciones normales o corutinas) como la etapa `etapa`."""
+
+    def decorador(func: F) -> F:
+        if not METRICS_ENABLED:
+            return func
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def envoltura_async(*args: Any, **kwargs: Any) -> Any:
+                inicio = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    observar(etapa, time.perf_counter() - inicio)
+
+            return envoltura_async  # type: ignore[return-value]
+
+        @functools.wraps(func)
+        def envoltura(*args: Any, **kwargs: Any) -> Any:
+            inicio = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observar(etapa, time.perf_counter() - inicio)
+
+        return envoltura  # type: ignore[return-value]
+
+    return decorador
+
+
+def registrar_llamada_llm(status: str, segundos: float, usage: Optional[Dict[str, Any]] = None) -> None:
+    """Metricas de una llamada HTTP al LLM: duracion, codigo de estado y tokens usados."""
+    if not METRICS_ENABLED:
+        return
+    observar("llm", segundos)
+    LLM_REQUESTS.inc(status=status)
+    if usage:
+        for tipo in ("prompt_tokens", "completion_tokens"):
+            tokens = usage.get(tipo)
+            if isinstance(tokens, (int, float)):
+                LLM_TOKENS.inc(tokens, type=tipo.replace("_tokens", ""))
+
+
+def registrar_reintento_llm() -> None:
+    if METRICS_ENABLED:
+        LLM_RETRIES.inc()
@@ -1,80 +1,363 @@
 ﻿import json
-from typing import Dict, Optional
+import re
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
 
-from src.models.domain import Intent
+from src.models.domain import SLOT_BY_STEP, FlowStep, Intent
+from src.controllers.especialidades import canonizar_especialidad
+from src.controllers.fechas import fecha_iso, hora_iso
+from src.controllers.lexicon import get_lexicon, normalizar_texto
 from src.controllers.llm_client import LLMClient
+from src.controllers.metrics import cronometrado
+from src.controllers.nlu_cache import NLU_CACHE, CacheKey, make_key
 
-def detectar_intencion_llm(mensaje: str, llm: LLMClient) -> Intent:
-    """
-    Usa reglas simples + LLM para detectar la intencion del usuario.
-    Regla prioritaria: si menciona 'cita' o 'agendar', se considera AGENDAR_CITA.
+ENTITY_FIELDS = ("nombre", "identificacion", "especialidad", "fecha", "hora", "medio")
+
+# Subir al cambiar cualquier prompt: invalida las entradas viejas de la cache NLU
+PROMPT_VERSION = "1"
+
+INTENT_PROMPT = (
+    "Eres un clasificador de intenciones. Devuelve un JSON con el campo 'intent' "
+    "que sea uno de: ['agendar_cita', 'small_talk', 'desconocida']."
+)
+ENTITIES_PROMPT = (
+    "Eres un extractor de entidades. Dado el mensaje del usuario, devuelve un JSON con los "
+    "campos: nombre, identificacion, especialidad, fecha, hora, medio. Usa null cuando no se pueda extraer."
+)
+# Extraccion dirigida: solo los slots faltantes y una respuesta mas corta
+TARGETED_ENTITIES_PROMPT = (
+    "Extrae del mensaje del usuario un JSON solo con los campos: {campos}. "
+    "Usa null si no aparece."
+)
+MAX_TOKENS_BASE = 16
+MAX_TOKENS_POR_CAMPO = 16
+
+JOINT_PROMPT = (
+    "Eres un modulo NLU para un agente de citas medicas. Dado el mensaje del usuario, "
+    "devuelve un JSON con el campo 'intent' (uno de: ['agendar_cita', 'small_talk', "
+    "'desconocida']) y los campos: nombre, identificacion, especialidad, fecha, hora, medio. "
+    "Usa null cuando no se pueda extraer."
+)
+
+
+def _entidades_vacias() -> Dict[str, Optional[str]]:
+    return {campo: None for campo in ENTITY_FIELDS}
+
+
+def _parse_entidades(data: Dict[str, Any]) -> Dict[str, Optional[str]]:
+    return _canonizar_entidades({campo: data.get(campo) for campo in ENTITY_FIELDS})
+
+
+def _canonizar_entidades(entidades: Dict[str, Optional[str]]) -> Dict[str, Optional[str]]:
+    """Lleva lo que devuelve el LLM a su forma canonica: especialidad del catalogo
+    ("el cardiologo" -> Cardiología), fecha ISO ("el proximo lunes" -> 2026-10-19) y hora HH:MM.
+
+    Si el valor no se reconoce con confianza se deja el texto del LLM.
     """
-    texto = mensaje.lower()
+    for campo, canonizar in _CANONIZADORES.items():
+        valor = entidades.get(campo)
+        if isinstance(valor, str) and valor.strip():
+            entidades[campo] = canonizar(valor) or valor
+    return entidades
+
+
+def _parse_intent(intent_value: Any) -> Intent:
+    for intent in Intent:
+        if intent.value == intent_value:
+            return intent
+    return Intent.DESCONOCIDA
+
 
-    if "cita" in texto or "agendar" in texto or "agenda" in texto:
+def _intencion_por_regla(mensaje: str) -> Optional[Intent]:
+    """Intencion resuelta por el lexicon, o None si hace falta el LLM.
+
+    AGENDAR_CITA si menciona una palabra de agendamiento ('cita', 'agendar'...);
+    SMALL_TALK si el mensaje es solo un saludo/cortesia ('hola', 'buenas tardes').
+    """
+    coincidencias = get_lexicon().buscar(mensaje)
+    if coincidencias.tiene("intencion", Intent.AGENDAR_CITA.value):
         return Intent.AGENDAR_CITA
+    if coincidencias.completo and coincidencias.tiene("intencion", Intent.SMALL_TALK.value):
+        return Intent.SMALL_TALK
+    return None
+
+
+_SEPARADORES_NUMERO = re.compile(r"[\s.\-]")
+
 
-    system_prompt = (
-        "Eres un clasificador de intenciones. Devuelve un JSON con el campo 'intent' "
-        "que sea uno de: ['agendar_cita', 'small_talk', 'desconocida']."
+def _validar_identificacion(mensaje: str) -> Optional[str]:
+    """La respuesta es solo un numero de documento (5 a 12 digitos, con puntos/espacios/guiones)."""
+    digitos = _SEPARADORES_NUMERO.sub("", mensaje.strip())
+    if digitos.isdigit() and 5 <= len(digitos) <= 12:
+        return digitos
+    return None
+
+
+def _validar_medio(mensaje: str) -> Optional[str]:
+    # Solo si el lexicon encontro una unica modalidad (ninguna o ambas: ambiguo)
+    return get_lexicon().buscar(mensaje).unico("modalidad")
+
+
+# Respuestas mas largas pueden traer otros datos: mejor que las lea el LLM
+_MAX_PALABRAS_ESPECIALIDAD = 6
+
+
+def _validar_especialidad(mensaje: str) -> Optional[str]:
+    # Catalogo con indice de trigramas: con score bajo, varias especialidades o una
+    # negacion ("ortopedia no, mejor cardio") se le pregunta al LLM
+    if len(normalizar_texto(mensaje).split()) > _MAX_PALABRAS_ESPECIALIDAD:
+        return None
+    if get_lexicon().buscar(mensaje).tiene("negacion"):
+        return None
+    return canonizar_especialidad(mensaje)
+
+
+# Validadores por slot: si reconocen la respuesta al slot esperado, no hace falta el LLM.
+# Fecha y hora: parser local en espanol ("manana", "el proximo lunes", "a las 3 de la tarde")
+_VALIDADORES: Dict[str, Callable[[str], Optional[str]]] = {
+    "identificacion": _validar_identificacion,
+    "medio": _validar_medio,
+    "fecha": fecha_iso,
+    "hora": hora_iso,
+    "especialidad": _validar_especialidad,
+}
+
+_CANONIZADORES: Dict[str, Callable[[str], Optional[str]]] = {
+    "especialidad": canonizar_especialidad,
+    "fecha": fecha_iso,
+    "hora": hora_iso,
+}
+
+
+def _campos_objetivo(faltantes: Sequence[str]) -> List[str]:
+    return [campo for campo in ENTITY_FIELDS if campo in faltantes]
+
+
+def _entidades_por_validador(
+    mensaje: str, campos: List[str], paso: Optional[FlowStep]
+) -> Tuple[Dict[str, Optional[str]], List[str]]:
+    """Lo que el validador del slot esperado en `paso` entiende sin LLM y los campos que
+    quedan para el LLM.
+
+    No queda ninguno solo si la respuesta es ese dato y nada mas: cada otro campo
+    tiene validador y ninguno reconoce algo en el mensaje ("cardiologia, manana"
+    trae tambien la fecha).
+    """
+    entidades = _entidades_vacias()
+    esperado = SLOT_BY_STEP.get(paso) if paso is not None else None
+    validador = _VALIDADORES.get(esperado) if esperado in campos else None
+    valor = validador(mensaje) if validador else None
+    if valor is None:
+        return entidades, campos
+    entidades[esperado] = valor  # type: ignore[index]
+    restantes = [campo for campo in campos if campo != esperado]
+    if all(campo in _VALIDADORES and _VALIDADORES[campo](mensaje) is None for campo in restantes):
+        return entidades, []
+    return entidades, restantes
+
+
+def _consulta_dirigida(campos: List[str]) -> Tuple[str, str, int]:
+    """(tipo de cache, prompt, max_tokens) para extraer solo `campos`."""
+    return (
+        "entidades:" + ",".join(campos),
+        TARGETED_ENTITIES_PROMPT.format(campos=", ".join(campos)),
+        MAX_TOKENS_BASE + MAX_TOKENS_POR_CAMPO * len(campos),
     )
-    messages = [
+
+
+def _parse_entidades_dirigidas(data: Optional[Dict[str, Any]], campos: List[str]) -> Dict[str, Optional[str]]:
+    entidades = _entidades_vacias()
+    if data is not None:
+        for campo in campos:
+            entidades[campo] = data.get(campo)
+    return _canonizar_entidades(entidades)
+
+
+def _fusionar(
+    entidades: Dict[str, Optional[str]], del_llm: Dict[str, Optional[str]], campos: List[str]
+) -> Dict[str, Optional[str]]:
+    """Lo del validador mas lo que el LLM extrajo de `campos`."""
+    for campo in campos:
+        entidades[campo] = del_llm[campo]
+    return entidades
+
+
+def _mensajes(system_prompt: str, mensaje: str) -> List[Dict[str, str]]:
+    return [
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": mensaje},
     ]
-    content = llm.chat(messages, response_format={"type": "json_object"})
+
+
+def _parse_respuesta_json(key: CacheKey, content: Optional[str]) -> Optional[Dict[str, Any]]:
+    """Parsea la respuesta del LLM y la guarda en cache solo si es un objeto JSON valido."""
     if not content:
-        return Intent.DESCONOCIDA
+        return None
     try:
         data = json.loads(content)
-        intent_value = data.get("intent", "desconocida")
-        for intent in Intent:
-            if intent.value == intent_value:
-                return intent
     except json.JSONDecodeError:
+        return None
+    if not isinstance(data, dict):
+        return None
+    NLU_CACHE.set(key, data)
+    return data
+
+
+def _consultar_llm_json(
+    tipo: str, system_prompt: str, mensaje: str, llm: LLMClient, max_tokens: Optional[int] = None
+) -> Optional[Dict[str, Any]]:
+    """
+    Envia el mensaje al LLM en modo JSON y devuelve el objeto parseado, pasando por la cache NLU.
+    Devuelve None si el LLM falla, el circuit breaker esta abierto o la respuesta no es
+    un objeto JSON (esos casos no se cachean); quien llama recurre entonces a las reglas.
+    """
+    key = make_key(tipo, mensaje, PROMPT_VERSION, llm.model)
+    cached = NLU_CACHE.get(key)
+    if cached is not None:
+        return cached
+    if not llm.disponible():
+        # Circuit breaker abierto: sin llamada, quedan solo las reglas
+        return None
+    content = llm.chat(
+        _mensajes(system_prompt, mensaje), response_format={"type": "json_object"}, max_tokens=max_tokens
+    )
+    return _parse_respuesta_json(key, content)
+
+
+async def _consultar_llm_json_async(
+    tipo: str, system_prompt: str, mensaje: str, llm: LLMClient, max_tokens: Optional[int] = None
+) -> Optional[Dict[str, Any]]:
+    """Version asincrona de _consultar_llm_json."""
+    key = make_key(tipo, mensaje, PROMPT_VERSION, llm.model)
+    cached = NLU_CACHE.get(key)
+    if cached is not None:
+        return cached
+    if not llm.disponible():
+        return None
+    content = await llm.achat(
+        _mensajes(system_prompt, mensaje), response_format={"type": "json_object"}, max_tokens=max_tokens
+    )
+    return _parse_respuesta_json(key, content)
+
+
+@cronometrado("nlu_intencion")
+def detectar_intencion_llm(mensaje: str, llm: LLMClient) -> Intent:
+    """
+    Usa reglas simples + LLM para detectar la intencion del usuario.
+    Regla prioritaria (lexicon): si menciona 'cita' o 'agendar', se considera AGENDAR_CITA;
+    si es solo un saludo, SMALL_TALK. En ambos casos no se llama al LLM.
+    """
+    intent_regla = _intencion_por_regla(mensaje)
+    if intent_regla is not None:
+        return intent_regla
+
+    data = _consultar_llm_json("intent", INTENT_PROMPT, mensaje, llm)
+    if data is None:
         return Intent.DESCONOCIDA
-    return Intent.DESCONOCIDA
+    return _parse_intent(data.get("intent", "desconocida"))
 
 
-def extraer_entidades_llm(mensaje: str, llm: LLMClient) -> Dict[str, Optional[str]]:
+@cronometrado("nlu_entidades")
+def extraer_entidades_llm(
+    mensaje: str,
+    llm: LLMClient,
+    faltantes: Optional[Sequence[str]] = None,
+    paso: Optional[FlowStep] = None,
+) -> Dict[str, Optional[str]]:
     """
     Usa OpenAI para extraer entidades del mensaje.
     Devuelve un dict con: nombre, identificacion, especialidad, fecha, hora, medio.
+
+    Con `faltantes` la extraccion es dirigida: solo se piden esos slots (prompt y
+    max_tokens mas chicos) y, si el validador del slot que se pidio en `paso`
+    reconoce la respuesta (un numero para identificacion, presencial/virtual para
+    medio, una fecha u hora que entiende el parser local, una especialidad del catalogo), no se llama al LLM
+    si la respuesta no trae otros datos; si los trae, el LLM extrae solo el resto. Sin faltantes no hay nada que extraer.
     """
-    system_prompt = (
-        "Eres un extractor de entidades. Dado el mensaje del usuario, devuelve un JSON con los "
-        "campos: nombre, identificacion, especialidad, fecha, hora, medio. Usa null cuando no se pueda extraer."
-    )
-    messages = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": mensaje},
-    ]
-    content = llm.chat(messages, response_format={"type": "json_object"})
-    if not content:
-        return {
-            "nombre": None,
-            "identificacion": None,
-            "especialidad": None,
-            "fecha": None,
-            "hora": None,
-            "medio": None,
-        }
-    try:
-        data = json.loads(content)
-        return {
-            "nombre": data.get("nombre"),
-            "identificacion": data.get("identificacion"),
-            "especialidad": data.get("especialidad"),
-            "fecha": data.get("fecha"),
-            "hora": data.get("hora"),
-            "medio": data.get("medio"),
-        }
-    except json.JSONDecodeError:
-        return {
-            "nombre": None,
-            "identificacion": None,
-            "especialidad": None,
-            "fecha": None,
-            "hora": None,
-            "medio": None,
-        }
+    if faltantes is None:
+        data = _consultar_llm_json("entidades", ENTITIES_PROMPT, mensaje, llm)
+        if data is None:
+            return _entidades_vacias()
+        return _parse_entidades(data)
+
+    campos = _campos_objetivo(faltantes)
+    if not campos:
+        return _entidades_vacias()
+    entidades, restantes = _entidades_por_validador(mensaje, campos, paso)
+    if not restantes:
+        return entidades
+    tipo, prompt, max_tokens = _consulta_dirigida(restantes)
+    data = _consultar_llm_json(tipo, prompt, mensaje, llm, max_tokens)
+    return _fusionar(entidades, _parse_entidades_dirigidas(data, restantes), restantes)
+
+
+@cronometrado("nlu_conjunto")
+def analizar_mensaje_llm(
+    mensaje: str, llm: LLMClient
+) -> Tuple[Intent, Dict[str, Optional[str]]]:
+    """
+    NLU conjunto: intencion + entidades en una sola llamada al LLM (modo JSON).
+    Se usa cuando se necesitan ambos resultados, ahorrando una ida y vuelta.
+    La regla de palabras clave de detectar_intencion_llm sigue teniendo prioridad
+    (un saludo solo no tiene entidades: se resuelve sin LLM).
+    """
+    intent_regla = _intencion_por_regla(mensaje)
+    if intent_regla == Intent.SMALL_TALK:
+        return intent_regla, _entidades_vacias()
+    data = _consultar_llm_json("conjunto", JOINT_PROMPT, mensaje, llm)
+    if data is None:
+        return intent_regla or Intent.DESCONOCIDA, _entidades_vacias()
+    intent = intent_regla or _parse_intent(data.get("intent", "desconocida"))
+    return intent, _parse_entidades(data)
+
+
+@cronometrado("nlu_intencion")
+async def detectar_intencion_llm_async(mensaje: str, llm: LLMClient) -> Intent:
+    """Version asincrona de detectar_intencion_llm."""
+    intent_regla = _intencion_por_regla(mensaje)
+    if intent_regla is not None:
+        return intent_regla
+
+    data = await _consultar_llm_json_async("intent", INTENT_PROMPT, mensaje, llm)
+    if data is None:
+        return Intent.DESCONOCIDA
+    return _parse_intent(data.get("intent", "desconocida"))
+
+
+@cronometrado("nlu_entidades")
+async def extraer_entidades_llm_async(
+    mensaje: str,
+    llm: LLMClient,
+    faltantes: Optional[Sequence[str]] = None,
+    paso: Optional[FlowStep] = None,
+) -> Dict[str, Optional[str]]:
+    """Version asincrona de extraer_entidades_llm."""
+    if faltantes is None:
+        data = await _consultar_llm_json_async("entidades", ENTITIES_PROMPT, mensaje, llm)
+        if data is None:
+            return _entidades_vacias()
+        return _parse_entidades(data)
+
+    campos = _campos_objetivo(faltantes)
+    if not campos:
+        return _entidades_vacias()
+    entidades, restantes = _entidades_por_validador(mensaje, campos, paso)
+    if not restantes:
+        return entidades
+    tipo, prompt, max_tokens = _consulta_dirigida(restantes)
+    data = await _consultar_llm_json_async(tipo, prompt, mensaje, llm, max_tokens)
+    return _fusionar(entidades, _parse_entidades_dirigidas(data, restantes), restantes)
+
+
+@cronometrado("nlu_conjunto")
+async def analizar_mensaje_llm_async(
+    mensaje: str, llm: LLMClient
+) -> Tuple[Intent, Dict[str, Optional[str]]]:
+    """Version asincrona de analizar_mensaje_llm."""
+    intent_regla = _intencion_por_regla(mensaje)
+    if intent_regla == Intent.SMALL_TALK:
+        return intent_regla, _entidades_vacias()
+    data = await _consultar_llm_json_async("conjunto", JOINT_PROMPT, mensaje, llm)
+    if data is None:
+        return intent_regla or Intent.DESCONOCIDA, _entidades_vacias()
+    intent = intent_regla or _parse_intent(data.get("intent", "desconocida"))
+    return intent, _parse_entidades(data)
@@ -0,0 +1,92 @@
+﻿import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+CacheKey = Tuple[str, str, str, str]
+
+DEFAULT_CACHE_SIZE = 2048
+DEFAULT_CACHE_TTL = 3600.0
+
+
+def normalizar_mensaje(mensaje: str) -> str:
+    """Normaliza el mensaje para la clave de cache (minusculas y espacios colapsados)."""
+    return " ".join(mensaje.split()).casefold()
+
+
+def make_key(tipo: str, mensaje: str, prompt_version: str, model: str) -> CacheKey:
+    """Clave de cache: tipo de consulta NLU, mensaje normalizado, version de prompt y modelo."""
+    return (tipo, normalizar_mensaje(mensaje), prompt_version, model)
+
+
+class NLUCache:
+    """Cache LRU con TTL para respuestas JSON del LLM en el NLU.
+
+    Thread-safe. Solo guarda respuestas validas: quien llama nunca debe pasar
+    None ni respuestas fallidas a set().
+    """
+
+    def __init__(self, max_size: int = DEFAULT_CACHE_SIZE, ttl_seconds: float = DEFAULT_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._data: "OrderedDict[CacheKey, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0 and self.ttl_seconds > 0
+
+    def get(self, key: CacheKey) -> Optional[Dict[str, Any]]:
+        if not self.enabled:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            expires_at, value = item
+            if expires_at <= now:
+                del self._data[key]
+                self.evictions += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return dict(value)
+
+    def set(self, key: CacheKey, value: Dict[str, Any]) -> None:
+        if not self.enabled or value is None:
+            return
+        expires_at = time.monotonic() + self.ttl_seconds
+        with self._lock:
+            self._data[key] = (expires_at, dict(value))
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+# Cache compartida por todo el proceso (NLU_CACHE_SIZE=0 la desactiva)
+NLU_CACHE = NLUCache(
+    max_size=int(os.environ.get("NLU_CACHE_SIZE", DEFAULT_CACHE_SIZE)),
+    ttl_seconds=float(os.environ.get("NLU_CACHE_TTL", DEFAULT_CACHE_TTL)),
+)
@@ -1,9 +1,14 @@
 ﻿from __future__ import annotations
 
+import re
+import sys
 import uuid
 from dataclasses import dataclass, field
 from enum import Enum
-from typing import Dict, List, Optional
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional
+
+# __slots__ en los dataclasses de estado (sin __dict__ por instancia) cuando Python lo soporta
+_SLOTS: Dict[str, Any] = {"slots": True} if sys.version_info >= (3, 10) else {}
 
 
 class Intent(Enum):
@@ -24,7 +29,26 @@ class FlowStep(Enum):
     COMPLETADO = "completado"
 
 
-@dataclass
+# Valores de vocabulario cerrado por slot (modalidades del lexicon, especialidades canonicas
+# del catalogo) y horas HH:MM: se internan para que miles de sesiones compartan el mismo string.
+# El texto libre ("cuando sea", una especialidad que no se reconocio) no se interna: haria
+# crecer la tabla de strings internados sin limite
+_VOCABULARIO_CERRADO: Dict[str, FrozenSet[str]] = {}
+_HORA_RELOJ = re.compile(r"\d{2}:\d{2}")
+
+
+def registrar_vocabulario(slot: str, valores: Iterable[str]) -> None:
+    """Valores canonicos de `slot` que se internan (lo llaman el lexicon y el catalogo al cargarse)."""
+    _VOCABULARIO_CERRADO[slot] = frozenset(valores)
+
+
+def _internable(slot: str, valor: str) -> bool:
+    if slot == "hora":
+        return _HORA_RELOJ.fullmatch(valor) is not None
+    return valor in _VOCABULARIO_CERRADO.get(slot, ())
+
+
+@dataclass(**_SLOTS)
 class Memory:
     nombre: Optional[str] = None
     identificacion: Optional[str] = None
@@ -33,6 +57,11 @@ class Memory:
     hora: Optional[str] = None
     medio: Optional[str] = None
 
+    def __setattr__(self, name: str, value: Any) -> None:
+        if type(value) is str and _internable(name, value):
+            value = sys.intern(value)
+        object.__setattr__(self, name, value)
+
     def to_dict(self) -> Dict[str, Optional[str]]:
         return {
             "nombre": self.nombre,
@@ -44,7 +73,7 @@ class Memory:
         }
 
 
-@dataclass
+@dataclass(**_SLOTS)
 class ConversationState:
     intent: Optional[Intent] = None
     step: FlowStep = FlowStep.INICIO
@@ -52,6 +81,9 @@ class ConversationState:
     session_id: str = field(default_factory=lambda: str(uuid.uuid4()))
     turn_counter: int = 0
     llm_failures: int = 0
+    llm_calls: int = 0  # llamadas al LLM del ultimo turno
+    duraciones_ms: Dict[str, float] = field(default_factory=dict)  # por etapa, ultimo turno
+    version: int = 0  # version en el almacen de sesiones compartido (0 = nunca guardada)
 
     def reset(self) -> None:
         self.intent = None
@@ -60,6 +92,9 @@ class ConversationState:
         self.session_id = str(uuid.uuid4())
         self.turn_counter = 0
         self.llm_failures = 0
+        self.llm_calls = 0
+        self.duraciones_ms = {}
+        self.version = 0
 
     def next_turn(self) -> int:
         """Incrementa y devuelve el número de turno de la conversación."""
@@ -71,6 +106,21 @@ REQUIRED_SLOTS_BY_INTENT: Dict[Intent, List[str]] = {
     Intent.AGENDAR_CITA: ["nombre", "identificacion", "especialidad", "fecha"],
 }
 
+# Se preguntan pero se puede agendar sin ellos ("cualquier hora")
+OPTIONAL_SLOTS_BY_INTENT: Dict[Intent, List[str]] = {
+    Intent.AGENDAR_CITA: ["hora", "medio"],
+}
+
+# Slot que el bot acaba de pedir en cada paso (lo que se espera en la respuesta del usuario)
+SLOT_BY_STEP: Dict[FlowStep, str] = {
+    FlowStep.PEDIR_NOMBRE: "nombre",
+    FlowStep.PEDIR_IDENTIFICACION: "identificacion",
+    FlowStep.PEDIR_ESPECIALIDAD: "especialidad",
+    FlowStep.PEDIR_FECHA: "fecha",
+    FlowStep.PEDIR_HORA: "hora",
+    FlowStep.PEDIR_MEDIO: "medio",
+}
+
 
 def get_missing_slots(state: ConversationState) -> List[str]:
     """Devuelve la lista de slots obligatorios faltantes para la intencion actual."""
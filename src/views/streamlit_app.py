@@ -4,6 +4,8 @@ from __future__ import annotations
 
 import os
 import sys
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Dict, List, Tuple
 
 import streamlit as st
 
@@ -17,12 +19,32 @@ if PROJECT_ROOT not in sys.path:
 
 from src.controllers.dialog_manager import agente_citas
 from src.models.domain import ConversationState, FlowStep
-from src.controllers.llm_client import LLMClient, OPENAI_API_URL, OPENAI_MODEL
+from src.controllers.llm_client import DEFAULT_POOL_SIZE, LLMClient, OPENAI_API_URL, OPENAI_MODEL
 from src.controllers.logging_utils import log_turno
 
+# Cada cuanto se revisa si el turno en curso termino (mientras tanto la vista sigue atendiendo clics)
+POLL_INTERVAL = float(os.environ.get("STREAMLIT_POLL_INTERVAL", 0.25))
+# Mensajes nuevos que se dibujan aparte antes de pasarlos al historial (un rerun completo)
+VENTANA_MENSAJES = int(os.environ.get("STREAMLIT_CHAT_WINDOW", 20))
+
+
+@st.cache_resource
+def _crear_llm_client(api_key: str, model: str, api_url: str, pool_size: int) -> LLMClient:
+    # Uno por proceso: todas las sesiones de navegador comparten el pool de conexiones
+    return LLMClient(api_key=api_key, model=model, api_url=api_url, pool_size=pool_size)
+
+
+@st.cache_resource
+def get_executor() -> ThreadPoolExecutor:
+    """Hilos del proceso que ejecutan los turnos (tantos como conexiones tiene el pool del LLM)."""
+    return ThreadPoolExecutor(
+        max_workers=int(os.environ.get("LLM_POOL_SIZE", DEFAULT_POOL_SIZE)),
+        thread_name_prefix="turno-streamlit",
+    )
+
 
 def get_llm_client() -> LLMClient:
-    """Crea el cliente de OpenAI usando la API key del entorno."""
+    """Cliente de OpenAI compartido por todas las sesiones, con la API key del entorno."""
     api_key = os.environ.get("OPENAI_API_KEY")
     if not api_key:
         st.error(
@@ -30,7 +52,22 @@ def get_llm_client() -> LLMClient:
             "Configúrala antes de usar la app."
         )
         st.stop()
-    return LLMClient(api_key=api_key, model=OPENAI_MODEL, api_url=OPENAI_API_URL)
+    return _crear_llm_client(
+        api_key,
+        OPENAI_MODEL,
+        os.environ.get("OPENAI_API_URL", OPENAI_API_URL),
+        int(os.environ.get("LLM_POOL_SIZE", DEFAULT_POOL_SIZE)),
+    )
+
+
+def procesar_turno(mensaje: str, state: ConversationState, llm_client: LLMClient) -> Tuple[str, bool]:
+    """Turno completo (en un hilo del executor): agente, log y reset si el flujo termino."""
+    respuesta_bot = agente_citas(mensaje, state, llm_client)
+    log_turno(usuario_texto=mensaje, bot_texto=respuesta_bot, state=state)
+    completado = state.step == FlowStep.COMPLETADO
+    if completado:
+        state.reset()
+    return respuesta_bot, completado
 
 
 def init_state() -> None:
@@ -39,43 +76,128 @@ def init_state() -> None:
         st.session_state.conversation_state = ConversationState()
     if "messages" not in st.session_state:
         st.session_state.messages = []
-    if "llm_client" not in st.session_state:
-        st.session_state.llm_client = get_llm_client()
+    if "pendiente" not in st.session_state:
+        st.session_state.pendiente = None
+    st.session_state.llm_client = get_llm_client()
+
+
+def reiniciar_conversacion() -> None:
+    # Estado nuevo (no reset()): un turno pendiente puede seguir usando el anterior en su hilo
+    st.session_state.conversation_state = ConversationState()
+    st.session_state.messages = []
+    st.session_state.pendiente = None
 
 
 def render_sidebar() -> None:
-    """Muestra en el sidebar el estado interno del agente (debugging/entrevista)."""
-    state: ConversationState = st.session_state.conversation_state
+    """Controles de la sesion en el sidebar (el estado del agente se muestra junto al chat)."""
+    st.sidebar.header("🧠 Sesion")
+    if st.sidebar.button("🔁 Reiniciar conversacion"):
+        reiniciar_conversacion()
+        st.rerun()
 
-    st.sidebar.header("🧠 Estado del agente")
-    st.sidebar.write(f"**Session ID:** `{state.session_id}`")
-    st.sidebar.write(f"**Turno actual:** {state.turn_counter}")
-    st.sidebar.write(f"**Intencion:** {state.intent.name if state.intent else 'Ninguna'}")
-    st.sidebar.write(f"**Paso del flujo:** {state.step.name}")
-    st.sidebar.write(f"**Fallos LLM:** {state.llm_failures}")
 
-    st.sidebar.subheader("📌 Memoria (slots)")
+def render_estado() -> None:
+    """Estado interno del agente (debugging/entrevista)."""
+    state: ConversationState = st.session_state.conversation_state
     mem = state.memory
-    st.sidebar.write(f"- Nombre: {mem.nombre}")
-    st.sidebar.write(f"- Identificacion: {mem.identificacion}")
-    st.sidebar.write(f"- Especialidad: {mem.especialidad}")
-    st.sidebar.write(f"- Fecha: {mem.fecha}")
-    st.sidebar.write(f"- Hora: {mem.hora}")
-    st.sidebar.write(f"- Medio: {mem.medio}")
+    with st.expander("🧠 Estado del agente"):
+        st.markdown(
+            f"**Session ID:** `{state.session_id}`  \n"
+            f"**Turno actual:** {state.turn_counter}  \n"
+            f"**Intencion:** {state.intent.name if state.intent else 'Ninguna'}  \n"
+            f"**Paso del flujo:** {state.step.name}  \n"
+            f"**Fallos LLM:** {state.llm_failures}\n\n"
+            "**📌 Memoria (slots)**\n"
+            f"- Nombre: {mem.nombre}\n"
+            f"- Identificacion: {mem.identificacion}\n"
+            f"- Especialidad: {mem.especialidad}\n"
+            f"- Fecha: {mem.fecha}\n"
+            f"- Hora: {mem.hora}\n"
+            f"- Medio: {mem.medio}"
+        )
 
-    if st.sidebar.button("🔁 Reiniciar conversacion"):
-        state.reset()
-        st.session_state.messages = []
-        st.rerun()
+
+def _formatear(msg: Dict[str, str]) -> str:
+    return f"**Tu:** {msg['text']}" if msg["role"] == "user" else f"**Bot:** {msg['text']}"
 
 
-def render_chat() -> None:
-    """Renderiza el historial de conversacion."""
-    for msg in st.session_state.messages:
-        if msg["role"] == "user":
-            st.markdown(f"**Tu:** {msg['text']}")
-        else:
-            st.markdown(f"**Bot:** {msg['text']}")
+def render_chat(messages: List[Dict[str, str]]) -> None:
+    """Renderiza mensajes como un solo elemento (no uno por mensaje)."""
+    if messages:
+        st.markdown("\n\n".join(_formatear(msg) for msg in messages))
+
+
+def enviar_mensaje() -> None:
+    """Callback de "Enviar": encola el turno en el executor antes de que se dibuje el fragmento."""
+    user_input = st.session_state.chat_input
+    if not user_input.strip():
+        return
+    if st.session_state.pendiente is not None:
+        st.toast("Espera la respuesta al mensaje anterior.")
+        return
+    st.session_state.messages.append({"role": "user", "text": user_input})
+    st.session_state.pendiente = get_executor().submit(
+        procesar_turno,
+        user_input,
+        st.session_state.conversation_state,
+        st.session_state.llm_client,
+    )
+
+
+def esperar_turno(future: "Future[Tuple[str, bool]]") -> None:
+    """Muestra el indicador mientras el turno corre en el executor y guarda la respuesta.
+
+    La espera es por tramos de POLL_INTERVAL con una llamada a Streamlit en cada
+    uno: un clic (reiniciar, limpiar) interrumpe la espera sin esperar al LLM.
+    """
+    indicador = st.empty()
+    puntos = 0
+    while not future.done():
+        puntos = puntos % 3 + 1
+        indicador.markdown(f"**Bot:** _escribiendo{'.' * puntos}_")
+        wait([future], timeout=POLL_INTERVAL)
+    indicador.empty()
+    if st.session_state.pendiente is future:
+        st.session_state.pendiente = None
+    try:
+        respuesta_bot, completado = future.result()
+    except Exception as e:
+        st.error(f"No se pudo procesar el mensaje: {e}")
+        return
+    st.session_state.messages.append({"role": "bot", "text": respuesta_bot})
+    render_chat(st.session_state.messages[-1:])
+    if completado:
+        st.success("✅ Flujo completado. El estado se reinicio para una nueva cita.")
+
+
+@st.fragment
+def render_conversacion() -> None:
+    """Mensajes nuevos, turno en curso, estado del agente y entrada de texto.
+
+    Es un fragmento: enviar un mensaje solo vuelve a ejecutar esta parte, el
+    historial dibujado en el rerun completo no se toca.
+    """
+    nuevos = st.session_state.messages[st.session_state.renderizados:]
+    if len(nuevos) > VENTANA_MENSAJES and st.session_state.pendiente is None:
+        # Se pasan al historial: un rerun completo cada VENTANA_MENSAJES mensajes
+        st.rerun()
+    # Los mensajes van arriba del formulario pero se completan despues de dibujarlo
+    conversacion = st.container()
+
+    with st.form("chat_form", clear_on_submit=True):
+        # No vamos a manipular este valor en session_state para evitar errores
+        st.text_input("Escribe tu mensaje:", key="chat_input")
+        st.form_submit_button("Enviar", on_click=enviar_mensaje)
+    # Este boton solo limpia el historial y resetea el estado
+    if st.button("Limpiar historial"):
+        reiniciar_conversacion()
+        st.rerun()
+
+    with conversacion:
+        render_chat(nuevos)
+        if st.session_state.pendiente is not None:
+            esperar_turno(st.session_state.pendiente)
+        render_estado()
 
 
 def main() -> None:
@@ -90,46 +212,10 @@ def main() -> None:
     render_sidebar()
 
     st.subheader("💬 Conversacion")
-    render_chat()
-
-    # No vamos a manipular este valor en session_state para evitar errores
-    user_input = st.text_input("Escribe tu mensaje:", key="chat_input")
-
-    col1, col2 = st.columns([1, 1])
-    with col1:
-        enviar = st.button("Enviar")
-    with col2:
-        reset_local = st.button("Limpiar historial")
-
-    # Este boton solo limpia el historial (y opcionalmente resetea el estado)
-    if reset_local:
-        st.session_state.messages = []
-        st.session_state.conversation_state.reset()
-        st.rerun()
-
-    if enviar and user_input.strip():
-        state: ConversationState = st.session_state.conversation_state
-        llm_client: LLMClient = st.session_state.llm_client
-
-        # Guardamos mensaje del usuario
-        st.session_state.messages.append({"role": "user", "text": user_input})
-
-        # Llamamos al agente
-        respuesta_bot = agente_citas(user_input, state, llm_client)
-
-        # Guardamos respuesta del bot
-        st.session_state.messages.append({"role": "bot", "text": respuesta_bot})
-
-        # Log en JSONL
-        log_turno(usuario_texto=user_input, bot_texto=respuesta_bot, state=state)
-
-        # Si el flujo termina, reseteamos para una nueva cita
-        if state.step == FlowStep.COMPLETADO:
-            st.success("✅ Flujo completado. El estado se reiniciara para una nueva cita.")
-            state.reset()
-
-        # Forzamos rerender para ver inmediatamente la nueva conversacion
-        st.rerun()
+    # Historial hasta este rerun completo; lo que llegue despues lo dibuja el fragmento
+    st.session_state.renderizados = len(st.session_state.messages)
+    render_chat(st.session_state.messages)
+    render_conversacion()
 
 
 if __name__ == "__main__":
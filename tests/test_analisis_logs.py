@@ -0,0 +1,81 @@
+﻿import json
+import os
+
+import pandas as pd
+
+import analisis_logs
+from analisis_logs import AgregadosLogs, analizar_incremental, calcular_funnel
+
+
+def _turno(session_id: str, turno: int, paso: str) -> dict:
+    return {
+        "session_id": session_id,
+        "turno": turno,
+        "timestamp": f"2026-10-18T10:00:{turno:02d}+00:00",
+        "intencion": "agendar_cita",
+        "paso": paso,
+    }
+
+
+def _escribir(path, registros) -> None:
+    with open(path, "a", encoding="utf-8") as f:
+        for registro in registros:
+            f.write(json.dumps(registro) + "\n")
+
+
+def test_incremental_lee_todas_las_rotaciones_intermedias(tmp_path):
+    log = tmp_path / "logs.jsonl"
+    checkpoint = str(tmp_path / "checkpoint.json")
+    _escribir(log, [_turno("a", 1, "PEDIR_NOMBRE")])
+    assert analizar_incremental(str(log), checkpoint).total_turnos == 1
+
+    # Dos rotaciones antes de la siguiente ejecucion
+    _escribir(log, [_turno("a", 2, "PEDIR_FECHA")])
+    os.rename(log, f"{log}.20261018T100000")
+    _escribir(log, [_turno("b", 1, "PEDIR_NOMBRE"), _turno("a", 3, "COMPLETADO")])
+    os.rename(log, f"{log}.20261018T110000")
+    _escribir(log, [_turno("c", 1, "PEDIR_NOMBRE")])
+
+    agregados = analizar_incremental(str(log), checkpoint)
+    assert agregados.total_turnos == 5
+    assert (agregados.sesiones, agregados.sesiones_completadas) == (3, 1)
+
+    # Sin cambios: nada nuevo que leer
+    assert analizar_incremental(str(log), checkpoint).total_turnos == 5
+
+
+def test_ventana_de_sesiones_acotada(monkeypatch):
+    monkeypatch.setattr(analisis_logs, "MAX_SESIONES_RECIENTES", 2)
+    agregados = AgregadosLogs()
+    agregados.actualizar([_turno(s, 1, "PEDIR_NOMBRE") for s in "abc"])
+    agregados.actualizar([_turno("c", 2, "COMPLETADO"), _turno("c", 3, "COMPLETADO")])
+    assert agregados.sesiones == 3
+    assert agregados.sesiones_completadas == 1
+    assert list(agregados.sesiones_recientes) == ["b", "c"]
+
+
+def test_checkpoint_anterior_con_sesiones_guardadas():
+    agregados = AgregadosLogs.desde_checkpoint(
+        {"total_turnos": 3, "turnos_por_sesion": {"a": 2, "b": 1}, "sesiones_completadas": ["a"]}
+    )
+    assert (agregados.sesiones, agregados.sesiones_completadas) == (2, 1)
+    assert agregados.sesiones_recientes == {"a": True, "b": False}
+
+
+def test_funnel_alcance_no_crece_entre_pasos():
+    # "b" da todos los datos de una vez: salta de PEDIR_NOMBRE a CONFIRMAR
+    df = pd.DataFrame(
+        [
+            _turno("a", 1, "PEDIR_NOMBRE"),
+            _turno("a", 2, "PEDIR_FECHA"),
+            _turno("b", 1, "PEDIR_NOMBRE"),
+            _turno("b", 2, "CONFIRMAR"),
+            _turno("b", 3, "COMPLETADO"),
+        ]
+    )
+    funnel = calcular_funnel(df)
+    assert funnel["sesiones"].is_monotonic_decreasing
+    assert funnel.loc["PEDIR_FECHA", "sesiones"] == 2
+    assert funnel.loc["CONFIRMAR", "sesiones"] == 1
+    assert funnel.loc["COMPLETADO", "pct_sesiones"] == 50.0
+    assert funnel.loc["PEDIR_FECHA", "abandonos"] == 1
@@ -0,0 +1,89 @@
+﻿import sqlite3
+
+import pytest
+
+from src.api import db
+from src.controllers.agenda import AGENDA
+
+
+@pytest.fixture
+def db_temporal(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "DB_PATH", tmp_path / "appointments.db")
+    monkeypatch.setattr(db, "_SCHEMA_READY", False)
+    db.init_db()
+    AGENDA.reconstruir([])
+    yield tmp_path / "appointments.db"
+    AGENDA.reconstruir([])
+
+
+def _fila(nombre, hora, especialidad="Cardiología", fecha="2027-01-04"):
+    return (nombre, "123456", especialidad, fecha, hora, "virtual", f"sesion-{nombre}")
+
+
+def _contar(path) -> int:
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM appointments").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_un_bloque_admite_una_sola_cita(db_temporal):
+    db.registrar_cita(*_fila("ana", "09:00"))
+    # 09:10 cae en el mismo bloque de 30 minutos; la especialidad se compara normalizada
+    with pytest.raises(db.BloqueOcupadoError):
+        db.registrar_cita(*_fila("beto", "09:10", especialidad="cardiologia"))
+    assert _contar(db_temporal) == 1
+    assert AGENDA.esta_libre("Cardiología", "2027-01-04", "09:00") is False
+
+
+def test_horas_sin_bloque_no_chocan(db_temporal):
+    db.registrar_cita(*_fila("ana", "cualquiera"))
+    db.registrar_cita(*_fila("beto", "cualquiera"))
+    db.registrar_cita(*_fila("carla", None))
+    assert _contar(db_temporal) == 3
+
+
+def test_escritor_falla_solo_el_item_en_conflicto(db_temporal):
+    escritor = db.AppointmentWriter()
+    # Se encolan antes de arrancar: los tres van en el mismo lote
+    futuros = [
+        escritor.submit(_fila("ana", "10:00")),
+        escritor.submit(_fila("beto", "10:00")),
+        escritor.submit(_fila("carla", "11:00")),
+    ]
+    escritor.start()
+    try:
+        assert futuros[0].result(timeout=5) > 0
+        with pytest.raises(db.BloqueOcupadoError):
+            futuros[1].result(timeout=5)
+        assert futuros[2].result(timeout=5) > 0
+    finally:
+        escritor.stop()
+    assert escritor.commits == 1
+    assert _contar(db_temporal) == 2
+
+
+def test_migracion_completa_bloques_sin_romper_duplicados(tmp_path, monkeypatch):
+    path = tmp_path / "vieja.db"
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE appointments (id INTEGER PRIMARY KEY AUTOINCREMENT, nombre TEXT, identificacion TEXT, "
+        "especialidad TEXT, fecha TEXT, hora TEXT, medio TEXT, session_id TEXT, "
+        "created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"
+    )
+    conn.executemany(
+        "INSERT INTO appointments (nombre, especialidad, fecha, hora) VALUES (?, ?, ?, ?)",
+        [("ana", "Pediatría", "2027-01-04", "08:00"), ("beto", "Pediatría", "2027-01-04", "08:00")],
+    )
+    conn.commit()
+    conn.close()
+
+    monkeypatch.setattr(db, "DB_PATH", path)
+    db.init_db()
+    conn = sqlite3.connect(path)
+    try:
+        bloques = conn.execute("SELECT nombre, bloque FROM appointments ORDER BY id").fetchall()
+    finally:
+        conn.close()
+    assert bloques == [("ana", "pediatria|2027-01-04|0"), ("beto", None)]
@@ -0,0 +1,97 @@
+﻿import datetime
+
+import pytest
+
+from benchmarks.fake_openai import FakeOpenAIServer
+from src.controllers.agenda import AGENDA
+from src.controllers.dialog_manager import agente_citas
+from src.controllers.fechas import fijar_reloj
+from src.controllers.llm_client import LLMClient
+from src.controllers.nlu import _entidades_por_validador
+from src.controllers.nlu_cache import NLU_CACHE
+from src.models.domain import ConversationState, FlowStep, Intent, Memory
+
+# Viernes: "manana" es el sabado 2027-01-02 y "el lunes" el 2027-01-04
+AHORA = datetime.datetime(2027, 1, 1, 9, 0)
+
+
+@pytest.fixture
+def llm():
+    fijar_reloj(lambda: AHORA)
+    NLU_CACHE.clear()
+    AGENDA.reconstruir([])
+    servidor = FakeOpenAIServer().start()
+    yield LLMClient(api_key="x", model="m", api_url=servidor.url, max_retries=0), servidor
+    servidor.stop()
+    AGENDA.reconstruir([])
+    NLU_CACHE.clear()
+    fijar_reloj(None)
+
+
+def _estado(paso: FlowStep, **memoria) -> ConversationState:
+    base = {"nombre": "Ana", "identificacion": "2000000"}
+    base.update(memoria)
+    return ConversationState(intent=Intent.AGENDAR_CITA, step=paso, memory=Memory(**base))
+
+
+@pytest.mark.parametrize(
+    "mensaje, paso, campos, esperado, restantes",
+    [
+        ("cardiologia", FlowStep.PEDIR_ESPECIALIDAD, ["especialidad", "fecha", "hora", "medio"], "Cardiología", []),
+        (
+            "cardiologia, mañana",
+            FlowStep.PEDIR_ESPECIALIDAD,
+            ["especialidad", "fecha", "hora", "medio"],
+            "Cardiología",
+            ["fecha", "hora", "medio"],
+        ),
+        ("el lunes a las 10", FlowStep.PEDIR_FECHA, ["fecha", "hora", "medio"], "2027-01-04", ["hora", "medio"]),
+        ("2000000", FlowStep.PEDIR_IDENTIFICACION, ["identificacion", "especialidad"], "2000000", []),
+        # Sin validador (nombre) todo queda para el LLM
+        ("Ana", FlowStep.PEDIR_NOMBRE, ["nombre", "hora"], None, ["nombre", "hora"]),
+    ],
+)
+def test_validador_solo_evita_el_llm_si_la_respuesta_es_ese_dato(llm, mensaje, paso, campos, esperado, restantes):
+    entidades, quedan = _entidades_por_validador(mensaje, campos, paso)
+    slot = {
+        FlowStep.PEDIR_ESPECIALIDAD: "especialidad",
+        FlowStep.PEDIR_FECHA: "fecha",
+        FlowStep.PEDIR_IDENTIFICACION: "identificacion",
+        FlowStep.PEDIR_NOMBRE: "nombre",
+    }[paso]
+    assert entidades[slot] == esperado
+    assert quedan == restantes
+
+
+def test_datos_adelantados_no_se_pierden(llm):
+    cliente, servidor = llm
+    state = _estado(FlowStep.PEDIR_ESPECIALIDAD)
+    respuesta = agente_citas("pediatria para el 2027-01-04 a las 08:00, virtual", state, cliente)
+    assert servidor.peticiones == 1
+    assert (state.memory.especialidad, state.memory.fecha, state.memory.hora, state.memory.medio) == (
+        "Pediatría",
+        "2027-01-04",
+        "08:00",
+        "virtual",
+    )
+    assert state.step == FlowStep.CONFIRMAR
+    assert "Confirmas" in respuesta
+
+
+def test_correccion_al_confirmar(llm):
+    cliente, servidor = llm
+    state = _estado(
+        FlowStep.CONFIRMAR, especialidad="Pediatría", fecha="2027-01-04", hora="08:00", medio="virtual"
+    )
+    respuesta = agente_citas("no, mejor el 2027-01-05", state, cliente)
+    assert state.memory.fecha == "2027-01-05"
+    assert state.step == FlowStep.CONFIRMAR
+    assert "Fecha: 2027-01-05" in respuesta
+
+    # Un "si" que trae otra hora tampoco reserva: se vuelve a confirmar
+    agente_citas("si, pero a las 09:00", state, cliente)
+    assert (state.memory.hora, state.step) == ("09:00", FlowStep.CONFIRMAR)
+
+    peticiones = servidor.peticiones
+    assert agente_citas("si", state, cliente) == "Tu cita ha sido registrada."
+    assert servidor.peticiones == peticiones
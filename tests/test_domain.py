@@ -0,0 +1,38 @@
+﻿import sys
+
+from src.controllers.especialidades import get_catalogo
+from src.controllers.lexicon import get_lexicon
+from src.models.domain import Memory
+
+
+def _copia(texto: str) -> str:
+    # Un string nuevo con el mismo contenido (no el literal ya internado)
+    return "".join(list(texto))
+
+
+def _internado(valor: str) -> bool:
+    return sys.intern(_copia(valor)) is valor
+
+
+def test_se_internan_solo_valores_de_vocabulario_cerrado():
+    get_lexicon()
+    get_catalogo()
+    memoria = Memory(
+        especialidad=_copia("Pediatría"),
+        hora=_copia("08:00"),
+        medio=_copia("virtual"),
+    )
+    assert _internado(memoria.especialidad)
+    assert _internado(memoria.hora)
+    assert _internado(memoria.medio)
+
+
+def test_texto_libre_no_se_interna():
+    memoria = Memory(
+        especialidad=_copia("algo que no esta en el catalogo 7f3a"),
+        hora=_copia("cuando sea 7f3a"),
+        medio=_copia("por telefono 7f3a"),
+    )
+    assert not _internado(memoria.especialidad)
+    assert not _internado(memoria.hora)
+    assert not _internado(memoria.medio)
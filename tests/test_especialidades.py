@@ -0,0 +1,46 @@
+﻿import pytest
+
+from src.controllers.especialidades import CatalogoEspecialidades, canonizar_especialidad
+from src.controllers.nlu import _validar_especialidad
+
+CATALOGO = CatalogoEspecialidades(
+    {
+        "Cardiología": ["cardiologia", "cardiologo", "cardio"],
+        "Dermatología": ["dermatologia", "piel"],
+        "Medicina general": ["medico general", "general"],
+        "Traumatología": ["ortopedia", "trauma"],
+    }
+)
+
+
+@pytest.mark.parametrize(
+    "texto, canonica, ambigua",
+    [
+        ("el cardiologo", "Cardiología", False),
+        ("medico general", "Medicina general", False),
+        ("cardiolojia", "Cardiología", False),
+        ("dermatologia o cardiologia", "Dermatología", True),
+        ("ortopedia no, mejor cardio", "Traumatología", True),
+    ],
+)
+def test_resolver_marca_varias_especialidades(texto, canonica, ambigua):
+    coincidencia = CATALOGO.resolver(texto)
+    assert (coincidencia.canonica, coincidencia.ambigua) == (canonica, ambigua)
+
+
+@pytest.mark.parametrize(
+    "mensaje, esperado",
+    [
+        ("cardiologia", "Cardiología"),
+        ("el cardiólogo", "Cardiología"),
+        ("dermatologia o cardiologia", None),
+        ("ortopedia no, mejor cardio", None),
+        ("no, pediatria", None),
+    ],
+)
+def test_validador_deja_al_llm_lo_ambiguo(mensaje, esperado):
+    assert _validar_especialidad(mensaje) == esperado
+
+
+def test_canonizar_no_elige_entre_dos_especialidades():
+    assert canonizar_especialidad("Dermatología y Cardiología") is None
@@ -0,0 +1,64 @@
+﻿import datetime
+
+import pytest
+
+from src.controllers.fechas import fijar_reloj, normalizar_fecha, normalizar_hora
+
+# Viernes 1 de enero de 2027, 09:00
+AHORA = datetime.datetime(2027, 1, 1, 9, 0)
+
+
+@pytest.fixture(autouse=True)
+def reloj_fijo():
+    fijar_reloj(lambda: AHORA)
+    yield
+    fijar_reloj(None)
+
+
+@pytest.mark.parametrize(
+    "texto, esperado",
+    [
+        ("15:30", "15:30"),
+        ("3:30 pm", "15:30"),
+        ("12 am", "00:00"),
+        ("a las 3 de la tarde", "15:00"),
+        ("a las tres y media", "15:30"),
+        ("a las 10 y cuarto", "10:15"),
+        ("a las tres y diez", "15:10"),
+        # "menos" se descuenta de la hora ya ubicada en la manana o la tarde
+        ("a la una menos cuarto", "12:45"),
+        ("a las 4 menos cuarto", "15:45"),
+        ("a las 8 menos cuarto", "07:45"),
+        ("a las doce menos diez", "11:50"),
+        ("a las 5 menos cuarto de la tarde", "16:45"),
+        ("a las 12 de la noche", "00:00"),
+        ("a las 12 y media de la noche", "00:30"),
+        ("a las 12 menos cuarto de la noche", "23:45"),
+        ("a las 12 de la madrugada", "00:00"),
+        ("a las 12 de la tarde", "12:00"),
+        ("mediodia", "12:00"),
+        ("cuando sea", None),
+    ],
+)
+def test_normalizar_hora(texto, esperado):
+    resultado = normalizar_hora(texto)
+    assert (resultado.valor if resultado else None) == esperado
+
+
+@pytest.mark.parametrize(
+    "texto, esperado",
+    [
+        ("2027-01-04", "2027-01-04"),
+        ("15/12", "2027-12-15"),
+        ("hoy", "2027-01-01"),
+        ("manana", "2027-01-02"),
+        ("pasado manana", "2027-01-03"),
+        ("el lunes", "2027-01-04"),
+        ("el viernes", "2027-01-08"),
+        ("en 3 dias", "2027-01-04"),
+        ("a las 10 de la manana", None),
+    ],
+)
+def test_normalizar_fecha(texto, esperado):
+    resultado = normalizar_fecha(texto)
+    assert (resultado.valor if resultado else None) == esperado
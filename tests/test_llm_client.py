@@ -0,0 +1,77 @@
+﻿import asyncio
+
+import pytest
+
+from benchmarks.fake_openai import FakeOpenAIServer
+from src.controllers.llm_client import RETRYABLE_STATUS, CircuitBreaker, LLMClient
+
+
+@pytest.fixture
+def servidor_lento():
+    servidor = FakeOpenAIServer(latencia_ms=2000).start()
+    yield servidor
+    servidor.stop()
+
+
+def _breaker_semiabierto() -> CircuitBreaker:
+    breaker = CircuitBreaker(umbral=1, enfriamiento=0.0)
+    breaker.registrar_fallo()
+    assert breaker.abierto
+    return breaker
+
+
+def test_semiabierto_deja_pasar_una_sola_prueba():
+    breaker = _breaker_semiabierto()
+    assert breaker.permitir() is True
+    assert breaker.estado == CircuitBreaker.SEMIABIERTO
+    assert breaker.permitir() is False
+    breaker.registrar_exito()
+    assert breaker.estado == CircuitBreaker.CERRADO
+
+
+def test_prueba_cancelada_no_deja_el_breaker_tomado(servidor_lento):
+    breaker = _breaker_semiabierto()
+    llm = LLMClient(api_key="x", model="m", api_url=servidor_lento.url, max_retries=0, breaker=breaker)
+
+    async def cancelar_prueba() -> None:
+        tarea = asyncio.ensure_future(llm.achat([{"role": "user", "content": "hola"}]))
+        await asyncio.sleep(0.2)
+        assert breaker.estado == CircuitBreaker.SEMIABIERTO and not breaker.disponible()
+        tarea.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await tarea
+        await llm.aclose()
+
+    asyncio.run(cancelar_prueba())
+    assert breaker.disponible()
+    assert breaker.permitir() is True
+
+
+def test_conflicto_no_es_reintentable():
+    assert 409 not in RETRYABLE_STATUS
+
+
+@pytest.fixture
+def servidor_cuerpo_invalido():
+    servidor = FakeOpenAIServer(cuerpo_invalido=True).start()
+    yield servidor
+    servidor.stop()
+
+
+def test_cuerpo_invalido_no_se_reintenta_ni_abre_el_breaker(servidor_cuerpo_invalido):
+    breaker = CircuitBreaker(umbral=1, enfriamiento=60.0)
+    llm = LLMClient(
+        api_key="x", model="m", api_url=servidor_cuerpo_invalido.url, max_retries=2, retry_backoff=0.0, breaker=breaker
+    )
+    mensajes = [{"role": "user", "content": "hola"}]
+    assert llm.chat(mensajes) is None
+
+    async def en_async() -> None:
+        assert await llm.achat(mensajes) is None
+        await llm.aclose()
+
+    asyncio.run(en_async())
+    # Sincrono y asincrono igual: una peticion cada uno, sin reintentos ni fallos del breaker
+    assert servidor_cuerpo_invalido.peticiones == 2
+    assert llm.retries == 0
+    assert breaker.estado == CircuitBreaker.CERRADO
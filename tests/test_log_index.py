@@ -0,0 +1,94 @@
+﻿import json
+import os
+
+from src.controllers.log_index import (
+    _ENTRADA,
+    IndiceTranscripts,
+    _IndiceActivo,
+    clave_sesion,
+    main,
+    segmentos_log,
+    sellar_indice,
+)
+from src.controllers.logging_utils import escribir_registros
+
+
+def test_segmentos_ordenados_por_timestamp_y_sufijo(tmp_path):
+    log = str(tmp_path / "logs.jsonl")
+    nombres = [
+        "logs.jsonl.20270101T100000-10",
+        "logs.jsonl.20270101T100000-2",
+        "logs.jsonl.20270101T100000",
+        "logs.jsonl.20261231T235959",
+        "logs.jsonl.20270101T100000-1",
+        "logs.jsonl.idx",
+        "logs.jsonl",
+    ]
+    for nombre in nombres:
+        (tmp_path / nombre).write_text("")
+    assert [p[len(log):] for p in segmentos_log(log)] == [
+        ".20261231T235959",
+        ".20270101T100000",
+        ".20270101T100000-1",
+        ".20270101T100000-2",
+        ".20270101T100000-10",
+        "",
+    ]
+
+
+def test_indice_activo_acotado_da_las_mismas_posiciones(tmp_path):
+    log = str(tmp_path / "logs.jsonl")
+    for turno in range(30):
+        escribir_registros([{"session_id": f"s{turno % 3}", "turno": turno}], log)
+    # Una linea escrita sin indice (otro proceso): esta en el log pero no en el .idx
+    with open(log, "a", encoding="utf-8") as f:
+        f.write(json.dumps({"session_id": "s1", "turno": 30}) + "\n")
+
+    completo = _IndiceActivo()
+    acotado = _IndiceActivo(max_entradas=5)
+    for _ in range(2):  # la segunda consulta ya es sobre el indice desbordado
+        for session_id in ("s0", "s1", "s2", "otra"):
+            clave = clave_sesion(session_id)
+            assert acotado.buscar(log, clave) == completo.buscar(log, clave)
+    assert acotado.desbordado and acotado.posiciones == {}
+    assert len(completo.buscar(log, clave_sesion("s1"))) == 11
+
+
+def _escribir_sin_indice(log: str, registros) -> None:
+    # Lineas de un log anterior al indice (o de un proceso que no lo mantiene)
+    with open(log, "a", encoding="utf-8") as f:
+        for registro in registros:
+            f.write(json.dumps(registro) + "\n")
+
+
+def test_lineas_previas_al_indice_se_encuentran(tmp_path):
+    log = str(tmp_path / "logs.jsonl")
+    _escribir_sin_indice(log, [{"session_id": "vieja", "turno": 1}, {"session_id": "otra", "turno": 1}])
+    assert [t["turno"] for t in IndiceTranscripts(log).transcript("vieja")] == [1]
+
+    escribir_registros([{"session_id": "nueva", "turno": 1}], log)
+    _escribir_sin_indice(log, [{"session_id": "vieja", "turno": 2}])
+    escribir_registros([{"session_id": "nueva", "turno": 2}], log)
+    # Un proceso nuevo: el .idx empieza despues de las lineas viejas y tiene un hueco
+    assert [t["turno"] for t in IndiceTranscripts(log).transcript("vieja")] == [1, 2]
+    acotado = IndiceTranscripts(log)
+    acotado._activo.max_entradas = 1
+    acotado.transcript("nueva")  # desborda: la siguiente consulta recorre el .idx
+    assert [t["turno"] for t in acotado.transcript("vieja")] == [1, 2]
+
+    # Al rotar, el indice sellado tambien incluye las lineas sin indice
+    segmento = log + ".20270101T100000"
+    os.replace(log, segmento)
+    sellar_indice(log, segmento)
+    assert [t["turno"] for t in IndiceTranscripts(log).transcript("vieja")] == [1, 2]
+
+
+def test_reindexar_reconstruye_el_indice_del_log_activo(tmp_path):
+    log = str(tmp_path / "logs.jsonl")
+    _escribir_sin_indice(log, [{"session_id": "vieja", "turno": 1}])
+    escribir_registros([{"session_id": "nueva", "turno": 1}], log)
+    main(["--log", log, "--reindexar"])
+    with open(log + ".idx", "rb") as f:
+        datos = f.read()
+    assert len(datos) == 2 * _ENTRADA.size
+    assert datos[:8] == clave_sesion("vieja")
@@ -0,0 +1,58 @@
+﻿import datetime
+import json
+import threading
+import time
+
+from src.controllers.log_index import segmentos_log
+from src.controllers.logging_utils import BufferedTurnLogger
+
+
+def _registro(session_id: str, hace_segundos: float = 0.0) -> dict:
+    momento = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=hace_segundos)
+    return {"session_id": session_id, "turno": 1, "timestamp": momento.isoformat()}
+
+
+def _escribir(path, registros) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        for registro in registros:
+            f.write(json.dumps(registro) + "\n")
+
+
+def test_stop_no_se_bloquea_con_la_cola_llena(tmp_path):
+    logger = BufferedTurnLogger(log_path=str(tmp_path / "logs.jsonl"), max_queue=1, batch_size=1)
+    trabado = threading.Event()
+    logger._flush = lambda lote: trabado.wait()  # disco colgado
+    logger.start()
+    logger.submit(_registro("a"))
+    time.sleep(0.05)  # el hilo toma "a" y se queda en el flush
+    assert logger.submit(_registro("b"))  # la cola queda llena
+    inicio = time.monotonic()
+    logger.stop(timeout=0.2)
+    assert time.monotonic() - inicio < 1.0
+    trabado.set()
+
+
+def test_rotacion_por_tiempo_cuenta_desde_el_primer_turno(tmp_path):
+    path = tmp_path / "logs.jsonl"
+    _escribir(path, [_registro("viejo", hace_segundos=7200)])
+    # Worker que recien arranca: la edad del archivo no es la de su descriptor
+    logger = BufferedTurnLogger(log_path=str(path), rotate_interval=3600)
+    logger.start()
+    logger.submit(_registro("nuevo"))
+    logger.stop()
+
+    rotado, actual = segmentos_log(str(path))
+    with open(rotado, encoding="utf-8") as f:
+        assert [json.loads(linea)["session_id"] for linea in f] == ["viejo"]
+    with open(actual, encoding="utf-8") as f:
+        assert [json.loads(linea)["session_id"] for linea in f] == ["nuevo"]
+
+
+def test_sin_rotacion_si_el_primer_turno_es_reciente(tmp_path):
+    path = tmp_path / "logs.jsonl"
+    _escribir(path, [_registro("reciente", hace_segundos=60)])
+    logger = BufferedTurnLogger(log_path=str(path), rotate_interval=3600)
+    logger.start()
+    logger.submit(_registro("nuevo"))
+    logger.stop()
+    assert segmentos_log(str(path)) == [str(path)]
@@ -0,0 +1,150 @@
+﻿import time
+
+import pytest
+
+from src.api.session_backends import (
+    ConflictoVersionError,
+    FormatoSesionError,
+    SharedSessionStore,
+    SQLiteSessionBackend,
+    deserializar_estado,
+    serializar_estado,
+)
+from src.models.domain import ConversationState, FlowStep, Intent, Memory
+
+
+@pytest.fixture
+def backend(tmp_path):
+    backend = SQLiteSessionBackend(tmp_path / "sesiones.db")
+    yield backend
+    backend.cerrar()
+
+
+def _estado(**memoria) -> ConversationState:
+    return ConversationState(
+        intent=Intent.AGENDAR_CITA,
+        step=FlowStep.PEDIR_HORA,
+        memory=Memory(**memoria),
+        turn_counter=5,
+        llm_failures=1,
+    )
+
+
+# --- Serializacion -------------------------------------------------------------------------
+
+
+@pytest.mark.parametrize("intent", [None, *Intent])
+@pytest.mark.parametrize("paso", list(FlowStep))
+def test_serializacion_ida_y_vuelta_intent_y_paso(intent, paso):
+    state = ConversationState(intent=intent, step=paso)
+    copia = deserializar_estado(serializar_estado(state))
+    assert (copia.intent, copia.step, copia.session_id) == (intent, paso, state.session_id)
+
+
+def test_serializacion_ida_y_vuelta_memoria():
+    state = _estado(
+        nombre="María José Ñúñez",
+        identificacion="1020304050",
+        especialidad="Cardiología",
+        fecha="2026-10-20",
+        hora="",
+        medio=None,
+    )
+    copia = deserializar_estado(serializar_estado(state), version=7)
+    assert copia.memory == state.memory
+    assert copia.memory.hora == "" and copia.memory.medio is None
+    assert (copia.turn_counter, copia.llm_failures, copia.version) == (5, 1, 7)
+
+
+@pytest.mark.parametrize("datos", [b"", b"\x01\x01", b"\x09" + bytes(20)])
+def test_deserializar_rechaza_bytes_invalidos(datos):
+    with pytest.raises(FormatoSesionError):
+        deserializar_estado(datos)
+
+
+# --- Backend SQLite: compare-and-set y expiracion --------------------------------------------
+
+
+def test_guardar_es_compare_and_set(backend):
+    expira = time.time() + 60
+    assert backend.guardar("s1", 0, b"a", expira) == 1
+    # Alta repetida (dos workers crean la misma sesion): gana el primero
+    assert backend.guardar("s1", 0, b"b", expira) is None
+    assert backend.guardar("s1", 1, b"c", expira) == 2
+    # Version vieja: otro worker ya la modifico
+    assert backend.guardar("s1", 1, b"d", expira) is None
+    assert backend.leer("s1", time.time()) == (2, b"c")
+
+
+def test_borrar_si_solo_con_la_version_leida(backend):
+    backend.guardar("s1", 0, b"a", time.time() + 60)
+    assert backend.borrar_si("s1", 2) is False
+    assert backend.leer("s1", time.time()) is not None
+    assert backend.borrar_si("s1", 1) is True
+    assert backend.leer("s1", time.time()) is None
+    assert backend.borrar_si("s1", 1) is False
+
+
+def test_sesion_expirada_no_se_lee_y_se_puede_recrear(backend):
+    ahora = time.time()
+    backend.guardar("s1", 0, b"vieja", ahora - 1)
+    backend.guardar("s2", 0, b"viva", ahora + 60)
+    assert backend.leer("s1", ahora) is None
+    assert backend.contar(ahora) == 1
+    # Una alta (version 0) reemplaza a la expirada
+    assert backend.guardar("s1", 0, b"nueva", ahora + 60) == 1
+    assert backend.leer("s1", ahora) == (1, b"nueva")
+
+
+def test_purgar_elimina_solo_las_expiradas(backend):
+    ahora = time.time()
+    backend.guardar("s1", 0, b"a", ahora - 1)
+    backend.guardar("s2", 0, b"b", ahora + 60)
+    assert backend.purgar(ahora) == 1
+    assert backend.leer("s2", ahora) == (1, b"b")
+
+
+# --- SharedSessionStore -------------------------------------------------------------------
+
+
+def test_store_put_conflicto_entre_workers(backend):
+    worker_a = SharedSessionStore(backend, cache_ttl=0)
+    worker_b = SharedSessionStore(backend, cache_ttl=0)
+    state = _estado(nombre="Ana")
+    worker_a.put(state)
+
+    copia_a = worker_a.get(state.session_id)
+    copia_b = worker_b.get(state.session_id)
+    copia_a.memory.fecha = "2026-10-20"
+    worker_a.put(copia_a)
+    copia_b.memory.fecha = "2026-10-21"
+    with pytest.raises(ConflictoVersionError):
+        worker_b.put(copia_b)
+    assert worker_b.get(state.session_id).memory.fecha == "2026-10-20"
+    assert worker_b.conflicts == 1
+
+
+def test_store_retirar_solo_lo_completa_un_worker(backend):
+    worker_a = SharedSessionStore(backend, cache_ttl=0)
+    worker_b = SharedSessionStore(backend, cache_ttl=0)
+    state = _estado(nombre="Ana")
+    worker_a.put(state)
+
+    # El mismo "si" llega a los dos workers: ambos leyeron la misma version
+    copia_a = worker_a.get(state.session_id)
+    copia_b = worker_b.get(state.session_id)
+    worker_a.retirar(copia_a)
+    assert copia_a.version == 0
+    with pytest.raises(ConflictoVersionError):
+        worker_b.retirar(copia_b)
+    assert state.session_id not in worker_b
+
+
+def test_store_expira_por_inactividad(backend):
+    store = SharedSessionStore(backend, idle_ttl=0.05, cache_ttl=0)
+    state = _estado()
+    store.put(state)
+    assert store.get(state.session_id) is not None
+    time.sleep(0.1)
+    assert store.get(state.session_id) is None
+    assert store.sweep() == 1